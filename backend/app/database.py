@@ -4,12 +4,14 @@ Provides methods to connect to MongoDB and retrieve collections.
 """
 
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import CollectionInvalid
 from dotenv import load_dotenv
 import os
 
 load_dotenv()
 
 MONGO_INSTANCES_COLLECTION = "mongo_instances"
+STATUS_HISTORY_COLLECTION = "instance_status_history"
 DB_NAME = os.getenv("MONGODB_NAME")
 
 
@@ -17,3 +19,30 @@ async def connect():
     client = AsyncIOMotorClient(os.getenv("MONGODB_URI"))
     db = client[DB_NAME]
     return client, db
+
+
+async def status_history_collection(db):
+    """
+    Returns the time-series collection of the status transitions, creating it if it doesn't
+    exist. Transitions older than STATUS_HISTORY_RETENTION_DAYS are removed by the server.
+    """
+    expire_after = int(os.getenv("STATUS_HISTORY_RETENTION_DAYS", "90")) * 24 * 60 * 60
+    try:
+        collection = await db.create_collection(
+            STATUS_HISTORY_COLLECTION,
+            timeseries={
+                "timeField": "timestamp",
+                "metaField": "instance_id",
+                "granularity": "seconds",
+            },
+            expireAfterSeconds=expire_after,
+        )
+    except CollectionInvalid:
+        # Already created, keep the retention up to date
+        await db.command(
+            "collMod", STATUS_HISTORY_COLLECTION, expireAfterSeconds=expire_after
+        )
+        collection = db.get_collection(STATUS_HISTORY_COLLECTION)
+    # Last status of each instance before a date, read with one index entry per instance
+    await collection.create_index([("instance_id", 1), ("timestamp", -1)])
+    return collection
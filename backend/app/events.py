@@ -0,0 +1,217 @@
+"""
+Events module for Mongo as a Service.
+Fans out the changes to the instances, read from a single change stream, to the clients
+subscribed to them. Events are identified by the resume token of their change, so clients
+can resume from the last event they received.
+"""
+
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from pymongo.errors import OperationFailure
+from .model import MongoInstance
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait before reopening the change stream after an error
+RETRY_INTERVAL = 5
+
+# Error code of change streams opened on a standalone MongoDB server
+CHANGE_STREAMS_NOT_SUPPORTED = 40573
+
+
+class EventsUnavailableError(Exception):
+    """The changes to the instances can't be read, change streams need a replica set."""
+
+
+@dataclass
+class InstanceEvent:
+    # Resume token of the change
+    id: str
+    operation: str
+    instance_id: str
+    instance: MongoInstance | None
+
+
+class Subscription:
+    """
+    Events received by a subscriber. Subscribers that don't keep up with the shared events fill
+    their queue and are dropped: the iteration stops and they have to subscribe again. The
+    iteration raises EventsUnavailableError when the events can't be read at all.
+    """
+
+    def __init__(self, instance_id, queue_size):
+        self.instance_id = instance_id
+        self._queue = asyncio.Queue(queue_size)
+        self._error = None
+
+    def publish(self, event):
+        """Queues the event, returns False if the queue is full."""
+        if self.instance_id is not None and event.instance_id != self.instance_id:
+            return True
+        try:
+            self._queue.put_nowait(event)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    async def put(self, event):
+        """Queues the event, waiting while the queue is full."""
+        if self.instance_id is None or event.instance_id == self.instance_id:
+            await self._queue.put(event)
+
+    def close(self, error=None):
+        """Discards the pending events and stops the iteration, failing with `error` if given."""
+        self._error = error
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        self._queue.put_nowait(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self._queue.get()
+        if event is None:
+            if self._error is not None:
+                raise EventsUnavailableError(self._error)
+            raise StopAsyncIteration
+        return event
+
+
+class InstanceEventsBroadcaster:
+    """
+    Reads the changes to the instances and publishes them to the subscribers. The changes are
+    read once, when there are subscribers, regardless of their number, and the change stream
+    is reopened after the last change read when it fails. The last `history_size` events are
+    kept so reconnecting subscribers can resume from the last event they received, older
+    events, or more than fit in their queue, are read again from a change stream of their own.
+    Change streams need a replica set: on a standalone server the subscriptions fail instead.
+    """
+
+    def __init__(self, instances_service, queue_size=100, history_size=1000):
+        self._instances_service = instances_service
+        self._queue_size = queue_size
+        self._history = deque(maxlen=history_size)
+        self._subscriptions = set()
+        self._resume_token = None
+        self._reader = None
+        # Why the changes can't be read, set when change streams aren't supported
+        self.unavailable_reason = None
+        # Tasks resuming the subscriptions from their own change stream
+        self._resumers = {}
+
+    @asynccontextmanager
+    async def subscribe(self, instance_id=None, last_event_id=None):
+        """
+        Subscribes to the changes of all the instances or of a single one. The changes after
+        the `last_event_id` event are received first.
+        """
+        subscription = Subscription(instance_id, self._queue_size)
+        history_ids = [event.id for event in self._history]
+        resume_after = last_event_id
+        if last_event_id in history_ids:
+            for event in list(self._history)[history_ids.index(last_event_id) + 1 :]:
+                if not subscription.publish(event):
+                    # More missed events than fit in the queue, the rest are read again
+                    break
+                resume_after = event.id
+            else:
+                resume_after = None
+        if resume_after is None:
+            self._follow(subscription)
+            resumer = None
+        else:
+            resumer = asyncio.create_task(self._resume(subscription, resume_after))
+            self._resumers[resumer] = subscription
+        try:
+            yield subscription
+        finally:
+            if resumer is not None:
+                resumer.cancel()
+                self._resumers.pop(resumer, None)
+            self._subscriptions.discard(subscription)
+
+    async def stop(self):
+        """Stops reading the changes and ends the subscriptions."""
+        tasks = [task for task in [self._reader, *self._resumers] if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._reader = None
+        for subscription in [*self._subscriptions, *self._resumers.values()]:
+            subscription.close()
+        self._subscriptions.clear()
+        self._resumers.clear()
+
+    def _follow(self, subscription):
+        """Publishes the next changes read from the shared change stream to the subscription."""
+        if self.unavailable_reason is not None:
+            subscription.close(self.unavailable_reason)
+            return
+        self._subscriptions.add(subscription)
+        if self._reader is None:
+            self._reader = asyncio.create_task(self._read_events())
+
+    def _publish(self, token, operation, instance_id, instance):
+        self._resume_token = token
+        event = InstanceEvent(token, operation, instance_id, instance)
+        self._history.append(event)
+        for subscription in list(self._subscriptions):
+            if not subscription.publish(event):
+                logger.warning("Dropping subscriber not keeping up with the events")
+                self._subscriptions.discard(subscription)
+                subscription.close()
+
+    async def _read_events(self):
+        while True:
+            resume_token = self._resume_token
+            try:
+                async for change in self._instances_service.watch_instances(resume_token):
+                    self._publish(*change)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if (
+                    isinstance(e, OperationFailure)
+                    and e.code == CHANGE_STREAMS_NOT_SUPPORTED
+                ):
+                    self._fail(f"Instance events need MongoDB running as a replica set: {e}")
+                    return
+                logger.error(f"Error reading instance changes: {e}")
+                if resume_token is not None and self._resume_token == resume_token:
+                    # The change stream may not be resumable from there anymore, it's
+                    # reopened from the current changes next time
+                    self._resume_token = None
+            await asyncio.sleep(RETRY_INTERVAL)
+
+    def _fail(self, reason):
+        """Ends the subscriptions with an error as the changes can't be read."""
+        logger.error(reason)
+        self.unavailable_reason = reason
+        self._reader = None
+        for subscription in self._subscriptions:
+            subscription.close(reason)
+        self._subscriptions.clear()
+
+    async def _resume(self, subscription, last_event_id):
+        """
+        Publishes the changes after `last_event_id` to the subscription from a change stream
+        of its own, at the pace the subscriber reads them. Falls back to the shared change
+        stream when it can't be resumed from there.
+        """
+        try:
+            async for token, operation, instance_id, instance in (
+                self._instances_service.watch_instances(last_event_id)
+            ):
+                await subscription.put(
+                    InstanceEvent(token, operation, instance_id, instance)
+                )
+            subscription.close()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Can't resume the instance changes after {last_event_id}: {e}")
+            self._follow(subscription)
@@ -0,0 +1,86 @@
+"""
+History module for Mongo as a Service.
+Records the status transitions of the instances in batches, in the background, so they don't
+add writes to the requests changing the status.
+"""
+
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+
+class StatusHistoryRecorder:
+    """
+    Buffers the status transitions and writes them every `flush_interval` seconds, or as soon
+    as `batch_size` transitions are pending. At most `max_pending` transitions are buffered
+    while the DB is unavailable, newer ones are dropped.
+    """
+
+    def __init__(
+        self, history_repository, batch_size=100, flush_interval=1.0, max_pending=10000
+    ):
+        self._history_repository = history_repository
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._max_pending = max_pending
+        self._pending = []
+        self._batch_ready = asyncio.Event()
+        self._writer = None
+
+    def record(
+        self,
+        instance_id: str,
+        status: str,
+        timestamp: datetime | None = None,
+        wake_seconds: float | None = None,
+    ):
+        """Records a transition. Transitions ending a wake up carry the seconds it took."""
+        if len(self._pending) >= self._max_pending:
+            logger.warning(f"Dropping status transition of instance {instance_id}")
+            return
+        transition = {
+            "timestamp": timestamp or datetime.now(tz=timezone.utc),
+            "instance_id": instance_id,
+            "status": status,
+        }
+        if wake_seconds is not None:
+            transition["wake_seconds"] = wake_seconds
+        self._pending.append(transition)
+        if len(self._pending) >= self._batch_size:
+            self._batch_ready.set()
+
+    async def flush(self):
+        """Writes the pending transitions, keeping them for the next flush if it fails."""
+        self._batch_ready.clear()
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        try:
+            await self._history_repository.insert_transitions(batch)
+        except Exception as e:
+            logger.error(f"Error writing {len(batch)} status transitions: {e}")
+            self._pending = (batch + self._pending)[: self._max_pending]
+
+    def start(self):
+        self._writer = asyncio.create_task(self._write_batches())
+
+    async def stop(self):
+        """Stops writing in the background and writes the pending transitions."""
+        if self._writer is not None:
+            self._writer.cancel()
+            try:
+                await self._writer
+            except asyncio.CancelledError:
+                pass
+            self._writer = None
+        await self.flush()
+
+    async def _write_batches(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
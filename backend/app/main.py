@@ -3,39 +3,94 @@ Main application module for Mongo as a Service.
 Initializes the FastAPI application and includes routers.
 """
 
-from fastapi import FastAPI
+import asyncio
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 from contextlib import asynccontextmanager
-from .database import connect, MONGO_INSTANCES_COLLECTION
-from .repository import MongoInstancesRepository
-from .services import InstancesService
-from .provisioner import Provisioner
+from .events import InstanceEventsBroadcaster
+from .resilience import CircuitOpenError
 from .routes import Routes
 
 
+async def create_instances_service():
+    """
+    Connects to the DB and the clusters concurrently and returns the instances service, the
+    status recorder and the provisioner, to be stopped, and the DB client, to be closed. The
+    DB driver and the Kubernetes client are imported here, so they aren't loaded when the
+    service is provided, as in tests.
+    """
+    from .database import connect, status_history_collection, MONGO_INSTANCES_COLLECTION
+    from .history import StatusHistoryRecorder
+    from .provisioner import Provisioner
+    from .repository import MongoInstancesRepository, StatusHistoryRepository
+    from .services import InstancesService
+
+    mongo_client, mongo_db = await connect()
+    try:
+        history_collection, provisioner = await asyncio.gather(
+            status_history_collection(mongo_db), Provisioner.create()
+        )
+    except BaseException:
+        mongo_client.close()
+        raise
+    history_repository = StatusHistoryRepository(history_collection)
+    status_recorder = StatusHistoryRecorder(history_repository)
+    instances_repository = MongoInstancesRepository(
+        mongo_db.get_collection(MONGO_INSTANCES_COLLECTION), status_recorder
+    )
+    instances_service = InstancesService(
+        instances_repository, provisioner, history_repository
+    )
+    return instances_service, status_recorder, provisioner, mongo_client
+
+
 def create_app(instances_service=None) -> FastAPI:
     """
     Create and configure the FastAPI application.
     """
+    routes = Routes()
 
     @asynccontextmanager
     async def lifespan(app: FastAPI):
         nonlocal instances_service
         mongo_client = None
+        events_broadcaster = None
+        status_recorder = None
+        provisioner = None
         try:
             if instances_service is None:
-                mongo_client, mongo_db = await connect()
-                instances_collection = mongo_db.get_collection(
-                    MONGO_INSTANCES_COLLECTION
-                )
-                instances_repository = MongoInstancesRepository(instances_collection)
-                provisioner = Provisioner()
-                instances_service = InstancesService(instances_repository, provisioner)
-            routes = Routes(instances_service)
-            app.include_router(routes.router)
+                (
+                    instances_service,
+                    status_recorder,
+                    provisioner,
+                    mongo_client,
+                ) = await create_instances_service()
+                status_recorder.start()
+                provisioner.start()
+            events_broadcaster = InstanceEventsBroadcaster(instances_service)
+            routes.set_services(instances_service, events_broadcaster)
             yield
         finally:
+            if events_broadcaster:
+                await events_broadcaster.stop()
+            if status_recorder:
+                await status_recorder.stop()
+            if provisioner:
+                await provisioner.stop()
             if mongo_client:
-                await mongo_client.close()
+                mongo_client.close()
 
     app = FastAPI(title="Mongo as a Service", lifespan=lifespan)
+    app.include_router(routes.router)
+
+    @app.get("/healthz", include_in_schema=False)
+    async def healthz():
+        """Returns 200 once the application has started, without calling the DB or the
+        clusters, for the readiness and liveness probes."""
+        return {"status": "ok"}
+
+    @app.exception_handler(CircuitOpenError)
+    async def circuit_open_handler(request: Request, exc: CircuitOpenError):
+        return JSONResponse(status_code=503, content={"detail": str(exc)})
+
     return app
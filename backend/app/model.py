@@ -1,8 +1,17 @@
 from datetime import datetime
-from pydantic import BaseModel
+from pydantic import BaseModel, computed_field
+import re
 import secrets
 import string
 
+_STORAGE_UNITS = {"Ki": 2**10, "Mi": 2**20, "Gi": 2**30, "Ti": 2**40}
+STORAGE_SIZE_PATTERN = r"^[0-9]+(Ki|Mi|Gi|Ti)$"
+VERSION_PATTERN = r"^([0-9]+)\.([0-9]+)(?:\.([0-9]+))?$"
+# Version of the new instances when none is requested
+DEFAULT_VERSION = "8.0"
+# Release series before 5.0 were named after the first two numbers of the version
+_LEGACY_NEXT_SERIES = {(3, 6): (4, 0), (4, 0): (4, 2), (4, 2): (4, 4), (4, 4): (5, 0)}
+
 
 class MongoInstance(BaseModel):
     name: str
@@ -11,8 +20,95 @@ class MongoInstance(BaseModel):
     status: str | None = None
     host: str | None = None
     port: int | None = None
+    tls: bool = False
+    # Version requested, instances created before versions were pinned run "latest"
+    version: str = "latest"
+    # Version running, reported by the operator once the rollouts complete
+    running_version: str | None = None
+    storage_size: str = "5Gi"
+    # Whether the storage class of the instance allows volume expansion, reported by the operator
+    storage_expandable: bool | None = None
+    members: int = 1
+    replica_set: str | None = None
+    from_snapshot: str | None = None
+    last_wake_seconds: float | None = None
+    cluster: str | None = None
+
+    @computed_field
+    @property
+    def connection_string(self) -> str | None:
+        """
+        Connection string of the instance. Outside the cluster replica sets are reached through
+        their primary only, the members' in-cluster names can't be resolved by the clients, so
+        the connection is direct instead of discovering the replica set.
+        """
+        if not (self.host and self.port):
+            return None
+        options = []
+        if self.replica_set:
+            options.append("directConnection=true")
+        if self.tls:
+            options.append("tls=true")
+        return f"mongodb://{self.host}:{self.port}/" + (
+            f"?{'&'.join(options)}" if options else ""
+        )
 
     @classmethod
     def generate_password(cls, length=16):
         characters = string.ascii_letters + string.digits
         return "".join(secrets.choice(characters) for _ in range(length))
+
+
+class MongoSnapshot(BaseModel):
+    id: str
+    instance_id: str
+    created_at: datetime
+    # Phase reported by the operator: InProgress, Ready or Failed
+    status: str | None = None
+    # Spec of the source instance, inherited by the clones
+    storage_size: str | None = None
+    version: str | None = None
+    cluster: str | None = None
+
+
+def parse_storage_size(size: str) -> int:
+    """Returns the number of bytes of a Kubernetes storage quantity like `5Gi`."""
+    match = re.match(STORAGE_SIZE_PATTERN, size)
+    if not match:
+        raise ValueError(f"Invalid storage size: {size}")
+    return int(size[: -len(match.group(1))]) * _STORAGE_UNITS[match.group(1)]
+
+
+def parse_version(version: str) -> tuple[int, int, int]:
+    """Returns the numbers of a MongoDB version like `8.0.6`."""
+    match = re.match(VERSION_PATTERN, version)
+    if not match:
+        raise ValueError(f"Invalid version: {version}")
+    return tuple(int(number or 0) for number in match.groups())
+
+
+def _release_series(version: tuple[int, int, int]) -> tuple[int, int]:
+    return version[:2] if version[0] < 5 else (version[0], 0)
+
+
+def check_version_upgrade(current: str, target: str):
+    """
+    Raises ValueError unless `target` is the same version as `current`, the version running,
+    or an upgrade to the same or the next release series, as MongoDB can't be downgraded nor
+    skip a major release.
+    """
+    if target == current:
+        return
+    if target == "latest":
+        raise ValueError("Version can't be changed to latest, pin a version")
+    target_version = parse_version(target)
+    current_version = parse_version(current)
+    if target_version < current_version:
+        raise ValueError(f"Version can't be downgraded from {current} to {target}")
+    current_series = _release_series(current_version)
+    next_series = _LEGACY_NEXT_SERIES.get(current_series, (current_series[0] + 1, 0))
+    if _release_series(target_version) > next_series:
+        raise ValueError(
+            f"Version can't be upgraded from {current} to {target}, upgrade to "
+            f"{next_series[0]}.{next_series[1]} first"
+        )
@@ -1,8 +1,33 @@
 """Provisioner for MongoDB instances. It takes care of creating and deleting the MongoDB instance
-in Kubernetes using the MongoInstance resource kind."""
+in Kubernetes using the MongoInstance resource kind, spreading the instances across clusters."""
 
+import asyncio
+import logging
+import os
+import posixpath
+import re
 from base64 import b64encode
-from kr8s.objects import new_class, Secret
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import NamedTuple
+import httpx
+import kr8s.asyncio
+from kr8s import APITimeoutError, NotFoundError, ServerError
+from kr8s.asyncio.objects import (
+    new_class,
+    Job,
+    PersistentVolume,
+    PersistentVolumeClaim,
+    Pod,
+    Secret,
+)
+from .model import MongoSnapshot
+from .resilience import CircuitBreaker, CircuitOpenError, TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Name of the cluster used when no kubeconfig contexts are configured
+DEFAULT_CLUSTER = "default"
 
 MongoInstanceResource = new_class(
     kind="MongoInstance",
@@ -11,29 +36,178 @@ MongoInstanceResource = new_class(
     plural="mongoinstances",
 )
 
+MongoSnapshotResource = new_class(
+    kind="MongoSnapshot",
+    version="mongo.miguelgarcia.dev/v1",
+    namespaced=True,
+    plural="mongosnapshots",
+)
+
+# Annotation set by the operator on hostPath volumes with the node holding their data
+NODE_ANNOTATION = "mongo.miguelgarcia.dev/node"
+
+# Names of the resources created for an instance, the instance ID is the first group
+MANAGED_RESOURCE_NAMES = {
+    MongoInstanceResource: re.compile(r"^mongo-instance-([0-9a-f]{24})$"),
+    Secret: re.compile(r"^mongo-credentials-([0-9a-f]{24})$"),
+    PersistentVolumeClaim: re.compile(
+        r"^(?:storage-)?mongo-instance-([0-9a-f]{24})(?:-pvc|-\d+)$"
+    ),
+    PersistentVolume: re.compile(r"^mongo-instance-([0-9a-f]{24})-pv$"),
+}
+
+
+class ManagedResource(NamedTuple):
+    """A Kubernetes resource created for a MongoDB instance."""
+
+    kind: type
+    name: str
+    instance_id: str
+    created_at: datetime
+    cluster: str = DEFAULT_CLUSTER
+
+
+class ClusterLoad(NamedTuple):
+    """Capacity of a cluster, as schedulable nodes, and load, as MongoDB members running."""
+
+    capacity: int
+    load: int
+
+
+class KubernetesCluster:
+    """
+    Provisions instances in a cluster using a long-lived Kubernetes API client. Calls are rate
+    limited to `qps` calls per second with bursts of `burst` calls, and rejected with
+    `CircuitOpenError` after `failure_threshold` consecutive failures of the API server, for
+    `reset_timeout` seconds.
+    """
+
+    def __init__(
+        self,
+        name,
+        api,
+        qps=20,
+        burst=40,
+        failure_threshold=5,
+        reset_timeout=30,
+    ):
+        self.name = name
+        self._api = api
+        self._rate_limiter = TokenBucket(qps, burst)
+        self._circuit_breaker = CircuitBreaker(failure_threshold, reset_timeout)
+
+    @classmethod
+    async def create(cls, name, context=None):
+        """Creates a client for the cluster of the kubeconfig context, configured from the
+        environment."""
+        return cls(
+            name,
+            await kr8s.asyncio.api(context=context),
+            qps=float(os.getenv("K8S_QPS", "20")),
+            burst=int(os.getenv("K8S_BURST", "40")),
+            failure_threshold=int(os.getenv("K8S_FAILURE_THRESHOLD", "5")),
+            reset_timeout=float(os.getenv("K8S_RESET_TIMEOUT", "30")),
+        )
+
+    @property
+    def is_available(self):
+        return not self._circuit_breaker.is_open
+
+    @asynccontextmanager
+    async def _api_call(self):
+        """Wraps calls to the API server with the rate limiter and the circuit breaker. Only
+        server errors and connectivity issues count as failures."""
+        self._circuit_breaker.before_call()
+        try:
+            await self._rate_limiter.acquire()
+            yield
+        except NotFoundError:
+            self._circuit_breaker.record_success()
+            raise
+        except ServerError as e:
+            if e.response is None or e.response.status_code >= 500:
+                self._circuit_breaker.record_failure()
+            else:
+                self._circuit_breaker.record_success()
+            raise
+        except (APITimeoutError, httpx.HTTPError, OSError):
+            self._circuit_breaker.record_failure()
+            raise
+        except BaseException:
+            self._circuit_breaker.record_aborted()
+            raise
+        self._circuit_breaker.record_success()
+
+    async def _list(self, kind, namespace=None, page_size=100):
+        """Lists the resources of a kind page by page, each page fetched in its own API call,
+        so no call is held open while the resources are consumed."""
+        params = {"limit": page_size}
+        while True:
+            async with self._api_call():
+                async with self._api.async_get_kind(
+                    kind, namespace=namespace, params=dict(params)
+                ) as (resource_class, response):
+                    page = response.json()
+            for item in page.get("items", []):
+                yield resource_class(item, api=self._api)
+            params["continue"] = page.get("metadata", {}).get("continue")
+            if not params["continue"]:
+                return
+
+    async def _delete(self, k8s_resource):
+        """Deletes the resource and its dependents in the background, ignoring it if it doesn't
+        exist. Returns whether the resource existed."""
+        try:
+            async with self._api_call():
+                await k8s_resource.async_delete(propagation_policy="Background")
+        except NotFoundError:
+            return False
+        return True
 
-class Provisioner:
     async def provision_instance(self, instance, root_password):
-        """Provisions a MongoDB instance in Kubernetes using the MongoInstance kind."""
+        """Provisions a MongoDB instance in Kubernetes using the MongoInstance kind. Instances
+        cloned from a snapshot reuse the credentials of the source instance."""
         k8s_name = f"mongo-instance-{instance.id}"
         k8s_credentials = f"mongo-credentials-{instance.id}"
         k8s_namespace = "default"
+        if instance.from_snapshot:
+            async with self._api_call():
+                snapshot = await MongoSnapshotResource.async_get(
+                    f"mongo-snapshot-{instance.from_snapshot}",
+                    namespace=k8s_namespace,
+                    api=self._api,
+                )
+            # Snapshots keep their own copy of the credentials, older ones only reference the
+            # secret of their source instance
+            snapshot_status = snapshot.raw.get("status", {})
+            async with self._api_call():
+                source_secret = await Secret.async_get(
+                    snapshot_status.get(
+                        "credentialsSecret", snapshot.spec["credentialsSecret"]
+                    ),
+                    namespace=k8s_namespace,
+                    api=self._api,
+                )
+            credentials = dict(source_secret.data)
+        else:
+            credentials = {
+                "username": b64encode("root".encode()).decode(),
+                "password": b64encode(root_password.encode()).decode(),
+            }
+        # The secret is created first, so the operator never sees an instance without
+        # credentials, and then owned by the MongoInstance, so it is garbage collected with it
         secret = Secret(
             {
                 "apiVersion": "v1",
                 "kind": "Secret",
-                "metadata": {
-                    "name": k8s_credentials,
-                    "namespace": k8s_namespace,
-                },
+                "metadata": {"name": k8s_credentials, "namespace": k8s_namespace},
                 "type": "Opaque",
-                "data": {
-                    "username": b64encode("root".encode()).decode(),
-                    "password": b64encode(root_password.encode()).decode(),
-                },
-            }
+                "data": credentials,
+            },
+            api=self._api,
         )
-        await secret.async_create()
+        async with self._api_call():
+            await secret.async_create()
         k8s_resource = MongoInstanceResource(
             {
                 "metadata": {
@@ -42,27 +216,401 @@ class Provisioner:
                     "annotations": {"mongo-instance-id": instance.id},
                 },
                 "spec": {
-                    "storageSize": "5Gi",
-                    "version": "latest",
+                    "storageSize": instance.storage_size,
+                    "version": instance.version,
+                    "members": instance.members,
                     "credentialsSecret": k8s_credentials,
                 },
-            }
+            },
+            api=self._api,
+        )
+        if instance.from_snapshot:
+            k8s_resource.raw["spec"]["fromSnapshot"] = (
+                f"mongo-snapshot-{instance.from_snapshot}"
+            )
+        try:
+            async with self._api_call():
+                await k8s_resource.async_create()
+        except Exception:
+            # Left to the sweeper if it can't be deleted either
+            try:
+                await self._delete(secret)
+            except Exception as e:
+                logger.warning(f"Error deleting secret {k8s_credentials}: {e}")
+            raise
+        async with self._api_call():
+            await secret.async_patch(
+                {
+                    "metadata": {
+                        "ownerReferences": [
+                            {
+                                "apiVersion": MongoInstanceResource.version,
+                                "kind": MongoInstanceResource.kind,
+                                "name": k8s_name,
+                                "uid": k8s_resource.metadata["uid"],
+                            }
+                        ]
+                    }
+                }
+            )
+
+    async def snapshot_instance(self, instance, snapshot_id):
+        """Takes a snapshot of a MongoDB instance creating a MongoSnapshot resource. The
+        operator takes care of taking a volume snapshot or a dump of the instance data."""
+        k8s_namespace = "default"
+        k8s_resource = MongoSnapshotResource(
+            {
+                "metadata": {
+                    "name": f"mongo-snapshot-{snapshot_id}",
+                    "namespace": k8s_namespace,
+                    "annotations": {"mongo-instance-id": instance.id},
+                },
+                "spec": {
+                    "instance": f"mongo-instance-{instance.id}",
+                    "credentialsSecret": f"mongo-credentials-{instance.id}",
+                },
+            },
+            api=self._api,
+        )
+        async with self._api_call():
+            await k8s_resource.async_create()
+
+    async def update_instance(self, instance, version=None, storage_size=None):
+        """Updates the version and/or storage size of the MongoInstance resource. The operator
+        takes care of rolling out the changes."""
+        k8s_name = f"mongo-instance-{instance.id}"
+        k8s_namespace = "default"
+        spec = {}
+        if version is not None:
+            spec["version"] = version
+        if storage_size is not None:
+            spec["storageSize"] = storage_size
+        k8s_resource = MongoInstanceResource(
+            {"metadata": {"name": k8s_name, "namespace": k8s_namespace}}, api=self._api
+        )
+        async with self._api_call():
+            await k8s_resource.async_patch({"spec": spec})
+
+    async def wake_instance(self, instance):
+        """Wakes up a hibernated MongoDB instance. The operator scales it back up."""
+        k8s_name = f"mongo-instance-{instance.id}"
+        k8s_namespace = "default"
+        k8s_resource = MongoInstanceResource(
+            {"metadata": {"name": k8s_name, "namespace": k8s_namespace}}, api=self._api
+        )
+        async with self._api_call():
+            await k8s_resource.async_patch({"spec": {"hibernated": False}})
+
+    async def get_snapshot(self, snapshot_id):
+        """Returns the MongoSnapshot resource of this cluster, or None if it isn't here."""
+        try:
+            async with self._api_call():
+                snapshot = await MongoSnapshotResource.async_get(
+                    f"mongo-snapshot-{snapshot_id}", namespace="default", api=self._api
+                )
+        except NotFoundError:
+            return None
+        status = snapshot.raw.get("status", {})
+        source = status.get("source", {})
+        created_at = snapshot.metadata["creationTimestamp"].replace("Z", "+00:00")
+        return MongoSnapshot(
+            id=snapshot_id,
+            instance_id=snapshot.annotations.get("mongo-instance-id", ""),
+            created_at=datetime.fromisoformat(created_at),
+            status=status.get("phase"),
+            storage_size=source.get("storageSize"),
+            version=source.get("version"),
+            cluster=self.name,
+        )
+
+    async def delete_snapshot(self, snapshot_id):
+        """Deletes the MongoSnapshot resource, its volume snapshot or archive is garbage
+        collected by Kubernetes. Returns False if it didn't exist."""
+        return await self._delete(
+            MongoSnapshotResource(
+                {
+                    "metadata": {
+                        "name": f"mongo-snapshot-{snapshot_id}",
+                        "namespace": "default",
+                    }
+                },
+                api=self._api,
+            )
+        )
+
+    async def get_load(self):
+        """Counts the schedulable nodes that are ready and the MongoDB members running."""
+        capacity = 0
+        async for node in self._list("nodes"):
+            ready = any(
+                condition["type"] == "Ready" and condition["status"] == "True"
+                for condition in node.raw.get("status", {}).get("conditions", [])
+            )
+            if ready and not node.raw.get("spec", {}).get("unschedulable"):
+                capacity += 1
+        load = 0
+        async for instance in self._list(MongoInstanceResource, namespace="default"):
+            load += instance.spec.get("members", 1)
+        return ClusterLoad(capacity, load)
+
+    async def list_managed_resources(self):
+        """Lists the resources created for MongoDB instances, MongoInstance resources first. The
+        resources are listed page by page as they are consumed."""
+        for kind, pattern in MANAGED_RESOURCE_NAMES.items():
+            namespace = "default" if kind.namespaced else None
+            async for resource in self._list(kind, namespace=namespace):
+                match = pattern.match(resource.name)
+                if not match:
+                    continue
+                instance_id = match.group(1)
+                if kind is MongoInstanceResource:
+                    instance_id = resource.annotations.get(
+                        "mongo-instance-id", instance_id
+                    )
+                created_at = resource.metadata["creationTimestamp"].replace(
+                    "Z", "+00:00"
+                )
+                yield ManagedResource(
+                    kind=kind,
+                    name=resource.name,
+                    instance_id=instance_id,
+                    created_at=datetime.fromisoformat(created_at),
+                    cluster=self.name,
+                )
+
+    async def delete_managed_resource(self, resource):
+        """Deletes a resource created for a MongoDB instance. The hostPath data of volumes is
+        deleted from their node first."""
+        namespace = "default" if resource.kind.namespaced else None
+        if resource.kind is PersistentVolume:
+            await self._delete_host_path_data(resource.name)
+        await self._delete(
+            resource.kind(
+                {"metadata": {"name": resource.name, "namespace": namespace}},
+                api=self._api,
+            )
         )
-        await k8s_resource.async_create()
+
+    async def _delete_host_path_data(self, pv_name):
+        """
+        Runs a job deleting the hostPath data of the volume on the node holding it, as deleting
+        the volume leaves the data on the node. Raises an error while the pod of the instance
+        is still running, so the volume is kept until a later sweep.
+        """
+        try:
+            async with self._api_call():
+                pv = await PersistentVolume.async_get(pv_name, api=self._api)
+        except NotFoundError:
+            return
+        path = pv.spec.get("hostPath", {}).get("path")
+        if not path:
+            return
+        node_name = pv.annotations.get(NODE_ANNOTATION)
+        if not node_name:
+            logger.warning(f"Node of {pv_name} is unknown, delete {path} manually")
+            return
+        instance_name = pv_name.removesuffix("-pv")
+        try:
+            async with self._api_call():
+                await Pod.async_get(f"{instance_name}-0", namespace="default", api=self._api)
+        except NotFoundError:
+            pass
+        else:
+            raise RuntimeError(f"Pod of {instance_name} is still running")
+        parent, data = posixpath.split(path.rstrip("/"))
+        job = Job(
+            {
+                "apiVersion": "batch/v1",
+                "kind": "Job",
+                "metadata": {"name": f"{instance_name}-cleanup", "namespace": "default"},
+                "spec": {
+                    "backoffLimit": 2,
+                    "ttlSecondsAfterFinished": 300,
+                    "template": {
+                        "spec": {
+                            "restartPolicy": "Never",
+                            "nodeName": node_name,
+                            "containers": [
+                                {
+                                    "name": "cleanup",
+                                    "image": "busybox",
+                                    "command": ["rm", "-rf", f"/host/{data}"],
+                                    "volumeMounts": [{"mountPath": "/host", "name": "host"}],
+                                }
+                            ],
+                            "volumes": [{"name": "host", "hostPath": {"path": parent}}],
+                        }
+                    },
+                },
+            },
+            api=self._api,
+        )
+        try:
+            async with self._api_call():
+                await job.async_create()
+        except ServerError as e:
+            # Created by a previous sweep which failed to delete the volume
+            if not e.response or e.response.status_code != 409:
+                raise
 
     async def deprovision_instance(self, instance):
         """Deprovisions a MongoDB instance in Kubernetes deleting the associated MongoInstance
-        resource."""
+        resource. The rest of the resources are garbage collected by Kubernetes. Returns False
+        if the MongoInstance resource didn't exist."""
         k8s_name = f"mongo-instance-{instance.id}"
         k8s_namespace = "default"
-        k8s_credentials = f"mongo-credentials-{instance.id}"
-        k8s_resource = MongoInstanceResource(
-            {"metadata": {"name": k8s_name, "namespace": k8s_namespace}}
+        return await self._delete(
+            MongoInstanceResource(
+                {"metadata": {"name": k8s_name, "namespace": k8s_namespace}},
+                api=self._api,
+            )
         )
-        secret = Secret(
-            {"metadata": {"name": k8s_credentials, "namespace": k8s_namespace}}
+
+
+class Provisioner:
+    """
+    Provisions instances across a registry of clusters. New instances go to the cluster with
+    the fewest MongoDB members per schedulable node, clones go to the cluster of their
+    snapshot, and the rest of the operations go to the cluster recorded in the instance. The
+    load of the clusters is cached and refreshed every `refresh_interval` seconds.
+    """
+
+    def __init__(self, clusters, refresh_interval=60):
+        self._clusters = {cluster.name: cluster for cluster in clusters}
+        # Instances without cluster were created before there was more than one
+        self._default_cluster = clusters[0]
+        self._refresh_interval = refresh_interval
+        self._loads = {cluster.name: ClusterLoad(1, 0) for cluster in clusters}
+        self._refresher = None
+
+    @classmethod
+    async def create(cls):
+        """
+        Creates a provisioner for the clusters of the comma-separated kubeconfig contexts in
+        K8S_CONTEXTS, named after the contexts, or for the current cluster if it isn't set.
+        """
+        contexts = [c.strip() for c in os.getenv("K8S_CONTEXTS", "").split(",") if c]
+        if not contexts:
+            clusters = [await KubernetesCluster.create(DEFAULT_CLUSTER)]
+        else:
+            clusters = await asyncio.gather(
+                *(KubernetesCluster.create(context, context) for context in contexts)
+            )
+        return cls(
+            clusters, refresh_interval=float(os.getenv("K8S_REFRESH_INTERVAL", "60"))
+        )
+
+    def start(self):
+        """Starts refreshing the load of the clusters in the background."""
+        self._refresher = asyncio.create_task(self._refresh_loads())
+
+    async def stop(self):
+        if self._refresher is not None:
+            self._refresher.cancel()
+            try:
+                await self._refresher
+            except asyncio.CancelledError:
+                pass
+            self._refresher = None
+
+    async def refresh_loads(self):
+        """Refreshes the cached load of the clusters, keeping the last one known on errors."""
+
+        async def refresh(cluster):
+            try:
+                self._loads[cluster.name] = await cluster.get_load()
+            except Exception as e:
+                logger.warning(f"Error getting the load of cluster {cluster.name}: {e}")
+
+        await asyncio.gather(*(refresh(c) for c in self._clusters.values()))
+
+    async def _refresh_loads(self):
+        while True:
+            await self.refresh_loads()
+            await asyncio.sleep(self._refresh_interval)
+
+    async def select_cluster(self):
+        """Returns the name of the least loaded cluster among the available ones."""
+        candidates = [
+            cluster
+            for cluster in self._clusters.values()
+            if cluster.is_available and self._loads[cluster.name].capacity > 0
+        ] or list(self._clusters.values())
+
+        def score(cluster):
+            capacity, load = self._loads[cluster.name]
+            return load / capacity if capacity else float("inf")
+
+        selected = min(candidates, key=score)
+        # Count the instance until the next refresh, so bursts are spread too
+        capacity, load = self._loads[selected.name]
+        self._loads[selected.name] = ClusterLoad(capacity, load + 1)
+        return selected.name
+
+    async def get_snapshot(self, snapshot_id):
+        """
+        Returns the snapshot from the cluster holding it, or None if it doesn't exist. Clusters
+        whose API server is unavailable are skipped, and CircuitOpenError is raised when the
+        snapshot isn't found in the rest, as it may be in one of them.
+        """
+        unavailable = []
+        for cluster in self._clusters.values():
+            if not cluster.is_available:
+                unavailable.append(cluster.name)
+                continue
+            try:
+                snapshot = await cluster.get_snapshot(snapshot_id)
+            except CircuitOpenError:
+                unavailable.append(cluster.name)
+                continue
+            if snapshot is not None:
+                return snapshot
+        if unavailable:
+            raise CircuitOpenError(
+                f"Snapshot {snapshot_id} not found, clusters {', '.join(unavailable)} are"
+                " unavailable"
+            )
+        return None
+
+    async def delete_snapshot(self, snapshot):
+        return await self._clusters[snapshot.cluster].delete_snapshot(snapshot.id)
+
+    @property
+    def default_cluster(self):
+        """Name of the cluster of the instances without cluster."""
+        return self._default_cluster.name
+
+    def _cluster_of(self, instance):
+        if instance.cluster is None:
+            return self._default_cluster
+        try:
+            return self._clusters[instance.cluster]
+        except KeyError:
+            raise ValueError(f"Unknown cluster {instance.cluster}")
+
+    async def provision_instance(self, instance, root_password):
+        await self._cluster_of(instance).provision_instance(instance, root_password)
+
+    async def snapshot_instance(self, instance, snapshot_id):
+        await self._cluster_of(instance).snapshot_instance(instance, snapshot_id)
+
+    async def update_instance(self, instance, version=None, storage_size=None):
+        await self._cluster_of(instance).update_instance(
+            instance, version=version, storage_size=storage_size
         )
-        if await secret.async_exists():
-            await secret.async_delete()
-        if await k8s_resource.async_exists():
-            await k8s_resource.async_delete()
+
+    async def wake_instance(self, instance):
+        await self._cluster_of(instance).wake_instance(instance)
+
+    async def deprovision_instance(self, instance):
+        return await self._cluster_of(instance).deprovision_instance(instance)
+
+    async def list_managed_resources(self):
+        """Lists the resources created for MongoDB instances, cluster by cluster, with the
+        MongoInstance resources of each cluster first."""
+        for cluster in self._clusters.values():
+            async for resource in cluster.list_managed_resources():
+                yield resource
+
+    async def delete_managed_resource(self, resource):
+        await self._clusters[resource.cluster].delete_managed_resource(resource)
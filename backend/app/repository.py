@@ -3,19 +3,45 @@ CRUD operations module for Mongo as a Service.
 Provides functions for creating, reading, updating, and deleting MongoDB instances in the DB.
 """
 
+import logging
+from datetime import datetime, timezone
 from bson.objectid import ObjectId
+from pymongo import ReturnDocument
 from .model import MongoInstance
 
+logger = logging.getLogger(__name__)
+
+# Statuses not counted towards the availability of an instance
+AVAILABILITY_EXCLUDED_STATUSES = ["provisioning", "hibernated", "deleting", "deleted"]
+
+# Upper bounds in seconds of the buckets of the wake time histogram, the last one is unbounded
+WAKE_TIME_BUCKETS = [5, 10, 30, 60, 120, 300]
+
+# Naive datetimes are UTC for the server
+_EPOCH = datetime(1970, 1, 1)
+_DAY_MS = 24 * 60 * 60 * 1000
+
 
 class MongoInstancesRepository:
-    def __init__(self, instances_collection):
+    """
+    Stores the instances. When a `status_recorder` is given, the status transitions of the
+    instances are recorded in the status history.
+    """
+
+    def __init__(self, instances_collection, status_recorder=None):
         self._instances_collection = instances_collection
+        self._status_recorder = status_recorder
+
+    def _record_status(self, instance_id, status, timestamp=None, wake_seconds=None):
+        if self._status_recorder is not None:
+            self._status_recorder.record(instance_id, status, timestamp, wake_seconds)
 
     async def create_instance(self, instance: MongoInstance):
         result = await self._instances_collection.insert_one(
-            instance.model_dump(exclude={"id"})
+            instance.model_dump(exclude={"id", "connection_string"})
         )
         instance.id = str(result.inserted_id)
+        self._record_status(instance.id, instance.status, instance.created_at)
         return instance
 
     async def get_instance(self, instance_id: str):
@@ -39,13 +65,416 @@ class MongoInstancesRepository:
             async for doc in cursor
         )
 
+    async def get_all_instance_states(self):
+        """Streams the ID, status, creation time and cluster of every instance."""
+        cursor = self._instances_collection.find(
+            {}, projection={"status": True, "created_at": True, "cluster": True}
+        )
+        async for doc in cursor:
+            yield str(doc["_id"]), doc.get("status"), doc["created_at"], doc.get("cluster")
+
+    async def watch_instances(self, resume_after: str | None = None):
+        """
+        Streams the changes to the instances, from a change stream, as (resume token,
+        operation, instance ID, instance) tuples, the instance is None for deletions. The
+        stream is resumed after the change of the `resume_after` token when given. Change
+        streams need a replica set.
+        """
+        async with self._instances_collection.watch(
+            full_document="updateLookup",
+            resume_after={"_data": resume_after} if resume_after else None,
+        ) as stream:
+            async for change in stream:
+                instance_id = str(change["documentKey"]["_id"])
+                doc = change.get("fullDocument")
+                instance = (
+                    MongoInstance.model_validate({"id": instance_id, **doc}, strict=False)
+                    if doc
+                    else None
+                )
+                yield change["_id"]["_data"], change["operationType"], instance_id, instance
+
     async def update_instance(self, instance_id: str, update):
+        """Updates the instance. Updates reported from a cluster are ignored unless the
+        instance is in that cluster, and the status of instances being deleted doesn't change
+        until they are removed."""
         updates = update.model_dump()
         # Remove fields with None values from the update dictionary
         updates = {key: value for key, value in updates.items() if value is not None}
-        await self._instances_collection.update_one(
-            {"_id": ObjectId(instance_id)}, {"$set": updates}
+        query = self._instance_query(instance_id, updates.pop("cluster", None))
+        if "status" in updates:
+            query["status"] = {"$ne": "deleting"}
+        if "status" not in updates or self._status_recorder is None:
+            await self._instances_collection.update_one(query, {"$set": updates})
+            return
+        previous = await self._instances_collection.find_one_and_update(
+            query,
+            {"$set": updates},
+            projection={"status": True},
+            return_document=ReturnDocument.BEFORE,
+        )
+        if previous and previous.get("status") != updates["status"]:
+            # The wake up time is reported along with the instance becoming ready
+            woke_up = previous.get("status") == "waking" and updates["status"] == "ready"
+            self._record_status(
+                instance_id,
+                updates["status"],
+                wake_seconds=updates.get("last_wake_seconds") if woke_up else None,
+            )
+
+    async def mark_instance_deleting(self, instance_id: str):
+        """Sets the status of the instance to deleting and returns the instance as it was
+        before, or None if the instance doesn't exist."""
+        try:
+            doc = await self._instances_collection.find_one_and_update(
+                {"_id": ObjectId(instance_id)},
+                {"$set": {"status": "deleting"}},
+                return_document=ReturnDocument.BEFORE,
+            )
+        except Exception as e:
+            logger.error(f"Error marking instance {instance_id} as deleting: {e}")
+            return None
+        if not doc:
+            return None
+        if doc.get("status") != "deleting":
+            self._record_status(instance_id, "deleting")
+        return MongoInstance.model_validate({"id": str(doc["_id"]), **doc}, strict=False)
+
+    async def unmark_instance_deleting(self, instance_id: str, status: str | None):
+        """Restores the status the instance had before it was marked as deleting."""
+        result = await self._instances_collection.update_one(
+            {"_id": ObjectId(instance_id), "status": "deleting"},
+            {"$set": {"status": status}},
+        )
+        if result.modified_count and status is not None:
+            self._record_status(instance_id, status)
+
+    async def delete_instance(self, instance_id: str, cluster: str | None = None):
+        """Deletes the instance, returning whether it existed."""
+        result = await self._instances_collection.delete_one(
+            self._instance_query(instance_id, cluster)
         )
+        if result.deleted_count:
+            self._record_status(instance_id, "deleted")
+        return bool(result.deleted_count)
+
+    @staticmethod
+    def _instance_query(instance_id, cluster=None):
+        query = {"_id": ObjectId(instance_id)}
+        if cluster is not None:
+            # Instances without cluster were created before there was more than one
+            query["cluster"] = {"$in": [cluster, None]}
+        return query
+
+
+class StatusHistoryRepository:
+    """
+    Stores the status transitions of the instances in a time-series collection, with the
+    instance ID as metadata. Aggregates are computed by the server.
+    """
+
+    def __init__(self, history_collection):
+        self._history_collection = history_collection
+
+    async def insert_transitions(self, transitions: list[dict]):
+        await self._history_collection.insert_many(transitions, ordered=False)
+
+    async def get_instance_history(
+        self, instance_id: str, since, until, bucket_seconds=None, limit=1000
+    ):
+        """
+        Returns the status transitions of the instance between `since` and `until`. When
+        `bucket_seconds` is given the transitions are downsampled to one point per bucket with
+        the last status and the number of transitions in the bucket.
+        """
+        pipeline = [
+            {
+                "$match": {
+                    "instance_id": instance_id,
+                    "timestamp": {"$gte": since, "$lt": until},
+                }
+            },
+            {"$sort": {"timestamp": 1}},
+        ]
+        if bucket_seconds:
+            bucket_start = {
+                "$subtract": [
+                    "$timestamp",
+                    {
+                        "$mod": [
+                            {"$subtract": ["$timestamp", _EPOCH]},
+                            bucket_seconds * 1000,
+                        ]
+                    },
+                ]
+            }
+            pipeline += [
+                {
+                    "$group": {
+                        "_id": bucket_start,
+                        "status": {"$last": "$status"},
+                        "transitions": {"$sum": 1},
+                    }
+                },
+                {"$sort": {"_id": 1}},
+                {
+                    "$project": {
+                        "_id": 0,
+                        "timestamp": "$_id",
+                        "status": 1,
+                        "transitions": 1,
+                    }
+                },
+            ]
+        else:
+            pipeline.append(
+                {
+                    "$project": {
+                        "_id": 0,
+                        "timestamp": 1,
+                        "status": 1,
+                        "transitions": {"$literal": 1},
+                    }
+                }
+            )
+        pipeline.append({"$limit": limit})
+        return [doc async for doc in self._history_collection.aggregate(pipeline)]
+
+    async def get_time_to_ready(self, since, until, percentiles=(0.5, 0.9, 0.99)):
+        """
+        Returns the number of instances provisioned between `since` and `until` that became
+        ready and the percentiles of the seconds they took, by nearest rank.
+        """
+        pipeline = [
+            {
+                "$match": {
+                    "status": {"$in": ["provisioning", "ready"]},
+                    "timestamp": {"$gte": since, "$lt": until},
+                }
+            },
+            {
+                "$group": {
+                    "_id": "$instance_id",
+                    "provisioning_at": {
+                        "$min": {
+                            "$cond": [
+                                {"$eq": ["$status", "provisioning"]},
+                                "$timestamp",
+                                None,
+                            ]
+                        }
+                    },
+                    "ready_at": {
+                        "$min": {
+                            "$cond": [
+                                {"$eq": ["$status", "ready"]},
+                                "$timestamp",
+                                None,
+                            ]
+                        }
+                    },
+                }
+            },
+            {"$match": {"provisioning_at": {"$ne": None}, "ready_at": {"$ne": None}}},
+            {
+                "$project": {
+                    "seconds": {
+                        "$divide": [
+                            {"$subtract": ["$ready_at", "$provisioning_at"]},
+                            1000,
+                        ]
+                    }
+                }
+            },
+            {"$match": {"seconds": {"$gte": 0}}},
+            {"$sort": {"seconds": 1}},
+            {"$group": {"_id": None, "seconds": {"$push": "$seconds"}}},
+            {
+                "$project": {
+                    "_id": 0,
+                    "count": {"$size": "$seconds"},
+                    **{
+                        f"p{round(p * 100)}": {
+                            "$arrayElemAt": [
+                                "$seconds",
+                                {
+                                    "$toInt": {
+                                        "$floor": {
+                                            "$multiply": [
+                                                p,
+                                                {
+                                                    "$subtract": [
+                                                        {"$size": "$seconds"},
+                                                        1,
+                                                    ]
+                                                },
+                                            ]
+                                        }
+                                    }
+                                },
+                            ]
+                        }
+                        for p in percentiles
+                    },
+                }
+            },
+        ]
+        async for doc in self._history_collection.aggregate(pipeline):
+            return doc
+        return {"count": 0}
+
+    async def get_wake_time_histogram(self, since, until, buckets=WAKE_TIME_BUCKETS):
+        """
+        Returns the number of instances woken up between `since` and `until` and the histogram
+        of the seconds they took, as the number of wake ups at most `le` seconds long for each
+        bucket, the last one without bound.
+        """
+        boundaries = [0, *buckets]
+        pipeline = [
+            {
+                "$match": {
+                    "wake_seconds": {"$exists": True},
+                    "timestamp": {"$gte": since, "$lt": until},
+                }
+            },
+            {
+                "$bucket": {
+                    "groupBy": "$wake_seconds",
+                    "boundaries": boundaries,
+                    "default": "inf",
+                    "output": {"count": {"$sum": 1}},
+                }
+            },
+        ]
+        counts = {
+            doc["_id"]: doc["count"]
+            async for doc in self._history_collection.aggregate(pipeline)
+        }
+        histogram = [
+            {"le": upper, "count": counts.get(lower, 0)}
+            for lower, upper in zip(boundaries, buckets)
+        ]
+        histogram.append({"le": None, "count": counts.get("inf", 0)})
+        return {
+            "count": sum(bucket["count"] for bucket in histogram),
+            "buckets": histogram,
+        }
+
+    async def get_daily_availability(self, since, until):
+        """
+        Returns, for each day between `since` and `until`, the seconds the instances spent
+        ready and the seconds they should have been available. Each status lasts until the
+        next transition of the instance, split across the days it spans, and instances start
+        with their last status before `since`. That status is read from the (instance ID,
+        timestamp) index, one entry per instance, instead of scanning the older transitions.
+        """
+        pipeline = [
+            {"$match": {"timestamp": {"$lt": since}}},
+            {"$sort": {"instance_id": 1, "timestamp": -1}},
+            {
+                "$group": {
+                    "_id": "$instance_id",
+                    "timestamp": {"$first": "$timestamp"},
+                    "status": {"$first": "$status"},
+                }
+            },
+            {"$project": {"_id": 0, "instance_id": "$_id", "timestamp": 1, "status": 1}},
+            {
+                "$unionWith": {
+                    "coll": self._history_collection.name,
+                    "pipeline": [
+                        {"$match": {"timestamp": {"$gte": since, "$lt": until}}},
+                        {
+                            "$project": {
+                                "_id": 0,
+                                "instance_id": 1,
+                                "timestamp": 1,
+                                "status": 1,
+                            }
+                        },
+                    ],
+                }
+            },
+            {
+                "$setWindowFields": {
+                    "partitionBy": "$instance_id",
+                    "sortBy": {"timestamp": 1},
+                    "output": {
+                        "end": {
+                            "$shift": {"output": "$timestamp", "by": 1, "default": until}
+                        }
+                    },
+                }
+            },
+            {"$match": {"status": {"$nin": AVAILABILITY_EXCLUDED_STATUSES}}},
+            # The status before `since` is only counted from `since`
+            {"$set": {"start": {"$max": ["$timestamp", since]}}},
+            {"$set": {"day": {"$dateTrunc": {"date": "$start", "unit": "day"}}}},
+            {
+                "$set": {
+                    "offset": {
+                        "$range": [
+                            0,
+                            {
+                                "$toInt": {
+                                    "$ceil": {
+                                        "$divide": [
+                                            {"$subtract": ["$end", "$day"]},
+                                            _DAY_MS,
+                                        ]
+                                    }
+                                }
+                            },
+                        ]
+                    }
+                }
+            },
+            {"$unwind": "$offset"},
+            {"$set": {"day": {"$add": ["$day", {"$multiply": ["$offset", _DAY_MS]}]}}},
+            {
+                "$set": {
+                    "seconds": {
+                        "$divide": [
+                            {
+                                "$subtract": [
+                                    {"$min": ["$end", {"$add": ["$day", _DAY_MS]}]},
+                                    {"$max": ["$start", "$day"]},
+                                ]
+                            },
+                            1000,
+                        ]
+                    }
+                }
+            },
+            {
+                "$group": {
+                    "_id": "$day",
+                    "total_seconds": {"$sum": "$seconds"},
+                    "ready_seconds": {
+                        "$sum": {
+                            "$cond": [{"$eq": ["$status", "ready"]}, "$seconds", 0]
+                        }
+                    },
+                }
+            },
+            {"$sort": {"_id": 1}},
+            {
+                "$project": {
+                    "_id": 0,
+                    "day": "$_id",
+                    "total_seconds": 1,
+                    "ready_seconds": 1,
+                }
+            },
+        ]
+        return [
+            {**doc, "day": _as_utc(doc["day"])}
+            async for doc in self._history_collection.aggregate(pipeline)
+        ]
+
 
-    async def delete_instance(self, instance_id: str):
-        await self._instances_collection.delete_one({"_id": ObjectId(instance_id)})
+def _as_utc(timestamp):
+    """The driver returns naive datetimes in UTC."""
+    if timestamp.tzinfo is None:
+        return timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.astimezone(timezone.utc)
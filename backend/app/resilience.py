@@ -0,0 +1,84 @@
+"""
+Client-side protections for the calls made to the Kubernetes API server.
+Provides a token bucket to limit the rate of calls and a circuit breaker to fail fast while the
+API server is unhealthy.
+"""
+
+import asyncio
+import time
+
+
+class CircuitOpenError(Exception):
+    """Raised when a call is rejected because the circuit breaker is open."""
+
+
+class TokenBucket:
+    """
+    Allows up to `qps` calls per second on average, with bursts of up to `burst` calls. Calls
+    exceeding the rate wait for a token instead of failing.
+    """
+
+    def __init__(self, qps: float, burst: int):
+        self._qps = qps
+        self._burst = burst
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self._burst, self._tokens + (now - self._updated_at) * self._qps
+            )
+            self._updated_at = now
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self._qps)
+                self._updated_at = time.monotonic()
+                self._tokens = 1
+            self._tokens -= 1
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures, rejecting calls for `reset_timeout`
+    seconds. After that a single trial call is let through: the circuit closes if it succeeds
+    and opens again if it fails.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_progress = False
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def before_call(self):
+        if self._opened_at is None:
+            return
+        if (
+            self._trial_in_progress
+            or time.monotonic() - self._opened_at < self._reset_timeout
+        ):
+            raise CircuitOpenError("Kubernetes API server is unavailable")
+        self._trial_in_progress = True
+
+    def record_success(self):
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_progress = False
+
+    def record_aborted(self):
+        """Records a call that ended without telling whether the API server is healthy, like a
+        cancelled one, so another trial call can be made."""
+        self._trial_in_progress = False
+
+    def record_failure(self):
+        self._failures += 1
+        self._trial_in_progress = False
+        if self._opened_at is not None or self._failures >= self._failure_threshold:
+            self._opened_at = time.monotonic()
@@ -4,49 +4,271 @@ Defines API endpoints for CRUD operations on MongoDB instances.
 All routes are protected with API key authentication.
 """
 
-from fastapi import APIRouter, Depends, HTTPException
+import asyncio
+import json
+from datetime import datetime
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
 from . import auth, serialization
+from .events import EventsUnavailableError
+
+# Seconds between keepalive comments sent on idle event streams
+KEEPALIVE_INTERVAL = 15
 
 
 class Routes:
-    def __init__(self, instances_service):
-        self._instances_service = instances_service
+    """
+    API endpoints. The router is built when the application is created, so the routes and their
+    models are ready before it starts, and the services are set once they are connected.
+    """
+
+    def __init__(self, instances_service=None, events_broadcaster=None):
+        self.set_services(instances_service, events_broadcaster)
         router = APIRouter(dependencies=[Depends(auth.get_api_key)])
         router.post(
             "/instances",
             response_model=serialization.MongoInstanceCreateOut,
             status_code=201,
         )(self.create_instance)
+        router.post(
+            "/instances/{instance_id}/snapshots",
+            response_model=serialization.MongoSnapshotOut,
+            status_code=202,
+        )(self.create_snapshot)
+        router.get(
+            "/snapshots/{snapshot_id}", response_model=serialization.MongoSnapshotOut
+        )(self.get_snapshot)
+        router.delete(
+            "/snapshots/{snapshot_id}", response_model=serialization.MongoSnapshotOut
+        )(self.delete_snapshot)
+        router.post(
+            "/instances/{instance_id}:wake",
+            response_model=serialization.MongoInstanceOut,
+        )(self.wake_instance)
         router.get("/instances", response_model=list[serialization.MongoInstanceOut])(
             self.list_instances
         )
+        # Registered before /instances/{instance_id} so "events" isn't taken as an ID
+        router.get("/instances/events", response_class=StreamingResponse)(
+            self.stream_events
+        )
+        router.get("/instances/{instance_id}/events", response_class=StreamingResponse)(
+            self.stream_instance_events
+        )
+        router.get(
+            "/instances/{instance_id}/history",
+            response_model=list[serialization.StatusHistoryPointOut],
+        )(self.get_instance_history)
         router.get(
             "/instances/{instance_id}", response_model=serialization.MongoInstanceOut
         )(self.get_instance)
-        router.put("/instances/{instance_id}")(self.update_instance)
-        router.delete("/instances/{instance_id}", status_code=204)(self.delete_instance)
+        router.get("/stats/time-to-ready", response_model=serialization.TimeToReadyOut)(
+            self.get_time_to_ready
+        )
+        router.get(
+            "/stats/wake-time", response_model=serialization.WakeTimeHistogramOut
+        )(self.get_wake_time_histogram)
+        router.get(
+            "/stats/availability",
+            response_model=list[serialization.DailyAvailabilityOut],
+        )(self.get_daily_availability)
+        router.put(
+            "/instances/{instance_id}", response_model=serialization.MongoInstanceOut
+        )(self.update_instance)
+        router.post(
+            "/instances/{instance_id}:deprovisioned",
+            response_model=serialization.MongoInstanceOut,
+        )(self.remove_deprovisioned_instance)
+        router.delete(
+            "/instances/{instance_id}",
+            response_model=serialization.MongoInstanceOut,
+            status_code=202,
+        )(self.delete_instance)
         self.router = router
 
+    def set_services(self, instances_service, events_broadcaster):
+        self._instances_service = instances_service
+        self._events_broadcaster = events_broadcaster
+
     async def create_instance(self, data: serialization.MongoInstanceCreate):
         """Creates and provisions a new MongoDB instance with a random root password."""
-        return await self._instances_service.create_instance(data.name)
+        try:
+            instance = await self._instances_service.create_instance(
+                data.name, data.members, data.from_snapshot, data.version
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if not instance:
+            raise HTTPException(status_code=404, detail="Snapshot not found")
+        return instance
+
+    async def create_snapshot(self, instance_id: str):
+        """Takes a snapshot of the instance. The snapshot is completed asynchronously."""
+        try:
+            snapshot = await self._instances_service.create_snapshot(instance_id)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if not snapshot:
+            raise HTTPException(status_code=404, detail="Instance not found")
+        return snapshot
+
+    async def get_snapshot(self, snapshot_id: str):
+        """Returns the snapshot, its status is Ready once it can be cloned."""
+        snapshot = await self._instances_service.get_snapshot(snapshot_id)
+        if not snapshot:
+            raise HTTPException(status_code=404, detail="Snapshot not found")
+        return snapshot
+
+    async def delete_snapshot(self, snapshot_id: str):
+        """Deletes the snapshot, it isn't deleted with its instance."""
+        snapshot = await self._instances_service.delete_snapshot(snapshot_id)
+        if not snapshot:
+            raise HTTPException(status_code=404, detail="Snapshot not found")
+        return snapshot
+
+    async def wake_instance(
+        self,
+        instance_id: str,
+        response: Response,
+        timeout: float = Query(default=120, ge=0, le=600),
+    ):
+        """Wakes up a hibernated instance, waiting until it is ready or the timeout expires.
+        Returns 202 if the instance is still waking up."""
+        try:
+            instance = await self._instances_service.wake_instance(instance_id, timeout)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if not instance:
+            raise HTTPException(status_code=404, detail="Instance not found")
+        if instance.status != "ready":
+            response.status_code = 202
+        return instance
 
     async def list_instances(self):
         return [r async for r in await self._instances_service.get_all_instances()]
 
+    async def stream_events(self, last_event_id: str | None = Header(default=None)):
+        """Streams the status changes of all the instances as Server-Sent Events."""
+        return self._event_stream(None, last_event_id)
+
+    async def stream_instance_events(
+        self, instance_id: str, last_event_id: str | None = Header(default=None)
+    ):
+        """Streams the status changes of the instance as Server-Sent Events."""
+        if await self._instances_service.get_instance(instance_id) is None:
+            raise HTTPException(status_code=404, detail="Instance not found")
+        return self._event_stream(instance_id, last_event_id)
+
+    def _event_stream(self, instance_id, last_event_id):
+        """Returns the stream of events, ended with an `error` event if they can't be read."""
+        reason = self._events_broadcaster.unavailable_reason
+        if reason is not None:
+            raise HTTPException(status_code=503, detail=reason)
+
+        async def events():
+            async with self._events_broadcaster.subscribe(
+                instance_id, last_event_id
+            ) as subscription:
+                while True:
+                    try:
+                        event = await asyncio.wait_for(
+                            anext(subscription), KEEPALIVE_INTERVAL
+                        )
+                    except asyncio.TimeoutError:
+                        yield ": keepalive\n\n"
+                        continue
+                    except StopAsyncIteration:
+                        return
+                    except EventsUnavailableError as e:
+                        yield f"event: error\ndata: {json.dumps({'detail': str(e)})}\n\n"
+                        return
+                    yield format_event(event)
+
+        return StreamingResponse(
+            events(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
     async def get_instance(self, instance_id: str):
         instance = await self._instances_service.get_instance(instance_id)
         if not instance:
             raise HTTPException(status_code=404, detail="Instance not found")
         return instance
 
+    async def get_instance_history(
+        self,
+        instance_id: str,
+        since: datetime | None = None,
+        until: datetime | None = None,
+        bucket: int | None = Query(default=None, ge=1),
+    ):
+        """Returns the status transitions of the instance, downsampled to one point every
+        `bucket` seconds if given. The history outlives the instance."""
+        return await self._instances_service.get_instance_history(
+            instance_id, since, until, bucket
+        )
+
+    async def get_time_to_ready(
+        self, since: datetime | None = None, until: datetime | None = None
+    ):
+        """Returns the percentiles of the seconds taken by new instances to become ready."""
+        return await self._instances_service.get_time_to_ready(since, until)
+
+    async def get_wake_time_histogram(
+        self, since: datetime | None = None, until: datetime | None = None
+    ):
+        """Returns the histogram of the seconds taken by hibernated instances to wake up."""
+        return await self._instances_service.get_wake_time_histogram(since, until)
+
+    async def get_daily_availability(
+        self, since: datetime | None = None, until: datetime | None = None
+    ):
+        """Returns the fraction of time the instances were ready per day, not counting the
+        time they were provisioning, hibernated or being deleted."""
+        return await self._instances_service.get_daily_availability(since, until)
+
     async def update_instance(
         self, instance_id: str, update: serialization.MongoInstanceUpdate
     ):
-        return await self._instances_service.update_instance(instance_id, update)
+        if update.status in ("deleting", "deleted"):
+            raise HTTPException(
+                status_code=400, detail="Instances are deleted with DELETE"
+            )
+        try:
+            instance = await self._instances_service.update_instance(instance_id, update)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if not instance:
+            raise HTTPException(status_code=404, detail="Instance not found")
+        return instance
+
+    async def remove_deprovisioned_instance(
+        self, instance_id: str, cluster: str | None = None
+    ):
+        """Removes the instance once its resources are gone from the cluster, called by the
+        monitor."""
+        instance = await self._instances_service.remove_deprovisioned_instance(
+            instance_id, cluster
+        )
+        if not instance:
+            raise HTTPException(status_code=404, detail="Instance not found")
+        return instance
 
     async def delete_instance(self, instance_id: str):
-        instance = await self._instances_service.get_instance(instance_id)
+        """Starts the deletion of the instance, which completes asynchronously."""
+        instance = await self._instances_service.delete_instance(instance_id)
         if not instance:
             raise HTTPException(status_code=404, detail="Instance not found")
-        await self._instances_service.delete_instance(instance_id)
+        return instance
+
+
+def format_event(event):
+    """Formats an instance event as a Server-Sent Event."""
+    if event.instance is None:
+        data = json.dumps({"id": event.instance_id})
+    else:
+        data = serialization.MongoInstanceOut.model_validate(
+            event.instance.model_dump()
+        ).model_dump_json(by_alias=True)
+    return f"id: {event.id}\nevent: {event.operation}\ndata: {data}\n\n"
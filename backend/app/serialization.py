@@ -3,29 +3,117 @@ Models module for Mongo as a Service.
 Defines Pydantic models for request validation and response serialization.
 """
 
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, Field, computed_field, model_validator
 from datetime import datetime
+from .model import DEFAULT_VERSION, STORAGE_SIZE_PATTERN, VERSION_PATTERN
 
 
 class MongoInstanceCreate(BaseModel):
+    model_config = ConfigDict(populate_by_name=True)
+
     name: str
+    members: int = Field(default=1, ge=1, le=7)
+    # Clones run the version of their snapshot
+    version: str = Field(default=DEFAULT_VERSION, pattern=VERSION_PATTERN)
+    from_snapshot: str | None = Field(default=None, alias="fromSnapshot")
+
+    @model_validator(mode="after")
+    def check_clone_members(self):
+        if self.from_snapshot and self.members > 1:
+            raise ValueError("Instances cloned from a snapshot must be standalone")
+        return self
 
 
 class MongoInstanceUpdate(BaseModel):
+    model_config = ConfigDict(populate_by_name=True)
+
     name: str | None = None
     status: str | None = None
     host: str | None = None
     port: int | None = None
+    tls: bool | None = None
+    replica_set: str | None = Field(default=None, alias="replicaSet")
+    last_wake_seconds: float | None = None
+    version: str | None = None
+    storage_size: str | None = Field(
+        default=None, alias="storageSize", pattern=STORAGE_SIZE_PATTERN
+    )
+    running_version: str | None = Field(default=None, alias="runningVersion")
+    storage_expandable: bool | None = Field(default=None, alias="storageExpandable")
+    # Cluster reporting the update, updates from other clusters than the instance's are ignored.
+    # Reported updates are stored as they are, the rest are requests to change the instance.
+    cluster: str | None = None
 
 
 class MongoInstanceOut(BaseModel):
+    model_config = ConfigDict(populate_by_name=True)
+
     id: str
     name: str
     created_at: datetime
     status: str | None
     host: str | None
     port: int | None
+    tls: bool = False
+    version: str | None = None
+    running_version: str | None = Field(default=None, alias="runningVersion")
+    storage_size: str | None = Field(default=None, alias="storageSize")
+    storage_expandable: bool | None = Field(default=None, alias="storageExpandable")
+    members: int = 1
+    connection_string: str | None = None
+    last_wake_seconds: float | None = None
+    cluster: str | None = None
 
 
 class MongoInstanceCreateOut(MongoInstanceOut):
     password: str | None = None
+
+
+class MongoSnapshotOut(BaseModel):
+    model_config = ConfigDict(populate_by_name=True)
+
+    id: str
+    instance_id: str
+    created_at: datetime
+    status: str | None = None
+    storage_size: str | None = Field(default=None, alias="storageSize")
+    version: str | None = None
+    cluster: str | None = None
+
+
+class StatusHistoryPointOut(BaseModel):
+    timestamp: datetime
+    status: str
+    # Number of transitions downsampled into this point
+    transitions: int = 1
+
+
+class TimeToReadyOut(BaseModel):
+    count: int
+    p50: float | None = None
+    p90: float | None = None
+    p99: float | None = None
+
+
+class WakeTimeBucketOut(BaseModel):
+    # Upper bound of the bucket in seconds, None for the last one
+    le: float | None
+    count: int
+
+
+class WakeTimeHistogramOut(BaseModel):
+    count: int
+    buckets: list[WakeTimeBucketOut]
+
+
+class DailyAvailabilityOut(BaseModel):
+    day: datetime
+    ready_seconds: float
+    total_seconds: float
+
+    @computed_field
+    @property
+    def availability(self) -> float | None:
+        if not self.total_seconds:
+            return None
+        return self.ready_seconds / self.total_seconds
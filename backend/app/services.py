@@ -2,19 +2,39 @@
 Business logic for managing instances.
 """
 
-from datetime import datetime, timezone
-from .model import MongoInstance
-from .serialization import MongoInstanceCreateOut
+import asyncio
+from bson.objectid import ObjectId
+from datetime import datetime, timedelta, timezone
+from .model import (
+    DEFAULT_VERSION,
+    MongoInstance,
+    check_version_upgrade,
+    parse_storage_size,
+)
+from .serialization import MongoInstanceCreateOut, MongoInstanceUpdate, MongoSnapshotOut
+
+# Seconds between checks of the status of an instance being woken up
+WAKE_POLL_INTERVAL = 0.5
 
 
 class InstancesService:
-    def __init__(self, instances_repository, provisioner):
+    def __init__(self, instances_repository, provisioner, status_history_repository):
         self._instances_repository = instances_repository
         self._provisioner = provisioner
+        self._status_history_repository = status_history_repository
 
-    async def create_instance(self, name: str):
+    async def create_instance(
+        self,
+        name: str,
+        members: int = 1,
+        from_snapshot: str | None = None,
+        version: str = DEFAULT_VERSION,
+    ):
         """
-        Creates and provisions a new MongoDB instance.
+        Creates and provisions a new MongoDB instance in the cluster selected by the provisioner.
+        Instances cloned from a snapshot go to the cluster of the snapshot and keep the storage
+        size, version and users of the source instance, so no new root password is generated
+        for them. Returns None if the snapshot doesn't exist.
         """
         instance = MongoInstance(
             id=None,
@@ -23,10 +43,24 @@ class InstancesService:
             status="provisioning",
             host=None,
             port=None,
+            members=members,
+            version=version,
+            from_snapshot=from_snapshot,
         )
+        if from_snapshot:
+            snapshot = await self._provisioner.get_snapshot(from_snapshot)
+            if snapshot is None:
+                return None
+            if snapshot.status != "Ready":
+                raise ValueError(f"Snapshot {from_snapshot} is not ready")
+            instance.cluster = snapshot.cluster
+            instance.storage_size = snapshot.storage_size or instance.storage_size
+            instance.version = snapshot.version or instance.version
+        else:
+            instance.cluster = await self._provisioner.select_cluster()
         await self._instances_repository.create_instance(instance)
         # Generate a random root password
-        root_password = MongoInstance.generate_password()
+        root_password = None if from_snapshot else MongoInstance.generate_password()
         await self._provisioner.provision_instance(instance, root_password)
         return MongoInstanceCreateOut(
             id=instance.id,
@@ -35,9 +69,75 @@ class InstancesService:
             status=instance.status,
             host=instance.host,
             port=instance.port,
+            version=instance.version,
+            storage_size=instance.storage_size,
+            members=instance.members,
+            connection_string=instance.connection_string,
+            cluster=instance.cluster,
             password=root_password,
         )
 
+    async def create_snapshot(self, instance_id: str):
+        """
+        Takes a snapshot of the instance that can be used to create clones of it. Returns None
+        if the instance doesn't exist.
+        """
+        instance = await self._instances_repository.get_instance(instance_id)
+        if instance is None:
+            return None
+        if instance.status == "hibernated":
+            raise ValueError(
+                f"Instance {instance_id} is hibernated, wake it up before taking a snapshot"
+            )
+        snapshot_id = str(ObjectId())
+        await self._provisioner.snapshot_instance(instance, snapshot_id)
+        return MongoSnapshotOut(
+            id=snapshot_id,
+            instance_id=instance_id,
+            created_at=datetime.now(tz=timezone.utc),
+            cluster=instance.cluster,
+        )
+
+    async def get_snapshot(self, snapshot_id: str):
+        """Returns the snapshot, or None if it doesn't exist."""
+        return await self._provisioner.get_snapshot(snapshot_id)
+
+    async def delete_snapshot(self, snapshot_id: str):
+        """
+        Deletes the snapshot, clones already created from it are kept. Returns None if it
+        doesn't exist.
+        """
+        snapshot = await self._provisioner.get_snapshot(snapshot_id)
+        if snapshot is None:
+            return None
+        await self._provisioner.delete_snapshot(snapshot)
+        return snapshot
+
+    async def wake_instance(self, instance_id: str, timeout: float):
+        """
+        Wakes up a hibernated instance and waits up to `timeout` seconds until it is ready.
+        Returns None if the instance doesn't exist or is deleted while waking up.
+        """
+        instance = await self._instances_repository.get_instance(instance_id)
+        if instance is None:
+            return None
+        if instance.status == "ready":
+            return instance
+        if instance.status == "hibernated":
+            await self._provisioner.wake_instance(instance)
+            await self._instances_repository.update_instance(
+                instance_id, MongoInstanceUpdate(status="waking")
+            )
+        elif instance.status != "waking":
+            raise ValueError(f"Instance is {instance.status}, not hibernated")
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            instance = await self._instances_repository.get_instance(instance_id)
+            if instance is None or instance.status == "ready" or loop.time() >= deadline:
+                return instance
+            await asyncio.sleep(WAKE_POLL_INTERVAL)
+
     async def get_instance(self, instance_id: str):
         instance = await self._instances_repository.get_instance(instance_id)
         return instance
@@ -45,12 +145,127 @@ class InstancesService:
     async def get_all_instances(self):
         return await self._instances_repository.get_all_instances()
 
+    async def get_instance_history(
+        self,
+        instance_id: str,
+        since: datetime | None = None,
+        until: datetime | None = None,
+        bucket_seconds: int | None = None,
+    ):
+        """Returns the status transitions of the instance, by default in the last 7 days."""
+        until = until or datetime.now(tz=timezone.utc)
+        since = since or until - timedelta(days=7)
+        return await self._status_history_repository.get_instance_history(
+            instance_id, since, until, bucket_seconds
+        )
+
+    async def get_time_to_ready(
+        self, since: datetime | None = None, until: datetime | None = None
+    ):
+        """Returns the percentiles of the time to ready, by default in the last 30 days."""
+        until = until or datetime.now(tz=timezone.utc)
+        since = since or until - timedelta(days=30)
+        return await self._status_history_repository.get_time_to_ready(since, until)
+
+    async def get_wake_time_histogram(
+        self, since: datetime | None = None, until: datetime | None = None
+    ):
+        """Returns the histogram of the wake up time, by default in the last 30 days."""
+        until = until or datetime.now(tz=timezone.utc)
+        since = since or until - timedelta(days=30)
+        return await self._status_history_repository.get_wake_time_histogram(
+            since, until
+        )
+
+    async def get_daily_availability(
+        self, since: datetime | None = None, until: datetime | None = None
+    ):
+        """Returns the availability of the fleet per day, by default in the last 30 days."""
+        until = until or datetime.now(tz=timezone.utc)
+        since = since or until - timedelta(days=30)
+        return await self._status_history_repository.get_daily_availability(
+            since, until
+        )
+
+    def watch_instances(self, resume_after=None):
+        """
+        Streams the changes to the instances as (resume token, operation, instance ID,
+        instance) tuples, after the change of the `resume_after` token when given.
+        """
+        return self._instances_repository.watch_instances(resume_after)
+
     async def update_instance(self, instance_id: str, update):
+        """
+        Updates the instance and returns it, or None if it doesn't exist. Updates reported by a
+        cluster are stored as they are. Changes to the version or storage size requested by
+        clients are applied to the running instance in place: the instance is marked as
+        updating until a new version is rolled out, and the new storage size is only stored
+        once the cluster reports it, as the expansion can still fail there.
+        """
+        if update.cluster is None and (
+            update.version is not None or update.storage_size is not None
+        ):
+            instance = await self._instances_repository.get_instance(instance_id)
+            if instance is None:
+                return None
+            if update.version == instance.version:
+                update.version = None
+            if update.storage_size is not None:
+                if parse_storage_size(update.storage_size) < parse_storage_size(
+                    instance.storage_size
+                ):
+                    raise ValueError("Storage size can't be reduced")
+                if instance.storage_expandable is False:
+                    raise ValueError("Storage of the instance can't be expanded")
+            if update.version is not None:
+                if instance.running_version is None:
+                    raise ValueError(
+                        "Version running isn't known yet, retry once the instance is ready"
+                    )
+                check_version_upgrade(instance.running_version, update.version)
+            await self._provisioner.update_instance(
+                instance, version=update.version, storage_size=update.storage_size
+            )
+            if update.version is not None:
+                update.status = "updating"
+            update.storage_size = None
         await self._instances_repository.update_instance(instance_id, update)
+        return await self._instances_repository.get_instance(instance_id)
 
     async def delete_instance(self, instance_id: str):
-        instance = await self._instances_repository.get_instance(instance_id)
+        """
+        Starts the deletion of the instance, marking it as deleting. Kubernetes deletes the
+        instance resources in the background and the instance is removed once the monitor
+        reports them as deprovisioned. The previous status is restored if the deletion can't
+        be started, so it can be retried. Returns None if the instance doesn't exist.
+        """
+        instance = await self._instances_repository.mark_instance_deleting(instance_id)
         if instance is None:
-            raise ValueError(f"Instance with ID {instance_id} not found")
-        await self._provisioner.deprovision_instance(instance)
-        await self._instances_repository.delete_instance(instance_id)
+            return None
+        try:
+            deprovisioned = await self._provisioner.deprovision_instance(instance)
+        except Exception:
+            await self._instances_repository.unmark_instance_deleting(
+                instance_id, instance.status
+            )
+            raise
+        if not deprovisioned:
+            # Nothing to wait for, the instance was never provisioned
+            await self._instances_repository.delete_instance(instance_id)
+        instance.status = "deleting"
+        return instance
+
+    async def remove_deprovisioned_instance(
+        self, instance_id: str, cluster: str | None = None
+    ):
+        """
+        Removes the instance once the monitor reports its resources are gone from `cluster`,
+        ignoring the reports from other clusters than the instance's. Returns the instance
+        removed, or None if it doesn't exist.
+        """
+        instance = await self._instances_repository.get_instance(instance_id)
+        if instance is None or not await self._instances_repository.delete_instance(
+            instance_id, cluster
+        ):
+            return None
+        return instance
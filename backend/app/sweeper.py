@@ -0,0 +1,189 @@
+"""
+Garbage collector for Mongo as a Service.
+Finds the drift between the instances stored in the DB and the resources in Kubernetes, left
+behind when provisioning or deprovisioning an instance fails half-way, and fixes it.
+
+Run it with `python -m app.sweeper [--dry-run] [--interval SECONDS]`.
+"""
+
+import argparse
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from .database import connect, status_history_collection, MONGO_INSTANCES_COLLECTION
+from .history import StatusHistoryRecorder
+from .provisioner import MongoInstanceResource, Provisioner
+from .repository import MongoInstancesRepository, StatusHistoryRepository
+from .serialization import MongoInstanceUpdate
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SweepReport:
+    # Kubernetes resources without instance, as (kind, name)
+    orphan_resources: list[tuple[str, str]] = field(default_factory=list)
+    # Instances without MongoInstance resource, marked as failed
+    orphan_instances: list[str] = field(default_factory=list)
+    # Instances being deleted whose MongoInstance resource is gone, removed from the DB
+    deleted_instances: list[str] = field(default_factory=list)
+    # Instances being deleted whose MongoInstance resource is still there, deleted again
+    retried_deletions: list[str] = field(default_factory=list)
+
+
+class Sweeper:
+    """
+    Joins the instances in the DB with the resources in Kubernetes by cluster and instance ID.
+    Only the clusters and instance IDs are kept in memory, resources are streamed page by page.
+
+    - MongoInstance resources of instances that are not in the DB, or in another cluster,
+      are deleted.
+    - Secrets, PersistentVolumes and PersistentVolumeClaims without a MongoInstance resource
+      are deleted, and so is the hostPath data of the PersistentVolumes.
+    - Instances in the DB without a MongoInstance resource are marked as failed, or removed
+      if they were being deleted.
+    - MongoInstance resources of instances being deleted are deleted again, in case the
+      deletion was interrupted before reaching Kubernetes.
+
+    Objects younger than `grace_period` are skipped as they may belong to an instance being
+    provisioned. Deletions are done in batches of `batch_size` waiting `batch_interval`
+    seconds between them.
+    """
+
+    def __init__(
+        self,
+        instances_repository,
+        provisioner,
+        grace_period=timedelta(minutes=10),
+        batch_size=20,
+        batch_interval=1.0,
+    ):
+        self._instances_repository = instances_repository
+        self._provisioner = provisioner
+        self._grace_period = grace_period
+        self._batch_size = batch_size
+        self._batch_interval = batch_interval
+
+    async def sweep(self, dry_run=False) -> SweepReport:
+        report = SweepReport()
+        deadline = datetime.now(tz=timezone.utc) - self._grace_period
+
+        db_instances = set()
+        candidate_instances = set()
+        deleting_instances = set()
+        async for instance_id, status, created_at, cluster in (
+            self._instances_repository.get_all_instance_states()
+        ):
+            key = (cluster or self._provisioner.default_cluster, instance_id)
+            db_instances.add(key)
+            if created_at.tzinfo is None:
+                created_at = created_at.replace(tzinfo=timezone.utc)
+            if status == "deleting":
+                deleting_instances.add(key)
+            elif status != "failed" and created_at < deadline:
+                candidate_instances.add(key)
+
+        # (cluster, instance ID) of the MongoInstance resources
+        cluster_instances = set()
+        orphans = []
+        # MongoInstance resources of each cluster are listed first, so they are known when
+        # joining the rest
+        async for resource in self._provisioner.list_managed_resources():
+            key = (resource.cluster, resource.instance_id)
+            if resource.kind is MongoInstanceResource:
+                cluster_instances.add(key)
+                owned = key in db_instances
+            else:
+                owned = key in cluster_instances
+            if not owned and resource.created_at < deadline:
+                orphans.append(resource)
+                report.orphan_resources.append((resource.kind.kind, resource.name))
+                if len(orphans) == self._batch_size:
+                    await self._delete_batch(orphans, dry_run)
+                    orphans = []
+        await self._delete_batch(orphans, dry_run)
+
+        report.orphan_instances = sorted(
+            instance_id for _, instance_id in candidate_instances - cluster_instances
+        )
+        for instance_id in report.orphan_instances:
+            logger.info(f"Instance {instance_id} has no MongoInstance resource")
+            if not dry_run:
+                await self._instances_repository.update_instance(
+                    instance_id, MongoInstanceUpdate(status="failed")
+                )
+        report.deleted_instances = sorted(
+            instance_id for _, instance_id in deleting_instances - cluster_instances
+        )
+        for instance_id in report.deleted_instances:
+            logger.info(f"Instance {instance_id} was deleted")
+            if not dry_run:
+                await self._instances_repository.delete_instance(instance_id)
+        report.retried_deletions = sorted(
+            instance_id for _, instance_id in deleting_instances & cluster_instances
+        )
+        for instance_id in report.retried_deletions:
+            logger.info(f"Deleting instance {instance_id} again")
+            if dry_run:
+                continue
+            instance = await self._instances_repository.get_instance(instance_id)
+            if instance is None:
+                continue
+            try:
+                await self._provisioner.deprovision_instance(instance)
+            except Exception as e:
+                logger.warning(f"Error deleting instance {instance_id}: {e}")
+        return report
+
+    async def _delete_batch(self, resources, dry_run):
+        if not resources:
+            return
+        for resource in resources:
+            logger.info(f"Orphan {resource.kind.kind} {resource.name}")
+            if dry_run:
+                continue
+            try:
+                await self._provisioner.delete_managed_resource(resource)
+            except Exception as e:
+                logger.warning(f"Error deleting {resource.kind.kind} {resource.name}: {e}")
+        if not dry_run:
+            await asyncio.sleep(self._batch_interval)
+
+
+async def main(dry_run, interval):
+    mongo_client, mongo_db = await connect()
+    status_recorder = StatusHistoryRecorder(
+        StatusHistoryRepository(await status_history_collection(mongo_db))
+    )
+    status_recorder.start()
+    try:
+        instances_repository = MongoInstancesRepository(
+            mongo_db.get_collection(MONGO_INSTANCES_COLLECTION), status_recorder
+        )
+        sweeper = Sweeper(instances_repository, await Provisioner.create())
+        while True:
+            report = await sweeper.sweep(dry_run=dry_run)
+            logger.info(
+                f"{len(report.orphan_resources)} orphan resources, "
+                f"{len(report.orphan_instances)} orphan instances"
+            )
+            if not interval:
+                return report
+            await asyncio.sleep(interval)
+    finally:
+        await status_recorder.stop()
+        mongo_client.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--dry-run", action="store_true", help="Report the drift without fixing it"
+    )
+    parser.add_argument(
+        "--interval", type=int, default=0, help="Sweep every INTERVAL seconds"
+    )
+    args = parser.parse_args()
+    asyncio.run(main(args.dry_run, args.interval))
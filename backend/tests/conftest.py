@@ -5,12 +5,14 @@ Pytest configuration file for test fixtures.
 import pytest
 import asyncio
 from mongomock_motor import AsyncMongoMockClient
-from datetime import datetime
+from datetime import datetime, timezone
 from httpx import ASGITransport, AsyncClient
 from asgi_lifespan import LifespanManager
 from bson import ObjectId
 
-from app.repository import MongoInstancesRepository
+from app.history import StatusHistoryRecorder
+from app.model import MongoSnapshot
+from app.repository import MongoInstancesRepository, StatusHistoryRepository
 from app.services import InstancesService
 
 
@@ -21,9 +23,21 @@ def mock_mongo_collection():
 
 
 @pytest.fixture
-def mongo_instances_repository(mock_mongo_collection):
+def status_history_repository():
+    """Returns a StatusHistoryRepository with a mock collection."""
+    return StatusHistoryRepository(AsyncMongoMockClient()["db"]["history"])
+
+
+@pytest.fixture
+def status_recorder(status_history_repository):
+    """Returns a StatusHistoryRecorder, transitions are written when flushed."""
+    return StatusHistoryRecorder(status_history_repository)
+
+
+@pytest.fixture
+def mongo_instances_repository(mock_mongo_collection, status_recorder):
     """Returns an MongoInstancesRepository instance with a mock collection."""
-    return MongoInstancesRepository(mock_mongo_collection)
+    return MongoInstancesRepository(mock_mongo_collection, status_recorder)
 
 
 @pytest.fixture
@@ -33,21 +47,65 @@ def mock_provisioner():
     class MockProvisioner:
         def __init__(self):
             self.provisioned_instances = []
+            self.updated_instances = []
+            self.snapshots = []
+            self.woken_instances = []
+
+        async def select_cluster(self):
+            return "default"
+
+        async def get_snapshot(self, snapshot_id):
+            # Snapshots are ready as soon as they are taken
+            for instance_id, taken_snapshot_id in self.snapshots:
+                if taken_snapshot_id == snapshot_id:
+                    return MongoSnapshot(
+                        id=snapshot_id,
+                        instance_id=instance_id,
+                        created_at=datetime.now(tz=timezone.utc),
+                        status="Ready",
+                        storage_size="10Gi",
+                        version="7.0",
+                        cluster="default",
+                    )
+            return None
 
         async def provision_instance(self, instance, root_password):
             self.provisioned_instances.append(instance.id)
 
+        async def snapshot_instance(self, instance, snapshot_id):
+            self.snapshots.append((instance.id, snapshot_id))
+
+        async def delete_snapshot(self, snapshot):
+            self.snapshots = [
+                (instance_id, snapshot_id)
+                for instance_id, snapshot_id in self.snapshots
+                if snapshot_id != snapshot.id
+            ]
+            return True
+
+        async def wake_instance(self, instance):
+            self.woken_instances.append(instance.id)
+
+        async def update_instance(self, instance, version=None, storage_size=None):
+            self.updated_instances.append((instance.id, version, storage_size))
+
         async def deprovision_instance(self, instance):
-            if instance_id in self.provisioned_instances:
+            if instance.id in self.provisioned_instances:
                 self.provisioned_instances.remove(instance.id)
+                return True
+            return False
 
     return MockProvisioner()
 
 
 @pytest.fixture
-def mongo_instances_service(mongo_instances_repository, mock_provisioner):
+def mongo_instances_service(
+    mongo_instances_repository, mock_provisioner, status_history_repository
+):
     """Returns an InstancesService."""
-    return InstancesService(mongo_instances_repository, mock_provisioner)
+    return InstancesService(
+        mongo_instances_repository, mock_provisioner, status_history_repository
+    )
 
 
 @pytest.fixture
@@ -4,6 +4,9 @@ Tests for API endpoints.
 
 import pytest
 
+from app.resilience import CircuitOpenError
+from app.serialization import MongoInstanceUpdate
+
 
 @pytest.mark.asyncio
 async def test_create_instance(app_client, api_key, mock_provisioner):
@@ -22,6 +25,7 @@ async def test_create_instance(app_client, api_key, mock_provisioner):
         assert data["status"] == "provisioning"
         assert mock_provisioner.provisioned_instances == [data["id"]]
         assert data["password"] is not None
+        assert data["version"] == "8.0"
 
 
 @pytest.mark.asyncio
@@ -90,9 +94,77 @@ async def test_delete_instance_route(
     async with app_client as ac:
         headers = {"X-API-Key": api_key}
         response = await ac.delete(f"/instances/{instance_id}", headers=headers)
-        assert response.status_code == 204
+        assert response.status_code == 202
+        response = await ac.get(f"/instances/{instance_id}", headers=headers)
+        assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_delete_provisioned_instance_route(app_client, api_key, mock_provisioner):
+    """Test that provisioned instances are removed once reported as deleted."""
+    async with app_client as ac:
+        headers = {"X-API-Key": api_key}
+        response = await ac.post(
+            "/instances", headers=headers, json={"name": "test-instance"}
+        )
+        instance_id = response.json()["id"]
+        response = await ac.delete(f"/instances/{instance_id}", headers=headers)
+        assert response.status_code == 202
+        assert response.json()["status"] == "deleting"
+        assert mock_provisioner.provisioned_instances == []
+        response = await ac.get(f"/instances/{instance_id}", headers=headers)
+        assert response.json()["status"] == "deleting"
+        # Only the monitor removes instances, once their resources are gone
+        response = await ac.put(
+            f"/instances/{instance_id}", headers=headers, json={"status": "deleted"}
+        )
+        assert response.status_code == 400
+        # The status reported while the resources are deleted is ignored
+        response = await ac.put(
+            f"/instances/{instance_id}", headers=headers, json={"status": "not ready"}
+        )
+        assert response.json()["status"] == "deleting"
+        response = await ac.post(
+            f"/instances/{instance_id}:deprovisioned",
+            headers=headers,
+            params={"cluster": "default"},
+        )
+        assert response.status_code == 200
         response = await ac.get(f"/instances/{instance_id}", headers=headers)
         assert response.status_code == 404
+        response = await ac.post(
+            f"/instances/{instance_id}:deprovisioned", headers=headers
+        )
+        assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_delete_instance_failure_restores_status(
+    mongo_instances_service, mock_provisioner
+):
+    """Test that the status is restored when the deletion can't be started."""
+    instance = await mongo_instances_service.create_instance("test-instance")
+    await mongo_instances_service.update_instance(
+        instance.id, MongoInstanceUpdate(status="ready")
+    )
+
+    async def deprovision_instance(instance):
+        raise ConnectionError("API server unavailable")
+
+    mock_provisioner.deprovision_instance = deprovision_instance
+    with pytest.raises(ConnectionError):
+        await mongo_instances_service.delete_instance(instance.id)
+    instance = await mongo_instances_service.get_instance(instance.id)
+    assert instance.status == "ready"
+
+
+@pytest.mark.asyncio
+async def test_delete_instance_not_found_route(app_client, api_key):
+    """Test deleting an unknown instance."""
+    async with app_client as ac:
+        headers = {"X-API-Key": api_key}
+        response = await ac.delete("/instances/111", headers=headers)
+        assert response.status_code == 404
 
 
 @pytest.mark.asyncio
@@ -105,3 +177,336 @@ async def test_invalid_api_key(app_client, api_key):
             "/instances", headers=headers, json={"name": "test-instance"}
         )
         assert response.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_update_instance_version_and_storage_route(
+    app_client, mock_instances_collection_with_data, instance_id, api_key, mock_provisioner
+):
+    """Test resizing and upgrading an instance through the update endpoint."""
+    await mock_instances_collection_with_data.update_one(
+        {}, {"$set": {"running_version": "7.0.12", "storage_expandable": True}}
+    )
+    async with app_client as ac:
+        headers = {"X-API-Key": api_key}
+        response = await ac.put(
+            f"/instances/{instance_id}",
+            headers=headers,
+            json={"version": "8.0.6", "storageSize": "10Gi"},
+        )
+        assert response.status_code == 200
+        assert response.json()["version"] == "8.0.6"
+        assert mock_provisioner.updated_instances == [(instance_id, "8.0.6", "10Gi")]
+        response = await ac.get(f"/instances/{instance_id}", headers=headers)
+        data = response.json()
+        assert data["status"] == "updating"
+        assert data["version"] == "8.0.6"
+        # Stored once the cluster reports it
+        assert data["storageSize"] == "5Gi"
+
+        response = await ac.put(
+            f"/instances/{instance_id}",
+            headers=headers,
+            json={"storageSize": "10Gi", "runningVersion": "8.0.6", "cluster": "default"},
+        )
+        assert response.status_code == 200
+        assert response.json()["storageSize"] == "10Gi"
+        assert response.json()["runningVersion"] == "8.0.6"
+        assert len(mock_provisioner.updated_instances) == 1
+
+
+@pytest.mark.asyncio
+async def test_update_instance_storage_not_expandable_route(
+    app_client, mock_instances_collection_with_data, instance_id, api_key, mock_provisioner
+):
+    """Test that the storage of instances whose storage class can't expand can't change."""
+    await mock_instances_collection_with_data.update_one(
+        {}, {"$set": {"storage_expandable": False}}
+    )
+    async with app_client as ac:
+        headers = {"X-API-Key": api_key}
+        response = await ac.put(
+            f"/instances/{instance_id}", headers=headers, json={"storageSize": "10Gi"}
+        )
+        assert response.status_code == 400
+        assert mock_provisioner.updated_instances == []
+
+
+@pytest.mark.asyncio
+async def test_update_instance_shrink_storage_route(
+    app_client, mock_instances_collection_with_data, instance_id, api_key, mock_provisioner
+):
+    """Test that the storage of an instance can't be reduced."""
+    async with app_client as ac:
+        headers = {"X-API-Key": api_key}
+        response = await ac.put(
+            f"/instances/{instance_id}", headers=headers, json={"storageSize": "1Gi"}
+        )
+        assert response.status_code == 400
+        assert mock_provisioner.updated_instances == []
+
+
+@pytest.mark.asyncio
+async def test_update_instance_version_checks_route(
+    app_client, mock_instances_collection_with_data, instance_id, api_key, mock_provisioner
+):
+    """Test that versions can't be downgraded nor skip a major release."""
+    async with app_client as ac:
+        headers = {"X-API-Key": api_key}
+        url = f"/instances/{instance_id}"
+        # The instance runs "latest", the version running isn't known yet
+        response = await ac.put(url, headers=headers, json={"version": "3.6.23"})
+        assert response.status_code == 400
+        await mock_instances_collection_with_data.update_one(
+            {}, {"$set": {"running_version": "6.0.3"}}
+        )
+        response = await ac.put(url, headers=headers, json={"version": "6.0.14"})
+        assert response.status_code == 200
+        for version in ["5.0.26", "8.0.6", "latest", "seven"]:
+            response = await ac.put(url, headers=headers, json={"version": version})
+            assert response.status_code == 400, version
+        response = await ac.put(url, headers=headers, json={"version": "7.0.12"})
+        assert response.status_code == 200
+        assert [version for _, version, _ in mock_provisioner.updated_instances] == [
+            "6.0.14",
+            "7.0.12",
+        ]
+
+
+@pytest.mark.asyncio
+async def test_update_unknown_instance_route(app_client, api_key):
+    """Test updating an unknown instance."""
+    async with app_client as ac:
+        headers = {"X-API-Key": api_key}
+        response = await ac.put(
+            "/instances/0123456789abcdef01234567", headers=headers, json={"name": "x"}
+        )
+        assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_create_replica_set_instance(app_client, api_key):
+    """Test creating a replica set and reporting its connection string."""
+    async with app_client as ac:
+        headers = {"X-API-Key": api_key}
+        response = await ac.post(
+            "/instances", headers=headers, json={"name": "test-rs", "members": 3}
+        )
+        assert response.status_code == 201
+        instance_id = response.json()["id"]
+        assert response.json()["members"] == 3
+        response = await ac.put(
+            f"/instances/{instance_id}",
+            headers=headers,
+            json={"replicaSet": "rs0", "host": "mongo.example.com", "port": 31000},
+        )
+        assert response.status_code == 200
+        response = await ac.get(f"/instances/{instance_id}", headers=headers)
+        assert response.json()["connection_string"] == (
+            "mongodb://mongo.example.com:31000/?directConnection=true"
+        )
+        response = await ac.put(
+            f"/instances/{instance_id}",
+            headers=headers,
+            json={"host": "mongo-instance-1.mongo.example.com", "port": 27017, "tls": True},
+        )
+        response = await ac.get(f"/instances/{instance_id}", headers=headers)
+        assert response.json()["connection_string"] == (
+            "mongodb://mongo-instance-1.mongo.example.com:27017/?directConnection=true&tls=true"
+        )
+
+
+@pytest.mark.asyncio
+async def test_create_snapshot_and_clone_route(
+    app_client, mock_instances_collection_with_data, instance_id, api_key, mock_provisioner
+):
+    """Test taking a snapshot of an instance and cloning it."""
+    async with app_client as ac:
+        headers = {"X-API-Key": api_key}
+        response = await ac.post(f"/instances/{instance_id}/snapshots", headers=headers)
+        assert response.status_code == 202
+        snapshot_id = response.json()["id"]
+        assert mock_provisioner.snapshots == [(instance_id, snapshot_id)]
+        response = await ac.post(
+            "/instances",
+            headers=headers,
+            json={"name": "test-clone", "fromSnapshot": snapshot_id},
+        )
+        assert response.status_code == 201
+        assert response.json()["password"] is None
+        assert response.json()["id"] in mock_provisioner.provisioned_instances
+        # The clone inherits the spec of the source instance
+        assert response.json()["storageSize"] == "10Gi"
+        assert response.json()["version"] == "7.0"
+
+
+@pytest.mark.asyncio
+async def test_get_snapshot_route(
+    app_client, mock_instances_collection_with_data, instance_id, api_key
+):
+    """Test getting the status of a snapshot."""
+    async with app_client as ac:
+        headers = {"X-API-Key": api_key}
+        response = await ac.post(f"/instances/{instance_id}/snapshots", headers=headers)
+        snapshot_id = response.json()["id"]
+        response = await ac.get(f"/snapshots/{snapshot_id}", headers=headers)
+        assert response.status_code == 200
+        assert response.json()["instance_id"] == instance_id
+        assert response.json()["status"] == "Ready"
+        response = await ac.get("/snapshots/6814f1d1a4c2f1a0b1c2d3e4", headers=headers)
+        assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_delete_snapshot_route(
+    app_client, mock_instances_collection_with_data, instance_id, api_key, mock_provisioner
+):
+    """Test that snapshots are deleted on their own, keeping their instance."""
+    async with app_client as ac:
+        headers = {"X-API-Key": api_key}
+        response = await ac.post(f"/instances/{instance_id}/snapshots", headers=headers)
+        snapshot_id = response.json()["id"]
+        response = await ac.delete(f"/snapshots/{snapshot_id}", headers=headers)
+        assert response.status_code == 200
+        assert response.json()["id"] == snapshot_id
+        assert mock_provisioner.snapshots == []
+        response = await ac.delete(f"/snapshots/{snapshot_id}", headers=headers)
+        assert response.status_code == 404
+        response = await ac.get(f"/instances/{instance_id}", headers=headers)
+        assert response.status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_create_snapshot_hibernated_route(
+    app_client, mock_instances_collection_with_data, instance_id, api_key, mock_provisioner
+):
+    """Test that hibernated instances can't be snapshotted."""
+    async with app_client as ac:
+        headers = {"X-API-Key": api_key}
+        await ac.put(
+            f"/instances/{instance_id}", headers=headers, json={"status": "hibernated"}
+        )
+        response = await ac.post(f"/instances/{instance_id}/snapshots", headers=headers)
+        assert response.status_code == 400
+        assert mock_provisioner.snapshots == []
+
+
+@pytest.mark.asyncio
+async def test_clone_unknown_snapshot_route(app_client, api_key):
+    """Test that cloning a snapshot that doesn't exist fails without creating the instance."""
+    async with app_client as ac:
+        headers = {"X-API-Key": api_key}
+        response = await ac.post(
+            "/instances",
+            headers=headers,
+            json={"name": "test-clone", "fromSnapshot": "6814f1d1a4c2f1a0b1c2d3e4"},
+        )
+        assert response.status_code == 404
+        response = await ac.get("/instances", headers=headers)
+        assert response.json() == []
+
+
+@pytest.mark.asyncio
+async def test_create_snapshot_not_found_route(app_client, api_key):
+    """Test taking a snapshot of an unknown instance."""
+    async with app_client as ac:
+        headers = {"X-API-Key": api_key}
+        response = await ac.post(
+            "/instances/6814f1d1a4c2f1a0b1c2d3e4/snapshots", headers=headers
+        )
+        assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_wake_instance_route(
+    app_client, mock_instances_collection_with_data, instance_id, api_key, mock_provisioner
+):
+    """Test waking up a hibernated instance."""
+    async with app_client as ac:
+        headers = {"X-API-Key": api_key}
+        await ac.put(
+            f"/instances/{instance_id}", headers=headers, json={"status": "hibernated"}
+        )
+        response = await ac.post(
+            f"/instances/{instance_id}:wake?timeout=0", headers=headers
+        )
+        assert response.status_code == 202
+        assert response.json()["status"] == "waking"
+        assert mock_provisioner.woken_instances == [instance_id]
+        await ac.put(
+            f"/instances/{instance_id}", headers=headers, json={"status": "ready"}
+        )
+        response = await ac.post(f"/instances/{instance_id}:wake", headers=headers)
+        assert response.status_code == 200
+        assert response.json()["status"] == "ready"
+
+
+@pytest.mark.asyncio
+async def test_wake_instance_not_hibernated_route(
+    app_client, mock_instances_collection_with_data, instance_id, api_key, mock_provisioner
+):
+    """Test that only hibernated instances are woken up."""
+    async with app_client as ac:
+        headers = {"X-API-Key": api_key}
+        await ac.put(
+            f"/instances/{instance_id}", headers=headers, json={"status": "updating"}
+        )
+        response = await ac.post(f"/instances/{instance_id}:wake", headers=headers)
+        assert response.status_code == 400
+        assert mock_provisioner.woken_instances == []
+        response = await ac.post(
+            "/instances/6814f1d1a4c2f1a0b1c2d3e4:wake", headers=headers
+        )
+        assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_routed_instance_connection_string(
+    app_client, mock_instances_collection_with_data, instance_id, api_key
+):
+    """Test the connection string of an instance exposed through the router."""
+    async with app_client as ac:
+        headers = {"X-API-Key": api_key}
+        await ac.put(
+            f"/instances/{instance_id}",
+            headers=headers,
+            json={"host": "mongo-instance-1.mongo.example.com", "port": 27017, "tls": True},
+        )
+        response = await ac.get(f"/instances/{instance_id}", headers=headers)
+        assert response.json()["connection_string"] == (
+            "mongodb://mongo-instance-1.mongo.example.com:27017/?tls=true"
+        )
+
+
+@pytest.mark.asyncio
+async def test_create_instance_cluster_unavailable(app_client, api_key, mock_provisioner):
+    """Test that calls rejected by the circuit breaker are reported as unavailable."""
+
+    async def provision_instance(instance, root_password):
+        raise CircuitOpenError("Kubernetes API server is unavailable")
+
+    mock_provisioner.provision_instance = provision_instance
+    async with app_client as ac:
+        headers = {"X-API-Key": api_key}
+        response = await ac.post(
+            "/instances", headers=headers, json={"name": "test-instance"}
+        )
+        assert response.status_code == 503
+
+
+@pytest.mark.asyncio
+async def test_healthz(app_client):
+    """Test that the health endpoint doesn't require an API key."""
+    async with app_client as ac:
+        response = await ac.get("/healthz")
+        assert response.status_code == 200
+        assert response.json() == {"status": "ok"}
+
+
+@pytest.mark.asyncio
+async def test_stream_instance_events_not_found_route(app_client, api_key):
+    """Test streaming the events of an unknown instance."""
+    async with app_client as ac:
+        headers = {"X-API-Key": api_key}
+        response = await ac.get("/instances/111/events", headers=headers)
+        assert response.status_code == 404
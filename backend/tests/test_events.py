@@ -0,0 +1,208 @@
+"""
+Tests for the instance events.
+"""
+
+import asyncio
+import pytest
+from datetime import datetime, timezone
+from pymongo.errors import OperationFailure
+
+from app.events import (
+    CHANGE_STREAMS_NOT_SUPPORTED,
+    EventsUnavailableError,
+    InstanceEventsBroadcaster,
+)
+from app.model import MongoInstance
+from app.routes import format_event
+
+
+class ChangeLogService:
+    """Service whose changes are the ones added to its log, identified by their position."""
+
+    def __init__(self):
+        self.changes = []
+        self._changed = asyncio.Event()
+
+    def add(self, operation, instance_id, instance):
+        self.changes.append((str(len(self.changes) + 1), operation, instance_id, instance))
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def watch_instances(self, resume_after=None):
+        tokens = [change[0] for change in self.changes]
+        if resume_after is None:
+            position = len(self.changes)
+        elif resume_after in tokens:
+            position = tokens.index(resume_after) + 1
+        else:
+            raise ValueError(f"Can't resume after {resume_after}")
+        while True:
+            while position < len(self.changes):
+                yield self.changes[position]
+                position += 1
+            await self._changed.wait()
+
+
+def make_instance(instance_id, status):
+    return MongoInstance(
+        id=instance_id,
+        name="test-instance",
+        created_at=datetime.now(tz=timezone.utc),
+        status=status,
+        host=None,
+        port=None,
+    )
+
+
+@pytest.mark.asyncio
+async def test_subscribe_filters_and_replays():
+    """Test that subscribers get the events of their instance and can resume."""
+    service = ChangeLogService()
+    broadcaster = InstanceEventsBroadcaster(service)
+    try:
+        async with broadcaster.subscribe("a") as subscription:
+            await asyncio.sleep(0)
+            service.add("update", "b", make_instance("b", "ready"))
+            service.add("update", "a", make_instance("a", "ready"))
+            event = await asyncio.wait_for(anext(subscription), 1)
+            assert (event.id, event.instance_id) == ("2", "a")
+            assert format_event(event).startswith("id: 2\nevent: update\ndata: {")
+
+        service.add("delete", "a", None)
+        await asyncio.sleep(0.01)
+        async with broadcaster.subscribe(last_event_id="1") as subscription:
+            replayed = [await anext(subscription), await anext(subscription)]
+        assert [(e.id, e.operation) for e in replayed] == [("2", "update"), ("3", "delete")]
+        assert format_event(replayed[1]) == 'id: 3\nevent: delete\ndata: {"id": "a"}\n\n'
+    finally:
+        await broadcaster.stop()
+
+
+@pytest.mark.asyncio
+async def test_subscribe_resumes_past_history():
+    """Test that subscribers resuming from events no longer in memory read them again."""
+    service = ChangeLogService()
+    broadcaster = InstanceEventsBroadcaster(service, history_size=1)
+    try:
+        for status in ["provisioning", "ready"]:
+            service.add("update", "a", make_instance("a", status))
+        async with broadcaster.subscribe(last_event_id="1") as subscription:
+            event = await asyncio.wait_for(anext(subscription), 1)
+            assert (event.id, event.instance.status) == ("2", "ready")
+            service.add("delete", "a", None)
+            event = await asyncio.wait_for(anext(subscription), 1)
+            assert (event.id, event.operation) == ("3", "delete")
+
+        # Unknown events can't be resumed, the subscribers get the next ones
+        async with broadcaster.subscribe(last_event_id="unknown") as subscription:
+            await asyncio.sleep(0.01)
+            service.add("insert", "b", make_instance("b", "provisioning"))
+            event = await asyncio.wait_for(anext(subscription), 1)
+            assert (event.id, event.instance_id) == ("4", "b")
+    finally:
+        await broadcaster.stop()
+
+
+@pytest.mark.asyncio
+async def test_subscribe_resumes_more_events_than_queue_size():
+    """Test that missed events not fitting in the queue are read again, none is skipped."""
+    service = ChangeLogService()
+    broadcaster = InstanceEventsBroadcaster(service, queue_size=2)
+    try:
+        async with broadcaster.subscribe():
+            await asyncio.sleep(0)
+            service.add("insert", "a", make_instance("a", "provisioning"))
+            await asyncio.sleep(0.01)
+        for status in ["ready", "updating", "ready"]:
+            service.add("update", "a", make_instance("a", status))
+        await asyncio.sleep(0.01)
+        async with broadcaster.subscribe(last_event_id="1") as subscription:
+            events = [await asyncio.wait_for(anext(subscription), 1) for _ in range(3)]
+        assert [event.id for event in events] == ["2", "3", "4"]
+    finally:
+        await broadcaster.stop()
+
+
+@pytest.mark.asyncio
+async def test_subscriptions_fail_without_change_streams():
+    """Test that subscriptions fail visibly when MongoDB doesn't support change streams."""
+
+    class StandaloneService(ChangeLogService):
+        async def watch_instances(self, resume_after=None):
+            raise OperationFailure(
+                "The $changeStream stage is only supported on replica sets",
+                code=CHANGE_STREAMS_NOT_SUPPORTED,
+            )
+            yield
+
+    broadcaster = InstanceEventsBroadcaster(StandaloneService())
+    try:
+        async with broadcaster.subscribe() as subscription:
+            with pytest.raises(EventsUnavailableError):
+                await asyncio.wait_for(anext(subscription), 1)
+        assert "replica set" in broadcaster.unavailable_reason
+        async with broadcaster.subscribe(last_event_id="1") as subscription:
+            with pytest.raises(EventsUnavailableError):
+                await asyncio.wait_for(anext(subscription), 1)
+    finally:
+        await broadcaster.stop()
+
+
+@pytest.mark.asyncio
+async def test_read_events_resumes_after_error(monkeypatch):
+    """Test that the change stream is reopened after the last change read."""
+    monkeypatch.setattr("app.events.RETRY_INTERVAL", 0)
+
+    class FailingService(ChangeLogService):
+        def __init__(self):
+            super().__init__()
+            self.resumed_after = []
+
+        async def watch_instances(self, resume_after=None):
+            self.resumed_after.append(resume_after)
+            changes = super().watch_instances(resume_after)
+            yield await anext(changes)
+            if len(self.resumed_after) == 1:
+                raise ConnectionError("Connection lost")
+            async for change in changes:
+                yield change
+
+    service = FailingService()
+    broadcaster = InstanceEventsBroadcaster(service)
+    try:
+        async with broadcaster.subscribe() as subscription:
+            await asyncio.sleep(0)
+            for status in ["provisioning", "ready"]:
+                service.add("update", "a", make_instance("a", status))
+            events = [await asyncio.wait_for(anext(subscription), 1) for _ in range(2)]
+        assert [event.id for event in events] == ["1", "2"]
+        assert service.resumed_after == [None, "1"]
+    finally:
+        await broadcaster.stop()
+
+
+@pytest.mark.asyncio
+async def test_stop_ends_subscriptions():
+    """Test that stopping the broadcaster cancels the reader and ends the subscriptions."""
+    broadcaster = InstanceEventsBroadcaster(ChangeLogService())
+    async with broadcaster.subscribe() as subscription:
+        await asyncio.sleep(0)
+        await broadcaster.stop()
+        assert [event async for event in subscription] == []
+    assert broadcaster._reader is None
+
+
+@pytest.mark.asyncio
+async def test_slow_subscriber_dropped():
+    """Test that subscribers whose queue is full stop receiving events."""
+    service = ChangeLogService()
+    broadcaster = InstanceEventsBroadcaster(service, queue_size=2)
+    try:
+        async with broadcaster.subscribe() as subscription:
+            await asyncio.sleep(0)
+            for status in ["provisioning", "ready", "updating"]:
+                service.add("update", "a", make_instance("a", status))
+            await asyncio.sleep(0.01)
+            assert [event async for event in subscription] == []
+    finally:
+        await broadcaster.stop()
@@ -0,0 +1,185 @@
+"""
+Tests for the status history.
+"""
+
+import os
+import pytest
+import pytest_asyncio
+from datetime import datetime, timedelta, timezone
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from app.database import status_history_collection
+from app.history import StatusHistoryRecorder
+from app.repository import StatusHistoryRepository
+from app.serialization import MongoInstanceUpdate
+
+
+@pytest.mark.asyncio
+async def test_status_transitions_recorded(
+    app_client, api_key, mongo_instances_service, status_recorder
+):
+    """Test that status changes are recorded once, when flushed."""
+    instance = await mongo_instances_service.create_instance("test-instance")
+    for status in ["ready", "ready", "updating", "ready"]:
+        await mongo_instances_service.update_instance(
+            instance.id, MongoInstanceUpdate(status=status)
+        )
+    async with app_client as ac:
+        headers = {"X-API-Key": api_key}
+        url = f"/instances/{instance.id}/history"
+        assert (await ac.get(url, headers=headers)).json() == []
+
+        await status_recorder.flush()
+        response = await ac.get(url, headers=headers)
+        assert response.status_code == 200
+        assert [point["status"] for point in response.json()] == [
+            "provisioning",
+            "ready",
+            "updating",
+            "ready",
+        ]
+
+        response = await ac.get(url, headers=headers, params={"bucket": 3600})
+        assert response.status_code == 200
+        points = response.json()
+        assert len(points) in (1, 2)
+        assert points[-1]["status"] == "ready"
+        assert sum(point["transitions"] for point in points) == 4
+
+
+@pytest.mark.asyncio
+async def test_time_to_ready_percentiles(app_client, api_key, status_history_repository):
+    """Test the percentiles of the time taken by instances to become ready."""
+    start = datetime.now(tz=timezone.utc) - timedelta(hours=1)
+    transitions = []
+    for i, seconds in enumerate([10, 20, 30, 40, 1000]):
+        transitions += [
+            {"timestamp": start, "instance_id": str(i), "status": "provisioning"},
+            {
+                "timestamp": start + timedelta(seconds=seconds),
+                "instance_id": str(i),
+                "status": "ready",
+            },
+        ]
+    # Never ready
+    transitions.append(
+        {"timestamp": start, "instance_id": "5", "status": "provisioning"}
+    )
+    await status_history_repository.insert_transitions(transitions)
+
+    async with app_client as ac:
+        response = await ac.get("/stats/time-to-ready", headers={"X-API-Key": api_key})
+        assert response.status_code == 200
+        assert response.json() == {"count": 5, "p50": 30.0, "p90": 40.0, "p99": 40.0}
+
+
+@pytest.mark.asyncio
+async def test_wake_time_histogram(
+    app_client, api_key, mongo_instances_service, status_recorder
+):
+    """Test that the wake up time reported by the operator is recorded in the histogram."""
+    instance = await mongo_instances_service.create_instance("test-instance")
+    for wake_seconds in [3, 12, 400]:
+        await mongo_instances_service.update_instance(
+            instance.id, MongoInstanceUpdate(status="hibernated")
+        )
+        await mongo_instances_service.wake_instance(instance.id, timeout=0)
+        await mongo_instances_service.update_instance(
+            instance.id,
+            MongoInstanceUpdate(status="ready", last_wake_seconds=wake_seconds),
+        )
+    await status_recorder.flush()
+
+    async with app_client as ac:
+        response = await ac.get("/stats/wake-time", headers={"X-API-Key": api_key})
+        assert response.status_code == 200
+        histogram = response.json()
+        assert histogram["count"] == 3
+        assert [bucket["count"] for bucket in histogram["buckets"]] == [
+            1,
+            0,
+            1,
+            0,
+            0,
+            0,
+            1,
+        ]
+        assert histogram["buckets"][-1]["le"] is None
+
+
+@pytest_asyncio.fixture
+async def mongodb_history_repository():
+    """Returns a StatusHistoryRepository on a MongoDB server, the mock doesn't run the
+    availability pipeline. Skipped unless MONGODB_TEST_URI is set."""
+    uri = os.getenv("MONGODB_TEST_URI")
+    if not uri:
+        pytest.skip("MONGODB_TEST_URI is not set")
+    client = AsyncIOMotorClient(uri)
+    db = client[f"test_history_{os.getpid()}"]
+    try:
+        yield StatusHistoryRepository(await status_history_collection(db))
+    finally:
+        await client.drop_database(db.name)
+        client.close()
+
+
+@pytest.mark.asyncio
+async def test_daily_availability(mongodb_history_repository):
+    """Test that the time spent ready is split across days, from the status before `since`."""
+    day = datetime(2026, 1, 2, tzinfo=timezone.utc)
+
+    def hours(h):
+        return day + timedelta(hours=h)
+
+    await mongodb_history_repository.insert_transitions(
+        [
+            # Ready since the day before
+            {"timestamp": hours(-12), "instance_id": "a", "status": "ready"},
+            {"timestamp": hours(6), "instance_id": "a", "status": "not ready"},
+            {"timestamp": hours(12), "instance_id": "a", "status": "ready"},
+            # Provisioning doesn't count
+            {"timestamp": hours(18), "instance_id": "b", "status": "provisioning"},
+            {"timestamp": hours(24), "instance_id": "b", "status": "ready"},
+            # Hibernated before `since`
+            {"timestamp": hours(-6), "instance_id": "c", "status": "ready"},
+            {"timestamp": hours(-1), "instance_id": "c", "status": "hibernated"},
+            # Changed right at `since`
+            {"timestamp": hours(-2), "instance_id": "d", "status": "ready"},
+            {"timestamp": hours(0), "instance_id": "d", "status": "not ready"},
+        ]
+    )
+
+    availability = await mongodb_history_repository.get_daily_availability(
+        day, hours(48)
+    )
+    assert [
+        (point["day"], point["ready_seconds"], point["total_seconds"])
+        for point in availability
+    ] == [(day, 18 * 3600, 48 * 3600), (hours(24), 48 * 3600, 72 * 3600)]
+
+
+class FailingHistoryRepository:
+    def __init__(self):
+        self.fail = True
+        self.transitions = []
+
+    async def insert_transitions(self, transitions):
+        if self.fail:
+            raise ConnectionError("DB unavailable")
+        self.transitions += transitions
+
+
+@pytest.mark.asyncio
+async def test_recorder_keeps_transitions_on_failure():
+    """Test that transitions are kept until written, up to the maximum pending."""
+    history_repository = FailingHistoryRepository()
+    recorder = StatusHistoryRecorder(history_repository, max_pending=2)
+    for status in ["provisioning", "ready", "failed"]:
+        recorder.record("a", status)
+    await recorder.flush()
+    history_repository.fail = False
+    await recorder.stop()
+    assert [t["status"] for t in history_repository.transitions] == [
+        "provisioning",
+        "ready",
+    ]
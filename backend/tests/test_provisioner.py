@@ -0,0 +1,286 @@
+"""
+Tests for the provisioning of instances across clusters.
+"""
+
+import asyncio
+import pytest
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from kr8s import NotFoundError
+
+from app.model import MongoSnapshot
+from app.provisioner import (
+    ClusterLoad,
+    Job,
+    KubernetesCluster,
+    ManagedResource,
+    MongoInstanceResource,
+    PersistentVolume,
+    Pod,
+    Provisioner,
+)
+from app.resilience import CircuitOpenError
+from app.services import InstancesService
+from app.serialization import MongoInstanceUpdate
+
+
+class FakeCluster:
+    """In-process cluster keeping its MongoInstance resources in memory."""
+
+    def __init__(self, name, nodes, members=0, snapshots=(), available=True):
+        self.name = name
+        self.nodes = nodes
+        self.members = members
+        self.snapshots = set(snapshots)
+        self.is_available = available
+        self.instances = set()
+        self.fail = False
+
+    async def get_load(self):
+        if self.fail:
+            raise ConnectionError("API server unavailable")
+        return ClusterLoad(self.nodes, self.members + len(self.instances))
+
+    async def get_snapshot(self, snapshot_id):
+        if not self.is_available or self.fail:
+            raise CircuitOpenError("Kubernetes API server is unavailable")
+        if snapshot_id not in self.snapshots:
+            return None
+        return MongoSnapshot(
+            id=snapshot_id,
+            instance_id="6814f1d1a4c2f1a0b1c2d3e4",
+            created_at=datetime.now(tz=timezone.utc),
+            status="Ready",
+            cluster=self.name,
+        )
+
+    async def provision_instance(self, instance, root_password):
+        self.instances.add(instance.id)
+
+    async def deprovision_instance(self, instance):
+        if instance.id not in self.instances:
+            return False
+        self.instances.remove(instance.id)
+        return True
+
+
+@pytest.fixture
+def clusters():
+    return [
+        FakeCluster("a", nodes=2, members=4),
+        FakeCluster("b", nodes=4, members=4),
+        # Unreachable, it would be the least loaded otherwise
+        FakeCluster("c", nodes=10, available=False),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_instances_spread_across_clusters(
+    clusters, mongo_instances_repository, status_history_repository
+):
+    """Test that instances go to the least loaded cluster and are deleted from it."""
+    provisioner = Provisioner(clusters)
+    await provisioner.refresh_loads()
+    service = InstancesService(
+        mongo_instances_repository, provisioner, status_history_repository
+    )
+
+    created = [await service.create_instance(f"test-{i}") for i in range(5)]
+
+    assert [instance.cluster for instance in created] == ["b", "b", "b", "b", "a"]
+    instance = await service.get_instance(created[0].id)
+    assert instance.cluster == "b"
+    assert instance.id in clusters[1].instances
+    await service.delete_instance(instance.id)
+    assert instance.id not in clusters[1].instances
+
+
+@pytest.mark.asyncio
+async def test_refresh_keeps_last_load_on_error(clusters):
+    """Test that the last load known is used when a cluster can't be reached."""
+    provisioner = Provisioner(clusters[:2])
+    await provisioner.refresh_loads()
+    clusters[1].members = 100
+    clusters[1].fail = True
+    await provisioner.refresh_loads()
+    assert await provisioner.select_cluster() == "b"
+
+
+@pytest.mark.asyncio
+async def test_clones_go_to_snapshot_cluster(clusters):
+    """Test that clones are provisioned in the cluster of their snapshot."""
+    clusters[0].snapshots.add("snapshot-1")
+    provisioner = Provisioner(clusters)
+    snapshot = await provisioner.get_snapshot("snapshot-1")
+    assert snapshot.cluster == "a"
+    assert await Provisioner(clusters[:2]).get_snapshot("snapshot-2") is None
+
+
+@pytest.mark.asyncio
+async def test_snapshot_lookup_skips_unavailable_clusters(clusters):
+    """Test that snapshots are looked up in the clusters whose API server is available, and
+    that snapshots not found there aren't reported as missing."""
+    clusters[1].snapshots.add("snapshot-1")
+    clusters[2].snapshots.add("snapshot-2")
+    # The circuit opens while looking up the snapshot
+    clusters[0].fail = True
+    provisioner = Provisioner(clusters)
+    snapshot = await provisioner.get_snapshot("snapshot-1")
+    assert snapshot.cluster == "b"
+    with pytest.raises(CircuitOpenError):
+        await provisioner.get_snapshot("snapshot-2")
+    with pytest.raises(CircuitOpenError):
+        await provisioner.get_snapshot("snapshot-3")
+
+
+@pytest.mark.asyncio
+async def test_updates_from_other_clusters_ignored(mongo_instances_service):
+    """Test that the status reported by other clusters than the instance's is ignored."""
+    instance = await mongo_instances_service.create_instance("test-instance")
+    await mongo_instances_service.update_instance(
+        instance.id, MongoInstanceUpdate(status="ready", cluster="other")
+    )
+    assert await mongo_instances_service.remove_deprovisioned_instance(
+        instance.id, "other"
+    ) is None
+    instance = await mongo_instances_service.get_instance(instance.id)
+    assert instance.status == "provisioning"
+    await mongo_instances_service.remove_deprovisioned_instance(instance.id, "default")
+    assert await mongo_instances_service.get_instance(instance.id) is None
+
+
+class FakeResponse:
+    def __init__(self, body):
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+class FakePagedApi:
+    """API client serving the MongoInstance resources in pages of two."""
+
+    def __init__(self, names):
+        self.names = names
+        self.requests = []
+
+    @asynccontextmanager
+    async def async_get_kind(self, kind, namespace=None, params=None):
+        self.requests.append(params)
+        start = int(params.get("continue") or 0)
+        items = [
+            {
+                "metadata": {
+                    "name": name,
+                    "namespace": "default",
+                    "creationTimestamp": "2025-05-01T00:00:00Z",
+                },
+                "spec": {"members": 1},
+            }
+            for name in self.names[start : start + 2]
+        ]
+        more = start + 2 < len(self.names)
+        yield kind, FakeResponse(
+            {"items": items, "metadata": {"continue": str(start + 2) if more else ""}}
+        )
+
+
+@pytest.mark.asyncio
+async def test_list_pages_in_separate_calls():
+    """Test that each page is fetched in its own API call, not held open while consumed."""
+    names = [f"mongo-instance-{i:024x}" for i in range(5)]
+    api = FakePagedApi(names)
+    cluster = KubernetesCluster("a", api)
+    calls = []
+    acquire = cluster._rate_limiter.acquire
+
+    async def count_calls():
+        calls.append(len(api.requests))
+        await acquire()
+
+    cluster._rate_limiter.acquire = count_calls
+    listed = [
+        resource.name
+        async for resource in cluster._list(MongoInstanceResource, page_size=2)
+    ]
+    assert listed == names
+    assert [request.get("continue") for request in api.requests] == [None, "2", "4"]
+    # Every page went through the rate limiter
+    assert calls == [0, 1, 2]
+
+
+@pytest.mark.asyncio
+async def test_cancelled_trial_call_releases_circuit():
+    """Test that a trial call cancelled while waiting for the rate limiter lets another
+    trial call through."""
+    cluster = KubernetesCluster(
+        "a", None, qps=0.001, burst=1, failure_threshold=1, reset_timeout=0
+    )
+    with pytest.raises(OSError):
+        async with cluster._api_call():
+            raise OSError("Connection refused")
+    assert not cluster.is_available
+
+    async def trial_call():
+        async with cluster._api_call():
+            pass
+
+    # The token was taken by the failed call, so the trial call waits for the next one
+    trial = asyncio.create_task(trial_call())
+    await asyncio.sleep(0.01)
+    with pytest.raises(CircuitOpenError):
+        cluster._circuit_breaker.before_call()
+    trial.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await trial
+    cluster._circuit_breaker.before_call()
+
+
+@pytest.mark.asyncio
+async def test_orphan_volume_data_deleted_from_its_node(monkeypatch):
+    """Test that the hostPath data of an orphan volume is deleted by a job on its node, once
+    the pod of the instance is gone, before deleting the volume."""
+    name = f"mongo-instance-{0:024x}"
+    pv = SimpleNamespace(
+        spec={"hostPath": {"path": f"/data/{name}"}},
+        annotations={"mongo.miguelgarcia.dev/node": "node-1"},
+    )
+    pods = {f"{name}-0"}
+    jobs = []
+    deleted = []
+
+    async def get_pv(pv_name, api=None):
+        return pv
+
+    async def get_pod(pod_name, namespace=None, api=None):
+        if pod_name not in pods:
+            raise NotFoundError(pod_name)
+
+    async def create_job(job):
+        jobs.append(job.raw)
+
+    async def delete(resource):
+        deleted.append(resource.name)
+
+    monkeypatch.setattr(PersistentVolume, "async_get", get_pv)
+    monkeypatch.setattr(Pod, "async_get", get_pod)
+    monkeypatch.setattr(Job, "async_create", create_job)
+    cluster = KubernetesCluster("a", None)
+    monkeypatch.setattr(cluster, "_delete", delete)
+    resource = ManagedResource(
+        PersistentVolume, f"{name}-pv", f"{0:024x}", datetime.now(tz=timezone.utc), "a"
+    )
+
+    # The volume is kept while the pod may still be using the data
+    with pytest.raises(RuntimeError):
+        await cluster.delete_managed_resource(resource)
+    assert jobs == [] and deleted == []
+
+    pods.clear()
+    await cluster.delete_managed_resource(resource)
+    pod_spec = jobs[0]["spec"]["template"]["spec"]
+    assert pod_spec["nodeName"] == "node-1"
+    assert pod_spec["volumes"][0]["hostPath"]["path"] == "/data"
+    assert pod_spec["containers"][0]["command"] == ["rm", "-rf", f"/host/{name}"]
+    assert deleted == [f"{name}-pv"]
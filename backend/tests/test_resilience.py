@@ -0,0 +1,63 @@
+"""
+Tests for the rate limiter and circuit breaker of the Kubernetes API calls.
+"""
+
+import pytest
+import time
+
+from app.resilience import CircuitBreaker, CircuitOpenError, TokenBucket
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_allows_bursts():
+    """Test that calls up to the burst size are not delayed."""
+    bucket = TokenBucket(qps=1, burst=5)
+    start = time.monotonic()
+    for _ in range(5):
+        await bucket.acquire()
+    assert time.monotonic() - start < 0.1
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_limits_rate():
+    """Test that calls beyond the burst size wait for a token."""
+    bucket = TokenBucket(qps=20, burst=1)
+    start = time.monotonic()
+    for _ in range(3):
+        await bucket.acquire()
+    assert time.monotonic() - start >= 0.09
+
+
+def test_circuit_breaker_opens_after_failures(monkeypatch):
+    """Test that the circuit opens after consecutive failures and closes after a trial."""
+    now = 1000.0
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    breaker.before_call()
+    breaker.record_failure()
+    breaker.before_call()
+    breaker.record_failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    now += 31
+    # A single trial call is let through
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_success()
+    assert not breaker.is_open
+    breaker.before_call()
+
+
+def test_circuit_breaker_reopens_after_failed_trial(monkeypatch):
+    """Test that a failed trial call opens the circuit again."""
+    now = 1000.0
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    now += 31
+    breaker.before_call()
+    breaker.record_failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
@@ -0,0 +1,164 @@
+"""
+Tests for the garbage collector.
+"""
+
+import pytest
+from bson import ObjectId
+from datetime import datetime, timedelta, timezone
+from kr8s.asyncio.objects import PersistentVolume, Secret
+
+from app.provisioner import ManagedResource, MongoInstanceResource
+from app.sweeper import Sweeper
+
+
+@pytest.fixture
+def mock_cluster():
+    """Returns a mock provisioner listing a fixed set of managed resources."""
+
+    class MockCluster:
+        default_cluster = "default"
+
+        def __init__(self):
+            self.resources = []
+            self.deleted = []
+
+        def add(
+            self, kind, name, instance_id, age=timedelta(hours=1), cluster="default"
+        ):
+            self.resources.append(
+                ManagedResource(
+                    kind,
+                    name,
+                    instance_id,
+                    datetime.now(tz=timezone.utc) - age,
+                    cluster,
+                )
+            )
+
+        async def list_managed_resources(self):
+            for resource in sorted(
+                self.resources, key=lambda r: r.kind is not MongoInstanceResource
+            ):
+                yield resource
+
+        async def delete_managed_resource(self, resource):
+            self.deleted.append(resource.name)
+
+        async def deprovision_instance(self, instance):
+            self.deleted.append(f"mongo-instance-{instance.id}")
+
+    return MockCluster()
+
+
+async def insert_instance(
+    collection, status="ready", age=timedelta(hours=1), cluster=None
+):
+    result = await collection.insert_one(
+        {
+            "name": "test-instance",
+            "status": status,
+            "created_at": datetime.utcnow() - age,
+            "cluster": cluster,
+        }
+    )
+    return str(result.inserted_id)
+
+
+@pytest.mark.asyncio
+async def test_sweep(mock_mongo_collection, mongo_instances_repository, mock_cluster):
+    """Test that orphan resources are deleted and orphan instances marked as failed."""
+    healthy_id = await insert_instance(mock_mongo_collection)
+    mock_cluster.add(MongoInstanceResource, f"mongo-instance-{healthy_id}", healthy_id)
+    mock_cluster.add(Secret, f"mongo-credentials-{healthy_id}", healthy_id)
+    # Provisioning failed before creating the MongoInstance
+    failed_id = await insert_instance(mock_mongo_collection, status="provisioning")
+    mock_cluster.add(Secret, f"mongo-credentials-{failed_id}", failed_id)
+    # Being provisioned
+    new_id = await insert_instance(mock_mongo_collection, age=timedelta(seconds=1))
+    mock_cluster.add(Secret, f"mongo-credentials-{new_id}", new_id, timedelta(seconds=1))
+    # Deleted from the DB but not from the cluster
+    deleted_id = str(ObjectId())
+    mock_cluster.add(MongoInstanceResource, f"mongo-instance-{deleted_id}", deleted_id)
+    # Leaked by the operator teardown
+    leaked_id = str(ObjectId())
+    mock_cluster.add(PersistentVolume, f"mongo-instance-{leaked_id}-pv", leaked_id)
+    # Deleted from the cluster but the deletion wasn't tracked
+    untracked_id = await insert_instance(mock_mongo_collection, status="deleting")
+    # Marked as deleting but the deletion didn't reach the cluster
+    interrupted_id = await insert_instance(mock_mongo_collection, status="deleting")
+    mock_cluster.add(
+        MongoInstanceResource, f"mongo-instance-{interrupted_id}", interrupted_id
+    )
+
+    sweeper = Sweeper(
+        mongo_instances_repository, mock_cluster, batch_size=2, batch_interval=0
+    )
+    report = await sweeper.sweep()
+
+    assert sorted(mock_cluster.deleted) == sorted(
+        [
+            f"mongo-credentials-{failed_id}",
+            f"mongo-instance-{deleted_id}",
+            f"mongo-instance-{leaked_id}-pv",
+            f"mongo-instance-{interrupted_id}",
+        ]
+    )
+    assert report.retried_deletions == [interrupted_id]
+    assert report.orphan_instances == [failed_id]
+    failed = await mongo_instances_repository.get_instance(failed_id)
+    assert failed.status == "failed"
+    assert report.deleted_instances == [untracked_id]
+    assert await mongo_instances_repository.get_instance(untracked_id) is None
+
+
+@pytest.mark.asyncio
+async def test_sweep_joins_by_cluster(
+    mock_mongo_collection, mongo_instances_repository, mock_cluster
+):
+    """Test that resources only belong to instances of their cluster."""
+    instance_id = await insert_instance(mock_mongo_collection, cluster="a")
+    # Left behind in another cluster
+    mock_cluster.add(
+        MongoInstanceResource, f"mongo-instance-{instance_id}", instance_id, cluster="b"
+    )
+    mock_cluster.add(
+        Secret, f"mongo-credentials-{instance_id}", instance_id, cluster="a"
+    )
+    deleting_id = await insert_instance(
+        mock_mongo_collection, status="deleting", cluster="a"
+    )
+    mock_cluster.add(
+        MongoInstanceResource, f"mongo-instance-{deleting_id}", deleting_id, cluster="b"
+    )
+
+    sweeper = Sweeper(mongo_instances_repository, mock_cluster, batch_interval=0)
+    report = await sweeper.sweep()
+
+    assert sorted(name for _, name in report.orphan_resources) == sorted(
+        [
+            f"mongo-instance-{instance_id}",
+            f"mongo-credentials-{instance_id}",
+            f"mongo-instance-{deleting_id}",
+        ]
+    )
+    assert report.orphan_instances == [instance_id]
+    assert report.retried_deletions == []
+    assert report.deleted_instances == [deleting_id]
+
+
+@pytest.mark.asyncio
+async def test_sweep_dry_run(
+    mock_mongo_collection, mongo_instances_repository, mock_cluster
+):
+    """Test that a dry run reports the drift without fixing it."""
+    failed_id = await insert_instance(mock_mongo_collection, status="provisioning")
+    mock_cluster.add(Secret, f"mongo-credentials-{failed_id}", failed_id)
+
+    sweeper = Sweeper(mongo_instances_repository, mock_cluster)
+    report = await sweeper.sweep(dry_run=True)
+
+    assert report.orphan_resources == [("Secret", f"mongo-credentials-{failed_id}")]
+    assert report.orphan_instances == [failed_id]
+    assert mock_cluster.deleted == []
+    instance = await mongo_instances_repository.get_instance(failed_id)
+    assert instance.status == "provisioning"
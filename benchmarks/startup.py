@@ -0,0 +1,197 @@
+"""Startup benchmark for the backend, the monitor and the operator.
+
+For each component it measures, in fresh processes:
+
+* the time taken to import its main module, and
+* the time from starting it to its first successful request: the backend and the operator
+  answering `/healthz`, the monitor reaching the Kubernetes API server.
+
+The components are started as they would be in their containers, so they need the same
+environment: a MongoDB for the backend (MONGODB_URI, MONGODB_NAME), a Kubernetes cluster for all
+of them and the monitor variables (BACKEND_API_URL, BACKEND_API_KEY, PUBLIC_HOST). The median of
+the runs is compared with the startup budgets and the benchmark fails if any is exceeded.
+
+Deferred imports show in the import time. The time to the first successful request is
+dominated by connecting to MongoDB and the Kubernetes API servers, so it depends on the
+environment more than on the code.
+
+Run it with `python benchmarks/startup.py [--runs N] [--uv] [component ...]`.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from dataclasses import dataclass
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+@dataclass
+class Component:
+    # Directory the component runs from
+    directory: Path
+    # Statement importing its main module
+    import_statement: str
+    # Arguments starting it, after the Python interpreter
+    start_args: list[str]
+    # URL answering 200 once it is ready, or text logged once it is ready
+    ready_url: str | None = None
+    ready_log: str | None = None
+    extra_env: dict[str, str] | None = None
+    # Budgets in seconds for the import and the first successful request
+    import_budget: float = 1.0
+    ready_budget: float = 5.0
+
+
+COMPONENTS = {
+    "backend": Component(
+        directory=ROOT / "backend",
+        import_statement="import app.main",
+        start_args=[
+            "-m",
+            "uvicorn",
+            "app.main:create_app",
+            "--factory",
+            "--port",
+            "18000",
+        ],
+        ready_url="http://127.0.0.1:18000/healthz",
+        import_budget=1.0,
+        ready_budget=3.0,
+    ),
+    "monitor": Component(
+        directory=ROOT / "mongo-monitor",
+        import_statement="import main",
+        start_args=["main.py"],
+        ready_log="Watching MongoInstances",
+        import_budget=1.0,
+        ready_budget=3.0,
+    ),
+    "operator": Component(
+        directory=ROOT / "mongo-operator" / "controller",
+        import_statement="import sys; sys.path.insert(0, 'src'); import controller",
+        start_args=["src/controller.py"],
+        ready_url="http://127.0.0.1:18080/healthz",
+        extra_env={"LIVENESS_ENDPOINT": "http://127.0.0.1:18080/healthz"},
+        import_budget=1.5,
+        ready_budget=5.0,
+    ),
+}
+
+
+def python_command(use_uv):
+    """Runs the components with their own environment when using uv, otherwise with the
+    current interpreter."""
+    return ["uv", "run", "python"] if use_uv else [sys.executable]
+
+
+def measure_import(component, use_uv):
+    code = (
+        "import time; start = time.perf_counter(); "
+        f"{component.import_statement}; print(time.perf_counter() - start)"
+    )
+    result = subprocess.run(
+        python_command(use_uv) + ["-c", code],
+        cwd=component.directory,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def is_ready(url):
+    try:
+        with urllib.request.urlopen(url, timeout=0.5) as response:
+            return response.status == 200
+    except OSError:
+        return False
+
+
+def measure_ready(component, use_uv, timeout):
+    """Returns the seconds until the first successful request, or None on timeout."""
+    env = {**os.environ, **(component.extra_env or {})}
+    logged = threading.Event()
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        python_command(use_uv) + component.start_args,
+        cwd=component.directory,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+    )
+
+    def read_output():
+        for line in process.stdout:
+            if component.ready_log and component.ready_log in line:
+                logged.set()
+
+    threading.Thread(target=read_output, daemon=True).start()
+    try:
+        while time.perf_counter() - start < timeout:
+            if component.ready_url and is_ready(component.ready_url):
+                return time.perf_counter() - start
+            if logged.wait(0.02):
+                return time.perf_counter() - start
+            if process.poll() is not None:
+                return None
+        return None
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "components", nargs="*", help=f"Components to measure: {', '.join(COMPONENTS)}"
+    )
+    parser.add_argument("--runs", type=int, default=5, help="Runs per measurement")
+    parser.add_argument(
+        "--timeout", type=float, default=60, help="Seconds to wait for each start"
+    )
+    parser.add_argument(
+        "--uv", action="store_true", help="Run each component in its uv environment"
+    )
+    args = parser.parse_args()
+    unknown = set(args.components) - COMPONENTS.keys()
+    if unknown:
+        parser.error(f"Unknown components: {', '.join(sorted(unknown))}")
+
+    over_budget = False
+    print(f"{'component':<10} {'import':>9} {'budget':>8} {'ready':>9} {'budget':>8}")
+    for name in args.components or COMPONENTS:
+        component = COMPONENTS[name]
+        imports = [measure_import(component, args.uv) for _ in range(args.runs)]
+        readies = [
+            measure_ready(component, args.uv, args.timeout) for _ in range(args.runs)
+        ]
+        import_time = statistics.median(imports)
+        ready_time = None if None in readies else statistics.median(readies)
+        failed = (
+            import_time > component.import_budget
+            or ready_time is None
+            or ready_time > component.ready_budget
+        )
+        over_budget |= failed
+        ready = "not ready" if ready_time is None else f"{ready_time:.3f}s"
+        print(
+            f"{name:<10} {import_time:>8.3f}s {component.import_budget:>7.1f}s "
+            f"{ready:>9} {component.ready_budget:>7.1f}s"
+            + ("  OVER BUDGET" if failed else "")
+        )
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == "__main__":
+    main()
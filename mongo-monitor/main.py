@@ -3,7 +3,9 @@ status of the instances in calling backend APIs."""
 
 import asyncio
 import os
+from dataclasses import dataclass
 import httpx
+import kr8s.asyncio
 from kr8s.asyncio import watch
 import logging
 
@@ -13,31 +15,89 @@ logging.basicConfig(
     format="%(asctime)s %(levelname)s [%(name)s] %(message)s",
 )
 
-backend_api_url =  os.getenv("BACKEND_API_URL")
-if not backend_api_url:
-    raise ValueError("BACKEND_API_URL environment variable is not set.")
-backend_api_key = os.getenv("BACKEND_API_KEY")
-if not backend_api_key:
-    raise ValueError("BACKEND_API_KEY environment variable is not set.")
+@dataclass
+class Settings:
+    backend_api_url: str
+    backend_api_key: str
+    # Hostname of the public-facing service of each cluster, by cluster name, used to populate
+    # the host field in the backend API
+    public_hosts: dict[str, str]
+    # Kubeconfig contexts of the clusters to watch, the current cluster if empty
+    contexts: list[str]
 
-# Hostname of the public-facing service used to populate the host field in the backend API
-public_host = os.getenv("PUBLIC_HOST")
-if not public_host:
-    raise ValueError("PUBLIC_HOST environment variable is not set.")
+def read_settings():
+    """Reads the settings from the environment when the monitor starts, not on import."""
+    backend_api_url = os.getenv("BACKEND_API_URL")
+    if not backend_api_url:
+        raise ValueError("BACKEND_API_URL environment variable is not set.")
+    backend_api_key = os.getenv("BACKEND_API_KEY")
+    if not backend_api_key:
+        raise ValueError("BACKEND_API_KEY environment variable is not set.")
+    contexts = [c.strip() for c in os.getenv("K8S_CONTEXTS", "").split(",") if c]
+    if not contexts:
+        public_host = os.getenv("PUBLIC_HOST")
+        if not public_host:
+            raise ValueError("PUBLIC_HOST environment variable is not set.")
+        public_hosts = {"default": public_host}
+    else:
+        # Each cluster has its own public host, as context=host pairs
+        public_hosts = {}
+        for entry in os.getenv("PUBLIC_HOSTS", "").split(","):
+            if entry.strip():
+                context, _, host = entry.partition("=")
+                public_hosts[context.strip()] = host.strip()
+        missing = [c for c in contexts if not public_hosts.get(c)]
+        if missing:
+            raise ValueError(
+                f"PUBLIC_HOSTS environment variable has no host for {', '.join(missing)}."
+            )
+    return Settings(backend_api_url, backend_api_key, public_hosts, contexts)
 
-async def update_instace(instance_id, port=None, status=None):
-    """Update the instance in the backend API."""
-    url = f"{backend_api_url}/instances/{instance_id}"
+async def update_instace(
+    settings,
+    instance_id,
+    port=None,
+    status=None,
+    replica_set=None,
+    last_wake_seconds=None,
+    hostname=None,
+    storage_size=None,
+    storage_expandable=None,
+    running_version=None,
+    cluster="default",
+):
+    """Update the instance in the backend API. The backend ignores the updates reported from
+    other clusters than the one of the instance."""
+    url = f"{settings.backend_api_url}/instances/{instance_id}"
     headers = {
-        "x-api-key": backend_api_key,
+        "x-api-key": settings.backend_api_key,
         "Content-Type": "application/json"
     }
-    data = {}
+    data = {"cluster": cluster}
     if port:
         data["port"] = port
     if status:
         data["status"] = status
-    data["host"] = public_host
+    if hostname:
+        # Instances exposed through the router are reached by hostname using TLS
+        data["host"] = hostname
+        data["tls"] = True
+    else:
+        data["host"] = settings.public_hosts[cluster]
+    if replica_set:
+        # The members are only reachable in-cluster, clients connect to the primary through
+        # the public host
+        data["replicaSet"] = replica_set["name"]
+    if last_wake_seconds:
+        data["last_wake_seconds"] = last_wake_seconds
+    # Storage size and version the instance actually has: the backend only stores new storage
+    # sizes once they are reported, and checks upgrades against the version running
+    if storage_size:
+        data["storageSize"] = storage_size
+    if storage_expandable is not None:
+        data["storageExpandable"] = storage_expandable
+    if running_version:
+        data["runningVersion"] = running_version
     async with httpx.AsyncClient() as client:
         response = await client.put(url, headers=headers, json=data)
         if response.status_code == 200:
@@ -45,7 +105,19 @@ async def update_instace(instance_id, port=None, status=None):
         else:
             logging.error(f"Failed to update instance {instance_id} in backend API: {response.text}")
 
-async def handle_event(event_type, instance):
+async def report_deprovisioned(settings, instance_id, cluster="default"):
+    """Report to the backend API that the resources of the instance are gone from the
+    cluster, so it removes the instance."""
+    url = f"{settings.backend_api_url}/instances/{instance_id}:deprovisioned"
+    headers = {"x-api-key": settings.backend_api_key}
+    async with httpx.AsyncClient() as client:
+        response = await client.post(url, headers=headers, params={"cluster": cluster})
+        if response.status_code == 200:
+            logging.info(f"Successfully removed instance {instance_id} from backend API.")
+        else:
+            logging.error(f"Failed to remove instance {instance_id} from backend API: {response.text}")
+
+async def handle_event(settings, event_type, instance, cluster="default"):
     instance_id = instance.annotations.get("mongo-instance-id")
     if not instance_id:
         logging.warning("No mongo-instance-id found in annotations.")
@@ -58,20 +130,60 @@ async def handle_event(event_type, instance):
             logging.info(f"Instance {instance_id} modified with status: {status}")
             port = status.get("port")
             available_replicas = status.get("availableReplicas")
-            instance_status = "ready" if available_replicas else "not ready"
-            await update_instace(instance_id, port=port, status=instance_status)
+            rollout_state = status.get("rollout", {}).get("state")
+            if status.get("hibernated"):
+                instance_status = "hibernated"
+            elif status.get("wakeRequestedAt"):
+                instance_status = "waking"
+            elif rollout_state == "InProgress":
+                instance_status = "updating"
+            else:
+                instance_status = "ready" if available_replicas else "not ready"
+            await update_instace(
+                settings,
+                instance_id,
+                port=port,
+                status=instance_status,
+                replica_set=status.get("replicaSet"),
+                last_wake_seconds=status.get("lastWakeSeconds"),
+                hostname=status.get("hostname"),
+                storage_size=status.get("storageSize"),
+                storage_expandable=status.get("storageExpandable"),
+                running_version=status.get("runningVersion"),
+                cluster=cluster,
+            )
             print(f"Instance {instance_id} modified with port: {port}, available replicas: {available_replicas}")
         else:
             logging.warning(f"Instance {instance_id} modified but no status found.")
+    elif event_type == "DELETED":
+        # The resources of the instance are gone, the backend can forget about it
+        await report_deprovisioned(settings, instance_id, cluster)
     
-async def watch_instances():
-    async for event in watch("mongoinstances", namespace="default"):
+async def watch_instances(settings, cluster="default", context=None):
+    api = await kr8s.asyncio.api(context=context)
+    # First call to the API server, the monitor is ready once it succeeds
+    await api.version()
+    logging.info(f"Watching MongoInstances in cluster {cluster}.")
+    async for event in watch("mongoinstances", namespace="default", api=api):
         event_type, instance = event
-        logging.info(f"Event: {event_type}, Instance: {instance['metadata']['name']}")
+        logging.info(
+            f"Event: {event_type}, Cluster: {cluster}, Instance: {instance['metadata']['name']}"
+        )
         try:
-            await handle_event(event_type, instance)
+            await handle_event(settings, event_type, instance, cluster)
         except Exception as e:
             logging.error(f"Error handling event: {e}")
 
+async def main():
+    """Watches the instances of every cluster concurrently, clusters are named after their
+    contexts as in the backend."""
+    settings = read_settings()
+    if not settings.contexts:
+        await watch_instances(settings)
+        return
+    await asyncio.gather(
+        *(watch_instances(settings, context, context) for context in settings.contexts)
+    )
+
 if __name__ == "__main__":
-    asyncio.run(watch_instances())
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file
@@ -5,11 +5,19 @@ care of creating and managing the MongoDB instance, including its storage, servi
 in the cluster.
 """
 
+import asyncio
 import kopf
 import logging
+import os
+from base64 import b64decode, b64encode
+from datetime import datetime, timezone
+from kr8s import NotFoundError, ServerError
 from kr8s.objects import (
+    Job,
     PersistentVolume,
     PersistentVolumeClaim,
+    Pod,
+    Secret,
     Service,
     StatefulSet,
     new_class,
@@ -24,6 +32,77 @@ MongoInstanceResource = new_class(
     plural="mongoinstances",
 )
 
+MongoSnapshotResource = new_class(
+    kind="MongoSnapshot",
+    version="mongo.miguelgarcia.dev/v1",
+    namespaced=True,
+    plural="mongosnapshots",
+)
+
+VolumeSnapshotResource = new_class(
+    kind="VolumeSnapshot",
+    version="snapshot.storage.k8s.io/v1",
+    namespaced=True,
+    plural="volumesnapshots",
+)
+
+StorageClassResource = new_class(
+    kind="StorageClass",
+    version="storage.k8s.io/v1",
+    namespaced=False,
+    plural="storageclasses",
+)
+
+# Readiness gate used while rolling out new versions of an instance
+READINESS_PROBE = {
+    "tcpSocket": {"port": 27017},
+    "initialDelaySeconds": 5,
+    "periodSeconds": 10,
+}
+
+# Name of the replica set of instances with more than one member
+REPLICA_SET_NAME = "rs0"
+
+# Label of the replica set members with their role, the service of the replica set only selects
+# the primary as clients outside the cluster can't reach the members by their in-cluster names
+ROLE_LABEL = "mongo.miguelgarcia.dev/role"
+
+# Annotation of the hostPath volumes with the node holding their data, so the data of volumes
+# left behind by a failed deletion can be found and deleted
+NODE_ANNOTATION = "mongo.miguelgarcia.dev/node"
+
+# Error code returned by replSetGetStatus before the replica set is initiated
+NOT_YET_INITIALIZED = 94
+
+# Snapshot class used for volume snapshots, the cluster default one is used when not set
+VOLUME_SNAPSHOT_CLASS = os.getenv("VOLUME_SNAPSHOT_CLASS")
+
+# Size of the chunks of the compressed archives written by the dump fallback
+ARCHIVE_CHUNK_SIZE = os.getenv("ARCHIVE_CHUNK_SIZE", "256m")
+
+# Idle time after which instances are hibernated, hibernation is disabled when 0
+HIBERNATE_AFTER_SECONDS = int(os.getenv("HIBERNATE_AFTER_SECONDS", "0"))
+
+# Operations counted as client activity when detecting idle instances
+ACTIVITY_OPCOUNTERS = ("insert", "query", "update", "delete", "getmore")
+
+# Application name used by the operator connections, excluded from the client connections
+OPERATOR_APP_NAME = "mongo-operator"
+
+# Instances are exposed with a NodePort service each ("nodeport") or through the shared
+# router ("router"), which routes connections by TLS SNI hostname
+ROUTING_MODE = os.getenv("ROUTING_MODE", "nodeport")
+ROUTER_DOMAIN = os.getenv("ROUTER_DOMAIN")
+ROUTER_PORT = int(os.getenv("ROUTER_PORT", "27017"))
+# Secret with the certificate and key of the router domain (`tls.pem`)
+ROUTER_TLS_SECRET = os.getenv("ROUTER_TLS_SECRET")
+if ROUTING_MODE not in ("nodeport", "router"):
+    raise ValueError(f"Unknown ROUTING_MODE {ROUTING_MODE}, use nodeport or router.")
+if ROUTING_MODE == "router" and not (ROUTER_DOMAIN and ROUTER_TLS_SECRET):
+    raise ValueError(
+        "ROUTER_DOMAIN and ROUTER_TLS_SECRET environment variables must be set in router mode."
+    )
+
 # Configure root logger
 logging.basicConfig(
     level=logging.INFO,  # Or INFO, WARNING, etc.
@@ -31,11 +110,42 @@ logging.basicConfig(
 )
 
 
+async def create_storage_from_snapshot(name, namespace, spec, snapshot_status):
+    """
+    Create the PersistentVolumeClaim of the MongoDB instance from a volume snapshot. The CSI
+    driver provisions the volume from the snapshot, so no data is copied by the operator.
+    """
+    pvc = PersistentVolumeClaim(
+        {
+            "apiVersion": "v1",
+            "kind": "PersistentVolumeClaim",
+            "metadata": {"name": f"{name}-pvc", "namespace": namespace},
+            "spec": {
+                "accessModes": ["ReadWriteOnce"],
+                "resources": {
+                    "requests": {
+                        "storage": snapshot_status.get(
+                            "restoreSize", spec.get("storageSize", "1Gi")
+                        )
+                    }
+                },
+                "dataSource": {
+                    "apiGroup": "snapshot.storage.k8s.io",
+                    "kind": "VolumeSnapshot",
+                    "name": snapshot_status["volumeSnapshot"],
+                },
+            },
+        }
+    )
+    kopf.adopt(pvc.raw)
+    await pvc.async_create()
+
+
 async def create_storage(name, namespace, spec):
     """
     Create a PersistentVolume and PersistentVolumeClaim for the MongoDB instance.
     """
-    requested_storage = spec.get("storage", "1Gi")
+    requested_storage = spec.get("storageSize", "1Gi")
     pv = PersistentVolume(
         {
             "apiVersion": "v1",
@@ -62,13 +172,22 @@ async def create_storage(name, namespace, spec):
             },
         }
     )
+    kopf.adopt(pvc.raw)
     await pvc.async_create()
 
 
-async def create_external_service(name, namespace):
+def service_selector(name, spec):
+    """Pods selected by the service of the instance, the primary for replica sets."""
+    if is_replica_set(spec):
+        return {"app": name, ROLE_LABEL: "primary"}
+    return {"app": name}
+
+
+async def create_external_service(name, namespace, spec):
     """
     Create a NodePort service for the MongoDB instance.
-    This service will expose the MongoDB instance to the outside world.
+    This service will expose the MongoDB instance to the outside world. In router mode the
+    instance is reached through the shared router, so a ClusterIP service is enough.
     """
     service = Service(
         {
@@ -76,8 +195,8 @@ async def create_external_service(name, namespace):
             "kind": "Service",
             "metadata": {"name": name, "namespace": namespace},
             "spec": {
-                "type": "NodePort",
-                "selector": {"app": name},
+                "type": "ClusterIP" if ROUTING_MODE == "router" else "NodePort",
+                "selector": service_selector(name, spec),
                 "ports": [{"protocol": "TCP", "port": 27017, "targetPort": 27017}],
             },
         }
@@ -87,6 +206,68 @@ async def create_external_service(name, namespace):
     return service
 
 
+def is_replica_set(spec):
+    return spec.get("members", 1) > 1
+
+
+def pvc_names(name, spec):
+    """
+    Names of the PersistentVolumeClaims of the MongoDB instance. Standalone instances use a
+    single pre-created claim while every replica set member gets its own claim from the
+    StatefulSet volume claim template.
+    """
+    if is_replica_set(spec):
+        return [f"storage-{name}-{i}" for i in range(spec["members"])]
+    return [f"{name}-pvc"]
+
+
+def member_hosts(name, namespace, members):
+    """Stable DNS names of the replica set members, provided by the headless service."""
+    return [
+        f"{name}-{i}.{name}-headless.{namespace}.svc.cluster.local:27017"
+        for i in range(members)
+    ]
+
+
+async def create_keyfile_secret(name, namespace):
+    """
+    Create the secret with the keyfile used by the replica set members to authenticate each
+    other.
+    """
+    secret = Secret(
+        {
+            "apiVersion": "v1",
+            "kind": "Secret",
+            "metadata": {"name": f"{name}-keyfile", "namespace": namespace},
+            "type": "Opaque",
+            "data": {"keyfile": b64encode(b64encode(os.urandom(756))).decode()},
+        }
+    )
+    kopf.adopt(secret.to_dict())
+    await secret.async_create()
+
+
+async def create_headless_service(name, namespace):
+    """
+    Create a headless service giving each replica set member a stable DNS name.
+    """
+    service = Service(
+        {
+            "apiVersion": "v1",
+            "kind": "Service",
+            "metadata": {"name": f"{name}-headless", "namespace": namespace},
+            "spec": {
+                "clusterIP": "None",
+                "publishNotReadyAddresses": True,
+                "selector": {"app": name},
+                "ports": [{"protocol": "TCP", "port": 27017, "targetPort": 27017}],
+            },
+        }
+    )
+    kopf.adopt(service.to_dict())
+    await service.async_create()
+
+
 async def create_stateful_set(name, namespace, spec):
     """
     Create a StatefulSet for the MongoDB instance.
@@ -94,6 +275,117 @@ async def create_stateful_set(name, namespace, spec):
     running and healthy.
     """
     credentials_secret = spec.get("credentialsSecret")
+    container = {
+        "name": name,
+        "image": f"mongo:{spec.get('version', 'latest')}",
+        "ports": [{"containerPort": 27017}],
+        "readinessProbe": READINESS_PROBE,
+        "volumeMounts": [{"mountPath": "/data/db", "name": "storage"}],
+        "env": [
+            {
+                "name": "MONGO_INITDB_ROOT_USERNAME",
+                "valueFrom": {
+                    "secretKeyRef": {
+                        "name": credentials_secret,
+                        "key": "username",
+                    }
+                },
+            },
+            {
+                "name": "MONGO_INITDB_ROOT_PASSWORD",
+                "valueFrom": {
+                    "secretKeyRef": {
+                        "name": credentials_secret,
+                        "key": "password",
+                    }
+                },
+            },
+        ],
+    }
+    pod_spec = {
+        "containers": [container],
+        "volumes": [
+            {
+                "name": "storage",
+                "persistentVolumeClaim": {"claimName": f"{name}-pvc"},
+            }
+        ],
+    }
+    stateful_set_spec = {
+        "serviceName": name,
+        "replicas": 1,
+        "minReadySeconds": 10,
+        "updateStrategy": {"type": "RollingUpdate"},
+        "selector": {"matchLabels": {"app": name}},
+        "template": {
+            "metadata": {"labels": {"app": name}},
+            "spec": pod_spec,
+        },
+    }
+    if is_replica_set(spec):
+        # mongod refuses keyfiles readable by other users, the secret is copied to an
+        # emptyDir owned by the mongodb user before starting the member.
+        container["args"] = [
+            "--replSet",
+            REPLICA_SET_NAME,
+            "--bind_ip_all",
+            "--keyFile",
+            "/etc/mongo-keyfile/keyfile",
+        ]
+        container["volumeMounts"].append(
+            {"mountPath": "/etc/mongo-keyfile", "name": "keyfile"}
+        )
+        pod_spec["initContainers"] = [
+            {
+                "name": "install-keyfile",
+                "image": container["image"],
+                "command": [
+                    "sh",
+                    "-c",
+                    "cp /keyfile-secret/keyfile /etc/mongo-keyfile/keyfile"
+                    " && chmod 400 /etc/mongo-keyfile/keyfile"
+                    " && chown 999:999 /etc/mongo-keyfile/keyfile",
+                ],
+                "volumeMounts": [
+                    {"mountPath": "/keyfile-secret", "name": "keyfile-secret"},
+                    {"mountPath": "/etc/mongo-keyfile", "name": "keyfile"},
+                ],
+            }
+        ]
+        pod_spec["volumes"] = [
+            {"name": "keyfile-secret", "secret": {"secretName": f"{name}-keyfile"}},
+            {"name": "keyfile", "emptyDir": {}},
+        ]
+        stateful_set_spec["serviceName"] = f"{name}-headless"
+        stateful_set_spec["persistentVolumeClaimRetentionPolicy"] = {
+            "whenDeleted": "Delete",
+            "whenScaled": "Retain",
+        }
+        stateful_set_spec["replicas"] = spec["members"]
+        stateful_set_spec["volumeClaimTemplates"] = [
+            {
+                "metadata": {"name": "storage"},
+                "spec": {
+                    "accessModes": ["ReadWriteOnce"],
+                    "resources": {
+                        "requests": {"storage": spec.get("storageSize", "1Gi")}
+                    },
+                },
+            }
+        ]
+    if ROUTING_MODE == "router":
+        # The router forwards the TLS connections as is, so mongod terminates TLS using the
+        # certificate of the router domain. Plain connections are still accepted in-cluster.
+        container["args"] = container.get("args", []) + [
+            "--tlsMode",
+            "allowTLS",
+            "--tlsCertificateKeyFile",
+            "/etc/mongo-tls/tls.pem",
+        ]
+        container["volumeMounts"].append({"mountPath": "/etc/mongo-tls", "name": "tls"})
+        pod_spec["volumes"].append(
+            {"name": "tls", "secret": {"secretName": ROUTER_TLS_SECRET}}
+        )
     stateful_set = StatefulSet(
         {
             "apiVersion": "apps/v1",
@@ -102,147 +394,918 @@ async def create_stateful_set(name, namespace, spec):
                 "name": name,
                 "namespace": namespace,
             },
-            "spec": {
-                "serviceName": name,
-                "replicas": 1,
-                "selector": {"matchLabels": {"app": name}},
-                "template": {
-                    "metadata": {"labels": {"app": name}},
-                    "spec": {
-                        "containers": [
-                            {
-                                "name": name,
-                                "image": f"mongo:{spec.get('version', 'latest')}",
-                                "ports": [{"containerPort": 27017}],
-                                "volumeMounts": [
-                                    {"mountPath": "/data/db", "name": "storage"}
-                                ],
-                                "env": [
-                                    {
-                                        "name": "MONGO_INITDB_ROOT_USERNAME",
-                                        "valueFrom": {
-                                            "secretKeyRef": {
-                                                "name": credentials_secret,
-                                                "key": "username",
-                                            }
-                                        },
-                                    },
-                                    {
-                                        "name": "MONGO_INITDB_ROOT_PASSWORD",
-                                        "valueFrom": {
-                                            "secretKeyRef": {
-                                                "name": credentials_secret,
-                                                "key": "password",
-                                            }
-                                        },
-                                    },
-                                ],
-                            }
-                        ],
-                        "volumes": [
-                            {
-                                "name": "storage",
-                                "persistentVolumeClaim": {"claimName": f"{name}-pvc"},
-                            }
-                        ],
-                    },
-                },
-            },
+            "spec": stateful_set_spec,
         }
     )
     kopf.adopt(stateful_set.to_dict())
     await stateful_set.async_create()
 
 
-async def setup_mongo_instance(name, namespace, spec):
+async def storage_expandable(name, namespace, spec):
     """
-    Setup the MongoDB instance by creating the necessary resources.
+    Whether the PersistentVolumeClaims of the MongoDB instance can be expanded, which their
+    storage class has to allow. The static hostPath volumes of standalone instances have no
+    storage class, so they can't.
     """
-    await create_storage(name, namespace, spec)
-    await create_stateful_set(name, namespace, spec)
-    return await create_external_service(name, namespace)
+    for pvc_name in pvc_names(name, spec):
+        pvc = await PersistentVolumeClaim.async_get(pvc_name, namespace=namespace)
+        class_name = pvc.spec.get("storageClassName")
+        if not class_name:
+            return False
+        storage_class = await StorageClassResource.async_get(class_name)
+        if not storage_class.raw.get("allowVolumeExpansion"):
+            return False
+    return True
 
 
-async def teardown_mongo_instance(name, namespace):
+async def resize_storage(name, namespace, spec):
     """
-    Teardown the MongoDB instance by deleting the resources.
+    Expand the PersistentVolumeClaims of the MongoDB instance in place. This only succeeds when
+    the storage class of the claims allows volume expansion.
     """
-    # Delete StatefulSet
-    try:
-        stateful_set = StatefulSet(
+    if not await storage_expandable(name, namespace, spec):
+        raise kopf.PermanentError("Storage of the instance can't be expanded")
+    for pvc_name in pvc_names(name, spec):
+        pvc = PersistentVolumeClaim(
             {
-                "apiVersion": "apps/v1",
-                "kind": "StatefulSet",
-                "metadata": {"name": name, "namespace": namespace},
+                "apiVersion": "v1",
+                "kind": "PersistentVolumeClaim",
+                "metadata": {"name": pvc_name, "namespace": namespace},
             }
         )
-        await stateful_set.async_delete()
-    except Exception as e:
-        logger.warning(f"Error deleting StatefulSet: {e}")
+        try:
+            await pvc.async_patch(
+                {"spec": {"resources": {"requests": {"storage": spec["storageSize"]}}}}
+            )
+        except ServerError as e:
+            raise kopf.PermanentError(f"Storage can't be expanded: {e}")
 
-    # Delete Service
-    try:
-        service = Service(
-            {
-                "apiVersion": "v1",
-                "kind": "Service",
-                "metadata": {"name": name, "namespace": namespace},
+
+async def scale_stateful_set(name, namespace, replicas):
+    """
+    Change the number of pods of the MongoDB instance. When adding members, the replica set
+    configuration is updated by the reconciler once they are running. When removing members,
+    the reconciler removes them from the configuration before calling this, so the remaining
+    members keep a majority.
+    """
+    stateful_set = StatefulSet(
+        {
+            "apiVersion": "apps/v1",
+            "kind": "StatefulSet",
+            "metadata": {"name": name, "namespace": namespace},
+        }
+    )
+    await stateful_set.async_patch({"spec": {"replicas": replicas}})
+
+
+async def hibernate_on_node(name, namespace, node_name):
+    """
+    Scale the MongoDB instance to zero, pinning its pod to the node holding its hostPath data,
+    so it wakes up on that node and not on an empty one.
+    """
+    stateful_set = StatefulSet(
+        {
+            "apiVersion": "apps/v1",
+            "kind": "StatefulSet",
+            "metadata": {"name": name, "namespace": namespace},
+        }
+    )
+    affinity = {
+        "nodeAffinity": {
+            "requiredDuringSchedulingIgnoredDuringExecution": {
+                "nodeSelectorTerms": [
+                    {
+                        "matchFields": [
+                            {
+                                "key": "metadata.name",
+                                "operator": "In",
+                                "values": [node_name],
+                            }
+                        ]
+                    }
+                ]
             }
-        )
-        await service.async_delete()
-    except Exception as e:
-        logger.warning(f"Error deleting Service: {e}")
+        }
+    }
+    await stateful_set.async_patch(
+        {"spec": {"replicas": 0, "template": {"spec": {"affinity": affinity}}}}
+    )
 
-    try:
-        # Delete PersistentVolumeClaim
-        pvc = PersistentVolumeClaim(
+
+async def upgrade_version(name, namespace, version):
+    """
+    Roll the StatefulSet of the MongoDB instance to a new image. Pods are replaced one at a time
+    and the rollout only moves forward once the replaced pod passes its readiness probe.
+    """
+    stateful_set = StatefulSet(
+        {
+            "apiVersion": "apps/v1",
+            "kind": "StatefulSet",
+            "metadata": {"name": name, "namespace": namespace},
+        }
+    )
+    await stateful_set.async_patch(
+        [
             {
-                "apiVersion": "v1",
-                "kind": "PersistentVolumeClaim",
-                "metadata": {"name": f"{name}-pvc", "namespace": namespace},
-            }
+                "op": "replace",
+                "path": "/spec/template/spec/containers/0/image",
+                "value": f"mongo:{version}",
+            },
+            {
+                "op": "add",
+                "path": "/spec/template/spec/containers/0/readinessProbe",
+                "value": READINESS_PROBE,
+            },
+        ],
+        type="json",
+    )
+
+
+async def setup_mongo_instance(name, namespace, spec):
+    """
+    Setup the MongoDB instance by creating the necessary resources.
+    """
+    snapshot_status = {}
+    if spec.get("fromSnapshot"):
+        if is_replica_set(spec):
+            raise kopf.PermanentError("Replica sets can't be cloned from snapshots")
+        snapshot = await MongoSnapshotResource.async_get(
+            spec["fromSnapshot"], namespace=namespace
         )
-        await pvc.async_delete()
-    except Exception as e:
-        logger.warning(f"Error deleting PersistentVolumeClaim: {e}")
+        snapshot_status = snapshot.raw.get("status", {})
+        if snapshot_status.get("phase") != "Ready":
+            raise kopf.TemporaryError("Snapshot is not ready yet", delay=30)
 
+    if is_replica_set(spec):
+        await create_keyfile_secret(name, namespace)
+        await create_headless_service(name, namespace)
+    elif snapshot_status.get("method") == "VolumeSnapshot":
+        await create_storage_from_snapshot(name, namespace, spec, snapshot_status)
+    else:
+        await create_storage(name, namespace, spec)
+    await create_stateful_set(name, namespace, spec)
+    if snapshot_status.get("method") == "Dump":
+        await create_restore_job(name, namespace, spec, snapshot_status)
+    return await create_external_service(name, namespace, spec)
+
+
+async def create_cleanup_job(name, namespace, node_name):
+    """
+    Create a job deleting the hostPath data of the MongoDB instance from the node where it ran.
+    The job is created once the pod of the instance is gone, so mongod isn't writing anymore.
+    """
+    job = Job(
+        {
+            "apiVersion": "batch/v1",
+            "kind": "Job",
+            "metadata": {"name": f"{name}-cleanup", "namespace": namespace},
+            "spec": {
+                "backoffLimit": 2,
+                "activeDeadlineSeconds": 900,
+                "ttlSecondsAfterFinished": 300,
+                "template": {
+                    "spec": {
+                        "restartPolicy": "Never",
+                        "nodeName": node_name,
+                        "containers": [
+                            {
+                                "name": "cleanup",
+                                "image": "busybox",
+                                "command": ["rm", "-rf", f"/data/{name}"],
+                                "volumeMounts": [{"mountPath": "/data", "name": "data"}],
+                            }
+                        ],
+                        "volumes": [{"name": "data", "hostPath": {"path": "/data"}}],
+                    }
+                },
+            },
+        }
+    )
     try:
-        # Delete PersistentVolume
-        pv = PersistentVolume(
-            {
-                "apiVersion": "v1",
-                "kind": "PersistentVolume",
-                "metadata": {"name": f"{name}-pv"},
-            }
-        )
-        await pv.async_delete()
-    except Exception as e:
-        logger.warning(f"Error deleting PersistentVolume: {e}")
+        await job.async_create()
+    except ServerError as e:
+        # Created by a previous attempt of the handler
+        if not e.response or e.response.status_code != 409:
+            raise
+
+
+async def stop_instance_pod(name, namespace):
+    """
+    Scale the MongoDB instance to zero and wait until its pod is gone. The pod is terminated
+    whether mongod shuts down cleanly or not, unlike its lock file which is left behind by an
+    unclean shutdown.
+    """
+    try:
+        await scale_stateful_set(name, namespace, 0)
+    except NotFoundError:
+        pass
+    try:
+        await Pod.async_get(f"{name}-0", namespace=namespace)
+    except NotFoundError:
+        return
+    raise kopf.TemporaryError(f"Waiting for the pod of '{name}' to terminate", delay=5)
+
+
+async def teardown_mongo_instance(name, namespace, spec, status):
+    """
+    Teardown the MongoDB instance releasing its hostPath storage. The rest of the resources are
+    owned by the MongoInstance and deleted by the Kubernetes garbage collector once this
+    handler releases the finalizer. The data is deleted from the node recorded in the status
+    when the instance first ran, which is known even if the instance is hibernated.
+    """
+    if is_replica_set(spec):
+        # Replica set members use dynamically provisioned volumes
+        return
+
+    try:
+        pv = await PersistentVolume.async_get(f"{name}-pv")
+    except NotFoundError:
+        return
+    if pv.raw.get("status", {}).get("phase") in ("Bound", "Released"):
+        node_name = status.get("nodeName") or pv.annotations.get(NODE_ANNOTATION)
+        if node_name is None:
+            # Instances created before the node was recorded, it is recorded on the volume
+            # as the pod is gone when the handler is retried
+            try:
+                pod = await Pod.async_get(f"{name}-0", namespace=namespace)
+                node_name = pod.spec["nodeName"]
+                await pv.async_patch(
+                    {"metadata": {"annotations": {NODE_ANNOTATION: node_name}}}
+                )
+            except NotFoundError:
+                pass
+        if node_name:
+            await stop_instance_pod(name, namespace)
+            await create_cleanup_job(name, namespace, node_name)
+        else:
+            logger.warning(f"Node of '{name}' is unknown, its data has to be deleted manually")
+    await pv.async_delete()
 
 
 @kopf.on.create("mongo.miguelgarcia.dev", "v1", "mongoinstances")
 async def create_mongo(spec, name, namespace, logger, patch, resource, **kwargs):
     logger.info(f"Creating MongoDB instance '{name}' in namespace '{namespace}'")
     service = await setup_mongo_instance(name, namespace, spec)
+    if ROUTING_MODE == "router":
+        hostname = f"{name}.{ROUTER_DOMAIN}"
+        logger.info(f"MongoDB instance '{name}' on host {hostname} created successfully")
+        patch.status["hostname"] = hostname
+        patch.status["port"] = ROUTER_PORT
+        return
     await service.async_refresh()
     port = service.spec.ports[0].nodePort
     logger.info(f"MongoDB instance '{name}' on port {port} created successfully")
     patch.status["port"] = port
 
 
-@kopf.on.update("mongo.miguelgarcia.dev", "v1", "mongoinstances")
-async def update_mongo(spec, name, namespace, logger, **kwargs):
-    logger.warning("Not implemented")
+@kopf.on.update("mongo.miguelgarcia.dev", "v1", "mongoinstances", field="spec")
+async def update_mongo(old, new, status, name, namespace, logger, patch, **kwargs):
+    old = old or {}
+    # The version is rolled out first, so it isn't held back when the storage can't be expanded
+    if new.get("version") != old.get("version"):
+        logger.info(f"Rolling out version {new.get('version')} of '{name}'")
+        await upgrade_version(name, namespace, new.get("version"))
+        patch.status["rollout"] = {"version": new.get("version"), "state": "InProgress"}
+    if new.get("storageSize") != old.get("storageSize"):
+        logger.info(f"Resizing storage of '{name}' to {new.get('storageSize')}")
+        await resize_storage(name, namespace, new)
+        patch.status["storageSize"] = new.get("storageSize")
+    if new.get("members", 1) != old.get("members", 1):
+        if not is_replica_set(old) or not is_replica_set(new):
+            raise kopf.PermanentError(
+                "Standalone instances can't be converted to replica sets"
+            )
+        if new["members"] < old.get("members", 1):
+            # The reconciler removes the members from the replica set, then the pods
+            logger.info(f"Removing members of replica set '{name}' down to {new['members']}")
+        elif not new.get("hibernated"):
+            logger.info(f"Scaling replica set '{name}' to {new['members']} members")
+            await scale_stateful_set(name, namespace, new["members"])
+    if new.get("hibernated", False) != old.get("hibernated", False):
+        if new.get("hibernated") and is_replica_set(new):
+            logger.info(f"Hibernating '{name}'")
+            await scale_stateful_set(name, namespace, 0)
+        elif new.get("hibernated"):
+            # The data of standalone instances is on the node they ran on
+            if not status.get("nodeName"):
+                raise kopf.TemporaryError(
+                    f"Node of '{name}' not known yet, can't hibernate it", delay=30
+                )
+            logger.info(f"Hibernating '{name}' on node {status['nodeName']}")
+            await hibernate_on_node(name, namespace, status["nodeName"])
+        else:
+            logger.info(f"Waking up '{name}'")
+            await scale_stateful_set(name, namespace, new.get("members", 1))
+            patch.status["wakeRequestedAt"] = datetime.now(tz=timezone.utc).isoformat()
+        patch.status["hibernated"] = new.get("hibernated")
 
 
 @kopf.on.delete("mongo.miguelgarcia.dev", "v1", "mongoinstances")
-async def delete_mongo(name, namespace, logger, **kwargs):
+async def delete_mongo(spec, status, name, namespace, logger, **kwargs):
     logger.info(f"Deleting MongoDB instance '{name}' in namespace '{namespace}'")
-    await teardown_mongo_instance(name, namespace)
-    # Example: Log spec or validate it
+    await teardown_mongo_instance(name, namespace, spec, status)
     logger.info(f"Instance '{name}' is being deleted")
 
 
+async def read_credentials(secret_name, namespace):
+    """Returns the root username and password stored in the credentials secret."""
+    secret = await Secret.async_get(secret_name, namespace=namespace)
+    return (
+        b64decode(secret.data["username"]).decode(),
+        b64decode(secret.data["password"]).decode(),
+    )
+
+
+def mongo_client(*args, **kwargs):
+    """Returns a client for MongoDB instances. pymongo is imported on first use, as it isn't
+    needed to start the operator and most handlers don't connect to the instances."""
+    from pymongo import AsyncMongoClient
+
+    return AsyncMongoClient(*args, **kwargs)
+
+
+def replica_set_members_config(config_members, hosts):
+    """
+    Computes the members of the replica set configuration for the desired hosts. Members are
+    added or removed one at a time, as required by `replSetReconfig`, keeping the ids of the
+    existing members.
+    """
+    current = [member for member in config_members if member["host"] in hosts]
+    if len(current) < len(config_members):
+        removed = next(m for m in config_members if m["host"] not in hosts)
+        return [m for m in config_members if m is not removed]
+    configured = {member["host"] for member in current}
+    missing = [host for host in hosts if host not in configured]
+    if missing:
+        next_id = max((member["_id"] for member in current), default=-1) + 1
+        return current + [{"_id": next_id, "host": missing[0]}]
+    return config_members
+
+
+@kopf.timer(
+    "mongo.miguelgarcia.dev",
+    "v1",
+    "mongoinstances",
+    interval=30,
+    when=lambda spec, **_: is_replica_set(spec),
+)
+async def reconcile_replica_set(spec, name, namespace, logger, patch, **kwargs):
+    """
+    Initiate the replica set once the members are running, keep its configuration in sync with
+    the desired number of members and report the primary and the members health. Members are
+    removed from the configuration one at a time, stepping down the primary if it is one of
+    them, and their pods are only removed once none of them is in the configuration.
+    """
+    from pymongo.errors import OperationFailure
+
+    username, password = await read_credentials(spec["credentialsSecret"], namespace)
+    hosts = member_hosts(name, namespace, spec["members"])
+    client = mongo_client(
+        hosts[0],
+        username=username,
+        password=password,
+        directConnection=True,
+        serverSelectionTimeoutMS=5000,
+    )
+    try:
+        try:
+            rs_status = await client.admin.command("replSetGetStatus")
+        except OperationFailure as e:
+            if e.code != NOT_YET_INITIALIZED:
+                raise
+            logger.info(f"Initiating replica set of '{name}'")
+            await client.admin.command(
+                "replSetInitiate",
+                {
+                    "_id": REPLICA_SET_NAME,
+                    "members": [{"_id": i, "host": h} for i, h in enumerate(hosts)],
+                },
+            )
+            return
+    finally:
+        await client.close()
+
+    client = mongo_client(
+        hosts,
+        username=username,
+        password=password,
+        replicaSet=REPLICA_SET_NAME,
+        serverSelectionTimeoutMS=5000,
+    )
+    try:
+        config = (await client.admin.command("replSetGetConfig"))["config"]
+        members = replica_set_members_config(config["members"], hosts)
+        primary = next(
+            (m["name"] for m in rs_status["members"] if m["stateStr"] == "PRIMARY"), None
+        )
+        removed = {m["host"] for m in config["members"]} - {m["host"] for m in members}
+        if primary in removed:
+            logger.info(f"Stepping down primary {primary} of '{name}' before removing it")
+            await client.admin.command("replSetStepDown", 60)
+            return
+        if members != config["members"]:
+            logger.info(f"Reconfiguring replica set of '{name}'")
+            config["members"] = members
+            config["version"] += 1
+            await client.admin.command("replSetReconfig", config)
+    finally:
+        await client.close()
+
+    await label_member_roles(name, namespace, spec, rs_status["members"], logger)
+
+    if len(members) == len(hosts):
+        stateful_set = await StatefulSet.async_get(name, namespace=namespace)
+        if stateful_set.spec.get("replicas", 0) > len(hosts):
+            logger.info(f"Scaling replica set '{name}' to {len(hosts)} members")
+            await scale_stateful_set(name, namespace, len(hosts))
+
+    patch.status["replicaSet"] = {
+        "name": REPLICA_SET_NAME,
+        "primary": primary,
+        "members": [
+            {"host": m["name"], "state": m["stateStr"], "health": m["health"]}
+            for m in rs_status["members"]
+        ],
+    }
+
+
+async def label_member_roles(name, namespace, spec, members, logger):
+    """
+    Label the pods of the replica set members with their role, so the service of the replica set
+    follows the primary after a failover.
+    """
+    relabeled = False
+    for member in members:
+        role = "primary" if member["stateStr"] == "PRIMARY" else "secondary"
+        try:
+            pod = await Pod.async_get(member["name"].split(".")[0], namespace=namespace)
+        except NotFoundError:
+            continue
+        if pod.labels.get(ROLE_LABEL) != role:
+            await pod.async_patch({"metadata": {"labels": {ROLE_LABEL: role}}})
+            relabeled = True
+    if relabeled:
+        logger.info(f"Relabeled the members of '{name}' with their roles")
+        # Services of replica sets created before the primary was labeled selected every member
+        service = await Service.async_get(name, namespace=namespace)
+        await service.async_patch({"spec": {"selector": service_selector(name, spec)}})
+
+
+def instance_host(name, namespace, spec):
+    """In-cluster address of the member holding the data captured by snapshots."""
+    if is_replica_set(spec):
+        return member_hosts(name, namespace, spec["members"])[0]
+    return f"{name}.{namespace}.svc.cluster.local:27017"
+
+
+def primary_client(name, namespace, spec, username, password):
+    """Returns a client for the standalone instance or the primary of the replica set."""
+    if is_replica_set(spec):
+        return mongo_client(
+            member_hosts(name, namespace, spec["members"]),
+            username=username,
+            password=password,
+            appname=OPERATOR_APP_NAME,
+            replicaSet=REPLICA_SET_NAME,
+            serverSelectionTimeoutMS=5000,
+        )
+    return mongo_client(
+        instance_host(name, namespace, spec),
+        username=username,
+        password=password,
+        appname=OPERATOR_APP_NAME,
+        directConnection=True,
+        serverSelectionTimeoutMS=5000,
+    )
+
+
+def feature_compatibility_version(version):
+    """Feature compatibility version matching a MongoDB version like `7.0.14`."""
+    return ".".join(version.split(".")[:2])
+
+
+@kopf.timer(
+    "mongo.miguelgarcia.dev",
+    "v1",
+    "mongoinstances",
+    interval=30,
+    when=lambda spec, status, **_: status.get("availableReplicas")
+    and status.get("rollout", {}).get("state") != "InProgress"
+    and status.get("versionOf") != spec.get("version"),
+)
+async def finish_version_rollout(spec, name, namespace, logger, patch, **kwargs):
+    """
+    Report the version running once a rollout completes, raising the feature compatibility
+    version to it first. mongod refuses to start the next major release on data whose feature
+    compatibility version is older than the previous one, so the next upgrade needs it.
+    """
+    username, password = await read_credentials(spec["credentialsSecret"], namespace)
+    client = primary_client(name, namespace, spec, username, password)
+    try:
+        running_version = (await client.admin.command("buildInfo"))["version"]
+        target = feature_compatibility_version(running_version)
+        parameter = await client.admin.command(
+            "getParameter", featureCompatibilityVersion=1
+        )
+        current = parameter["featureCompatibilityVersion"]["version"]
+        if tuple(map(int, current.split("."))) < tuple(map(int, target.split("."))):
+            logger.info(f"Raising feature compatibility version of '{name}' to {target}")
+            command = {"setFeatureCompatibilityVersion": target}
+            if int(target.split(".")[0]) >= 7:
+                command["confirm"] = True
+            await client.admin.command(command)
+    finally:
+        await client.close()
+    patch.status["runningVersion"] = running_version
+    patch.status["featureCompatibilityVersion"] = target
+    patch.status["versionOf"] = spec.get("version")
+
+
+def credentials_env(credentials_secret):
+    """Environment variables exposing the root credentials to the dump and restore jobs."""
+    return [
+        {
+            "name": f"MONGO_{key.upper()}",
+            "valueFrom": {"secretKeyRef": {"name": credentials_secret, "key": key}},
+        }
+        for key in ("username", "password")
+    ]
+
+
+async def create_volume_snapshot(name, namespace, instance):
+    """
+    Create a CSI VolumeSnapshot of the instance volume. Writes are flushed and blocked with
+    `fsyncLock` until the snapshot is cut, so the snapshot is consistent without stopping
+    the instance.
+    """
+    volume_snapshot = VolumeSnapshotResource(
+        {
+            "apiVersion": "snapshot.storage.k8s.io/v1",
+            "kind": "VolumeSnapshot",
+            "metadata": {"name": name, "namespace": namespace},
+            "spec": {
+                "source": {
+                    "persistentVolumeClaimName": pvc_names(
+                        instance.name, instance.spec
+                    )[0]
+                },
+            },
+        }
+    )
+    if VOLUME_SNAPSHOT_CLASS:
+        volume_snapshot.raw["spec"]["volumeSnapshotClassName"] = VOLUME_SNAPSHOT_CLASS
+    kopf.adopt(volume_snapshot.raw)
+
+    username, password = await read_credentials(
+        instance.spec["credentialsSecret"], namespace
+    )
+    client = mongo_client(
+        instance_host(instance.name, namespace, instance.spec),
+        username=username,
+        password=password,
+        directConnection=True,
+        serverSelectionTimeoutMS=5000,
+    )
+    try:
+        await client.admin.command("fsync", lock=True)
+        try:
+            await volume_snapshot.async_create()
+            for _ in range(60):
+                await volume_snapshot.async_refresh()
+                if volume_snapshot.raw.get("status", {}).get("creationTime"):
+                    break
+                await asyncio.sleep(1)
+        finally:
+            await client.admin.command("fsyncUnlock")
+    finally:
+        await client.close()
+
+
+async def create_dump_job(name, namespace, instance):
+    """
+    Fallback for clusters without volume snapshots: stream a compressed `mongodump` archive in
+    fixed size chunks to a dedicated volume.
+    """
+    archive_pvc = PersistentVolumeClaim(
+        {
+            "apiVersion": "v1",
+            "kind": "PersistentVolumeClaim",
+            "metadata": {"name": f"{name}-archive", "namespace": namespace},
+            "spec": {
+                "accessModes": ["ReadWriteOnce"],
+                "resources": {
+                    "requests": {"storage": instance.spec.get("storageSize", "1Gi")}
+                },
+            },
+        }
+    )
+    kopf.adopt(archive_pvc.raw)
+    await archive_pvc.async_create()
+    host = instance_host(instance.name, namespace, instance.spec)
+    job = Job(
+        {
+            "apiVersion": "batch/v1",
+            "kind": "Job",
+            "metadata": {"name": f"{name}-dump", "namespace": namespace},
+            "spec": {
+                "backoffLimit": 2,
+                "template": {
+                    "spec": {
+                        "restartPolicy": "Never",
+                        "containers": [
+                            {
+                                "name": "dump",
+                                "image": f"mongo:{instance.spec.get('version', 'latest')}",
+                                "command": [
+                                    "bash",
+                                    "-c",
+                                    "set -o pipefail; rm -f /archive/archive.gz.part-*;"
+                                    f" mongodump --host={host}"
+                                    ' --username="$MONGO_USERNAME" --password="$MONGO_PASSWORD"'
+                                    " --authenticationDatabase=admin --archive --gzip"
+                                    f" | split -b {ARCHIVE_CHUNK_SIZE} - /archive/archive.gz.part-",
+                                ],
+                                "env": credentials_env(instance.spec["credentialsSecret"]),
+                                "volumeMounts": [
+                                    {"mountPath": "/archive", "name": "archive"}
+                                ],
+                            }
+                        ],
+                        "volumes": [
+                            {
+                                "name": "archive",
+                                "persistentVolumeClaim": {
+                                    "claimName": f"{name}-archive"
+                                },
+                            }
+                        ],
+                    }
+                },
+            },
+        }
+    )
+    kopf.adopt(job.raw)
+    await job.async_create()
+
+
+async def create_restore_job(name, namespace, spec, snapshot_status):
+    """
+    Restore the archive of a dump snapshot into a new instance once it accepts connections.
+    """
+    host = f"{name}.{namespace}.svc.cluster.local:27017"
+    job = Job(
+        {
+            "apiVersion": "batch/v1",
+            "kind": "Job",
+            "metadata": {"name": f"{name}-restore", "namespace": namespace},
+            "spec": {
+                "backoffLimit": 2,
+                "template": {
+                    "spec": {
+                        "restartPolicy": "Never",
+                        "containers": [
+                            {
+                                "name": "restore",
+                                "image": f"mongo:{spec.get('version', 'latest')}",
+                                "command": [
+                                    "bash",
+                                    "-c",
+                                    "set -o pipefail;"
+                                    f" until mongosh --host={host} --quiet"
+                                    " --eval 'db.adminCommand(\"ping\")'; do sleep 2; done;"
+                                    " cat /archive/archive.gz.part-* | mongorestore"
+                                    f" --host={host}"
+                                    ' --username="$MONGO_USERNAME" --password="$MONGO_PASSWORD"'
+                                    " --authenticationDatabase=admin --archive --gzip",
+                                ],
+                                "env": credentials_env(spec["credentialsSecret"]),
+                                "volumeMounts": [
+                                    {
+                                        "mountPath": "/archive",
+                                        "name": "archive",
+                                        "readOnly": True,
+                                    }
+                                ],
+                            }
+                        ],
+                        "volumes": [
+                            {
+                                "name": "archive",
+                                "persistentVolumeClaim": {
+                                    "claimName": snapshot_status["archive"]
+                                },
+                            }
+                        ],
+                    }
+                },
+            },
+        }
+    )
+    kopf.adopt(job.raw)
+    await job.async_create()
+
+
+async def read_activity(name, namespace, spec):
+    """
+    Returns the number of client operations served by the instance and the number of clients
+    currently connected to it.
+    """
+    username, password = await read_credentials(spec["credentialsSecret"], namespace)
+    client = mongo_client(
+        instance_host(name, namespace, spec),
+        username=username,
+        password=password,
+        appname=OPERATOR_APP_NAME,
+        directConnection=True,
+        serverSelectionTimeoutMS=5000,
+    )
+    try:
+        server_status = await client.admin.command("serverStatus")
+        cursor = await client.admin.aggregate(
+            [
+                {"$currentOp": {"allUsers": True, "idleConnections": True}},
+                {"$match": {"client": {"$exists": True}}},
+                {"$match": {"appName": {"$ne": OPERATOR_APP_NAME}}},
+                {"$count": "clients"},
+            ]
+        )
+        result = await cursor.to_list()
+    finally:
+        await client.close()
+    operations = sum(server_status["opcounters"][op] for op in ACTIVITY_OPCOUNTERS)
+    return operations, result[0]["clients"] if result else 0
+
+
+@kopf.timer(
+    "mongo.miguelgarcia.dev",
+    "v1",
+    "mongoinstances",
+    interval=60,
+    when=lambda spec, status, **_: HIBERNATE_AFTER_SECONDS > 0
+    and not spec.get("hibernated")
+    and not is_replica_set(spec)
+    and status.get("availableReplicas")
+    and status.get("nodeName"),
+)
+async def detect_idle_instance(spec, status, name, namespace, logger, patch, **kwargs):
+    """
+    Hibernate instances without connected clients nor operations for HIBERNATE_AFTER_SECONDS.
+    The StatefulSet is scaled to zero while its volume is kept, and its pod is pinned to the
+    node recorded in `nodeName`, which holds the data.
+    """
+    operations, clients = await read_activity(name, namespace, spec)
+    now = datetime.now(tz=timezone.utc)
+    idle = status.get("idle", {})
+    if clients or operations != idle.get("operations"):
+        patch.status["idle"] = {"operations": operations, "since": now.isoformat()}
+        return
+    idle_seconds = (now - datetime.fromisoformat(idle["since"])).total_seconds()
+    if idle_seconds >= HIBERNATE_AFTER_SECONDS:
+        logger.info(f"Instance '{name}' idle for {idle_seconds:.0f}s, hibernating")
+        patch.spec["hibernated"] = True
+
+
+async def volume_is_csi(pvc_name, namespace):
+    """
+    Whether the claim is bound to a volume provisioned by a CSI driver, the only volumes that
+    can be snapshotted. Statically provisioned volumes, like the hostPath ones of standalone
+    instances, are dumped instead.
+    """
+    pvc = await PersistentVolumeClaim.async_get(pvc_name, namespace=namespace)
+    volume_name = pvc.spec.get("volumeName")
+    if not volume_name:
+        return False
+    pv = await PersistentVolume.async_get(volume_name)
+    return "csi" in pv.spec
+
+
+async def copy_credentials(name, namespace, credentials_secret):
+    """
+    Copy the credentials of the instance to a secret owned by the snapshot, so clones keep
+    them once the instance and its secret are deleted.
+    """
+    source = await Secret.async_get(credentials_secret, namespace=namespace)
+    secret = Secret(
+        {
+            "apiVersion": "v1",
+            "kind": "Secret",
+            "metadata": {"name": f"{name}-credentials", "namespace": namespace},
+            "type": "Opaque",
+            "data": dict(source.raw["data"]),
+        }
+    )
+    kopf.adopt(secret.raw)
+    try:
+        await secret.async_create()
+    except ServerError as e:
+        # Already copied by a previous attempt of the handler
+        if not e.response or e.response.status_code != 409:
+            raise
+    return secret.name
+
+
+async def fall_back_to_dump(name, namespace, spec, patch):
+    """Dump the instance of a snapshot whose volume snapshot failed."""
+    try:
+        instance = await MongoInstanceResource.async_get(
+            spec["instance"], namespace=namespace
+        )
+    except NotFoundError:
+        patch.status["phase"] = "Failed"
+        return
+    if instance.spec.get("hibernated"):
+        patch.status["phase"] = "Failed"
+        return
+    await create_dump_job(name, namespace, instance)
+    patch.status["method"] = "Dump"
+    patch.status["archive"] = f"{name}-archive"
+
+
+@kopf.on.create("mongo.miguelgarcia.dev", "v1", "mongosnapshots")
+async def create_snapshot(spec, name, namespace, logger, patch, **kwargs):
+    """
+    Take a snapshot of the instance. The snapshot has its own lifecycle: it outlives the
+    instance, keeping a copy of its credentials, and records the spec of the instance for the
+    clones.
+    """
+    instance = await MongoInstanceResource.async_get(
+        spec["instance"], namespace=namespace
+    )
+    if instance.spec.get("hibernated"):
+        # The instance can't be locked nor dumped without a running pod
+        logger.error(f"Snapshot '{name}' rejected, '{instance.name}' is hibernated")
+        patch.status["phase"] = "Failed"
+        return
+    patch.status["credentialsSecret"] = await copy_credentials(
+        name, namespace, instance.spec["credentialsSecret"]
+    )
+    patch.status["source"] = {
+        "storageSize": instance.spec.get("storageSize", "1Gi"),
+        "version": instance.spec.get("version", "latest"),
+    }
+    method = spec.get("method")
+    if method is None:
+        csi = await volume_is_csi(pvc_names(instance.name, instance.spec)[0], namespace)
+        method = "VolumeSnapshot" if csi else "Dump"
+    if method == "VolumeSnapshot":
+        try:
+            await create_volume_snapshot(name, namespace, instance)
+        except ServerError as e:
+            # The VolumeSnapshot kind is not served when the cluster has no CSI snapshot support
+            if spec.get("method") or not e.response or e.response.status_code != 404:
+                raise
+            logger.warning("Volume snapshots are not supported, falling back to a dump")
+            method = "Dump"
+    if method == "Dump":
+        await create_dump_job(name, namespace, instance)
+        patch.status["archive"] = f"{name}-archive"
+    logger.info(f"Snapshot '{name}' of '{spec['instance']}' started using {method}")
+    patch.status["method"] = method
+    patch.status["phase"] = "InProgress"
+
+
+@kopf.timer(
+    "mongo.miguelgarcia.dev",
+    "v1",
+    "mongosnapshots",
+    interval=10,
+    when=lambda status, **_: status.get("phase") == "InProgress",
+)
+async def track_snapshot(spec, name, namespace, status, logger, patch, **kwargs):
+    """
+    Mark the snapshot as ready once the volume snapshot can be restored or the dump finished.
+    Failed volume snapshots fall back to a dump unless the method was requested explicitly.
+    """
+    if status["method"] == "VolumeSnapshot":
+        volume_snapshot = await VolumeSnapshotResource.async_get(
+            name, namespace=namespace
+        )
+        snapshot_status = volume_snapshot.raw.get("status", {})
+        if snapshot_status.get("error"):
+            message = snapshot_status["error"].get("message")
+            if spec.get("method"):
+                logger.error(f"Volume snapshot '{name}' failed: {message}")
+                patch.status["phase"] = "Failed"
+            else:
+                logger.warning(
+                    f"Volume snapshot '{name}' failed, falling back to a dump: {message}"
+                )
+                await fall_back_to_dump(name, namespace, spec, patch)
+        elif snapshot_status.get("readyToUse"):
+            patch.status["phase"] = "Ready"
+            patch.status["volumeSnapshot"] = name
+            patch.status["restoreSize"] = snapshot_status.get("restoreSize")
+    else:
+        job = await Job.async_get(f"{name}-dump", namespace=namespace)
+        job_status = job.raw.get("status", {})
+        if job_status.get("succeeded"):
+            patch.status["phase"] = "Ready"
+        elif job_status.get("failed", 0) > job.spec.get("backoffLimit", 0):
+            patch.status["phase"] = "Failed"
+    if patch.status.get("phase"):
+        logger.info(f"Snapshot '{name}' is {patch.status['phase']}")
+
+
 @kopf.on.update("apps", "v1", "statefulsets", field="status")
 async def update_statefulset(meta, new, name, namespace, logger, **kwargs):
     # Check if the StatefulSet is owned by a MongoInstance resource
@@ -254,6 +1317,11 @@ async def update_statefulset(meta, new, name, namespace, logger, **kwargs):
     if not mongo_instance_ref:
         return
     available_replicas = new.get("availableReplicas", 0)
+    updated_replicas = new.get("updatedReplicas", 0)
+    rollout_complete = (
+        new.get("currentRevision") == new.get("updateRevision")
+        and updated_replicas == new.get("replicas", 0)
+    )
     logger.info(
         f"Updating MongoInstance '{mongo_instance_ref.get('name')}' with available replicas: {available_replicas}"
     )
@@ -276,12 +1344,63 @@ async def update_statefulset(meta, new, name, namespace, logger, **kwargs):
         namespace=namespace,
     )
 
+    status = {
+        "availableReplicas": available_replicas,
+        "rollout": {
+            "updatedReplicas": updated_replicas,
+            "state": "Complete" if rollout_complete else "InProgress",
+        },
+    }
+    # Standalone instances keep their data on the node where they first ran, record it so the
+    # data can be deleted with the instance even if it is hibernated by then
+    instance_status = mongo_instance.raw.get("status", {})
+    if (
+        available_replicas
+        and not is_replica_set(mongo_instance.spec)
+        and not instance_status.get("nodeName")
+    ):
+        pod = await Pod.async_get(f"{mongo_instance.name}-0", namespace=namespace)
+        status["nodeName"] = pod.spec.get("nodeName")
+        pv = PersistentVolume(
+            {
+                "apiVersion": "v1",
+                "kind": "PersistentVolume",
+                "metadata": {"name": f"{mongo_instance.name}-pv"},
+            }
+        )
+        await pv.async_patch(
+            {"metadata": {"annotations": {NODE_ANNOTATION: status["nodeName"]}}}
+        )
+    # The claims exist once the instance runs, their storage class tells if they can expand
+    if available_replicas and "storageExpandable" not in instance_status:
+        status["storageExpandable"] = await storage_expandable(
+            mongo_instance.name, namespace, mongo_instance.spec
+        )
+
+    # Track how long it took to wake up the instance from hibernation
+    wake_requested_at = instance_status.get("wakeRequestedAt")
+    if wake_requested_at and available_replicas >= new.get("replicas", 0) > 0:
+        wake_seconds = (
+            datetime.now(tz=timezone.utc) - datetime.fromisoformat(wake_requested_at)
+        ).total_seconds()
+        logger.info(f"MongoInstance '{mongo_instance.name}' woke up in {wake_seconds:.1f}s")
+        kopf.event(
+            mongo_instance.raw,
+            type="Normal",
+            reason="WokeUp",
+            message=f"Woke up from hibernation in {wake_seconds:.1f}s",
+        )
+        status["lastWakeSeconds"] = wake_seconds
+        status["wakeRequestedAt"] = None
+
     # Patch the custom resource
-    await mongo_instance.async_patch(
-        {"status": {"availableReplicas": available_replicas}}
-    )
+    await mongo_instance.async_patch({"status": status})
 
 
 if __name__ == "__main__":
-    # Run the Kopf operator loop
-    kopf.run(clusterwide=True, standalone=True)
+    # Run the Kopf operator loop, reporting its health once it has started on /healthz
+    kopf.run(
+        clusterwide=True,
+        standalone=True,
+        liveness_endpoint=os.getenv("LIVENESS_ENDPOINT", "http://0.0.0.0:8080/healthz"),
+    )
@@ -0,0 +1,284 @@
+"""This program routes MongoDB connections to the instances running on a Kubernetes cluster through
+a single port. Instances are selected using the TLS SNI hostname sent by the clients, the routing
+table is kept in memory and updated watching the MongoInstance resources."""
+
+import asyncio
+import os
+from collections import defaultdict
+from dataclasses import dataclass
+from kr8s.asyncio import get, watch
+from kr8s.asyncio.objects import new_class
+import logging
+
+# Configure root logger
+logging.basicConfig(
+    level=logging.INFO,  # Or INFO, WARNING, etc.
+    format="%(asctime)s %(levelname)s [%(name)s] %(message)s",
+)
+
+MongoInstanceResource = new_class(
+    kind="MongoInstance",
+    version="mongo.miguelgarcia.dev/v1",
+    namespaced=True,
+    plural="mongoinstances",
+)
+
+# Domain under which the instances are exposed, as <instance name>.<router domain>
+router_domain = os.getenv("ROUTER_DOMAIN")
+if not router_domain:
+    raise ValueError("ROUTER_DOMAIN environment variable is not set.")
+listen_port = int(os.getenv("LISTEN_PORT", "27017"))
+max_connections_per_tenant = int(os.getenv("MAX_CONNECTIONS_PER_TENANT", "100"))
+# Seconds to wait for hibernated instances to accept connections after waking them up
+wake_timeout = int(os.getenv("WAKE_TIMEOUT", "120"))
+# Seconds to wait before watching the instances again after the watch fails
+watch_retry_interval = int(os.getenv("WATCH_RETRY_INTERVAL", "5"))
+
+TLS_HANDSHAKE = 0x16
+TLS_CLIENT_HELLO = 0x01
+SNI_EXTENSION = 0x0000
+# Upper bound of the bytes buffered while waiting for a complete ClientHello
+MAX_CLIENT_HELLO = 16 * 1024
+
+
+@dataclass
+class Route:
+    name: str
+    namespace: str
+    host: str
+    port: int
+    hibernated: bool = False
+
+
+# Routes by tenant hostname and number of open connections by tenant hostname
+routes: dict[str, Route] = {}
+connections: dict[str, int] = defaultdict(int)
+# Connections being established, referenced until they finish so they aren't garbage collected
+connecting: set[asyncio.Task] = set()
+
+
+def parse_sni(record: bytes):
+    """
+    Returns the server name of a TLS ClientHello record or None if it doesn't include one or
+    is malformed.
+    """
+
+    def read_length(pos, size):
+        if pos + size > len(record):
+            raise ValueError("Truncated ClientHello")
+        return int.from_bytes(record[pos : pos + size], "big")
+
+    try:
+        if not record or record[0] != TLS_CLIENT_HELLO:
+            return None
+        # Skip handshake header (4), client version (2) and random (32)
+        pos = 38
+        pos += 1 + read_length(pos, 1)  # Session id
+        pos += 2 + read_length(pos, 2)  # Cipher suites
+        pos += 1 + read_length(pos, 1)  # Compression methods
+        extensions_end = min(pos + 2 + read_length(pos, 2), len(record))
+        pos += 2
+        while pos + 4 <= extensions_end:
+            extension_type = read_length(pos, 2)
+            extension_length = read_length(pos + 2, 2)
+            pos += 4
+            if extension_type == SNI_EXTENSION:
+                # Skip list length (2) and name type (1)
+                name_length = read_length(pos + 3, 2)
+                if pos + 5 + name_length > extensions_end:
+                    return None
+                return record[pos + 5 : pos + 5 + name_length].decode("ascii").lower()
+            pos += extension_length
+    except (ValueError, UnicodeDecodeError):
+        return None
+    return None
+
+
+class UpstreamProtocol(asyncio.Protocol):
+    """Connection to the instance, forwards the data received to the client."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.client.transport.write(data)
+
+    def connection_lost(self, exc):
+        self.client.transport.close()
+
+    def pause_writing(self):
+        self.client.transport.pause_reading()
+
+    def resume_writing(self):
+        self.client.transport.resume_reading()
+
+
+class ClientProtocol(asyncio.Protocol):
+    """
+    Connection from a client. The ClientHello is buffered until the tenant hostname is known,
+    afterwards the data received is handed to the upstream transport as is, without being
+    copied, and each side stops reading while the other one can't keep up.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.hostname = None
+        self.upstream = None
+        self.connect_task = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        if self.upstream:
+            self.upstream.transport.write(data)
+            return
+        self.buffer += data
+        if len(self.buffer) < 5:
+            return
+        record_length = int.from_bytes(self.buffer[3:5], "big")
+        if self.buffer[0] != TLS_HANDSHAKE or record_length > MAX_CLIENT_HELLO:
+            logging.warning("Closing connection not starting with a TLS handshake.")
+            self.transport.close()
+            return
+        if len(self.buffer) < 5 + record_length:
+            return
+        self.transport.pause_reading()
+        hostname = parse_sni(bytes(self.buffer[5 : 5 + record_length]))
+        self.connect_task = asyncio.create_task(self.connect(hostname))
+        connecting.add(self.connect_task)
+        self.connect_task.add_done_callback(connecting.discard)
+
+    async def connect(self, hostname):
+        route = routes.get(hostname)
+        if route is None:
+            logging.warning(f"No route for {hostname}.")
+            self.transport.close()
+            return
+        if connections[hostname] >= max_connections_per_tenant:
+            logging.warning(f"Too many connections to {hostname}.")
+            self.transport.close()
+            return
+        self.hostname = hostname
+        connections[hostname] += 1
+        try:
+            self.upstream = await connect_upstream(route, lambda: UpstreamProtocol(self))
+        except Exception as e:
+            logging.error(f"Error connecting to {hostname}: {e}")
+            self.transport.close()
+            return
+        if self.transport.is_closing():
+            self.upstream.transport.close()
+            return
+        self.upstream.transport.write(bytes(self.buffer))
+        self.buffer = None
+        self.transport.resume_reading()
+
+    def connection_lost(self, exc):
+        if self.connect_task:
+            self.connect_task.cancel()
+        if self.hostname:
+            connections[self.hostname] -= 1
+            if not connections[self.hostname]:
+                del connections[self.hostname]
+        if self.upstream:
+            self.upstream.transport.close()
+
+    def pause_writing(self):
+        self.upstream.transport.pause_reading()
+
+    def resume_writing(self):
+        self.upstream.transport.resume_reading()
+
+
+async def connect_upstream(route, protocol_factory):
+    """Connects to the instance, waking it up first when it is hibernated."""
+    loop = asyncio.get_running_loop()
+    if not route.hibernated:
+        _, protocol = await loop.create_connection(protocol_factory, route.host, route.port)
+        return protocol
+    logging.info(f"Waking up {route.name} on connect.")
+    instance = MongoInstanceResource(
+        {"metadata": {"name": route.name, "namespace": route.namespace}}
+    )
+    await instance.async_patch({"spec": {"hibernated": False}})
+    deadline = loop.time() + wake_timeout
+    while True:
+        try:
+            _, protocol = await loop.create_connection(
+                protocol_factory, route.host, route.port
+            )
+            return protocol
+        except OSError:
+            if loop.time() >= deadline:
+                raise
+            await asyncio.sleep(1)
+
+
+def update_route(event_type, instance):
+    """
+    Updates the route of the instance. Replica sets are routed to their primary, as reported by
+    the operator, since the service of the instance spreads the connections across all the
+    members. They are routed to the service until the primary is known.
+    """
+    hostname = f"{instance.name}.{router_domain}"
+    if event_type == "DELETED":
+        routes.pop(hostname, None)
+        return
+    host, port = f"{instance.name}.{instance.namespace}.svc.cluster.local", 27017
+    primary = (instance.raw.get("status") or {}).get("replicaSet", {}).get("primary")
+    if primary:
+        host, _, primary_port = primary.rpartition(":")
+        port = int(primary_port)
+    routes[hostname] = Route(
+        name=instance.name,
+        namespace=instance.namespace,
+        host=host,
+        port=port,
+        hibernated=bool(instance.spec.get("hibernated")),
+    )
+
+
+def replace_routes(instances):
+    """Replaces the routing table with the routes of the instances, dropping the routes of the
+    instances deleted while they weren't watched."""
+    hostnames = set()
+    for instance in instances:
+        update_route("ADDED", instance)
+        hostnames.add(f"{instance.name}.{router_domain}")
+    for hostname in routes.keys() - hostnames:
+        del routes[hostname]
+
+
+async def watch_routes():
+    """
+    Keeps the routing table up to date. The API server ends watches after a while, so whenever
+    the watch ends or fails the instances are listed again and watched from there.
+    """
+    while True:
+        try:
+            replace_routes([i async for i in get("mongoinstances", namespace="default")])
+            logging.info(f"Routing {len(routes)} instances.")
+            async for event in watch("mongoinstances", namespace="default"):
+                event_type, instance = event
+                logging.info(f"Event: {event_type}, Instance: {instance['metadata']['name']}")
+                update_route(event_type, instance)
+            logging.info("Watch ended, listing the instances again.")
+        except Exception as e:
+            logging.error(f"Error watching the instances: {e}")
+            await asyncio.sleep(watch_retry_interval)
+
+
+async def main():
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(ClientProtocol, port=listen_port)
+    logging.info(f"Routing connections on port {listen_port}.")
+    async with server:
+        await watch_routes()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
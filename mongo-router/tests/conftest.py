@@ -0,0 +1,7 @@
+"""
+Pytest configuration file, the router reads its settings when imported.
+"""
+
+import os
+
+os.environ.setdefault("ROUTER_DOMAIN", "mongo.example.com")
@@ -0,0 +1,100 @@
+"""
+Tests for the SNI parsing and the routing table.
+"""
+
+import ssl
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+
+def client_hello(server_hostname=None):
+    """Returns the ClientHello record, without the record header, sent by a TLS client."""
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    outgoing = ssl.MemoryBIO()
+    tls = context.wrap_bio(ssl.MemoryBIO(), outgoing, server_hostname=server_hostname)
+    with pytest.raises(ssl.SSLWantReadError):
+        tls.do_handshake()
+    record = outgoing.read()
+    assert record[0] == main.TLS_HANDSHAKE
+    return record[5 : 5 + int.from_bytes(record[3:5], "big")]
+
+
+def mongo_instance(name, status=None, hibernated=False):
+    """Returns a MongoInstance as received from the watch."""
+    spec = {"hibernated": hibernated}
+    return SimpleNamespace(
+        name=name,
+        namespace="default",
+        spec=spec,
+        raw={"spec": spec, "status": status or {}},
+    )
+
+
+@pytest.fixture(autouse=True)
+def routes():
+    main.routes.clear()
+    yield main.routes
+    main.routes.clear()
+
+
+def test_parse_sni():
+    """Test that the hostname is read from a ClientHello, lowercase."""
+    record = client_hello("Tenant.Mongo.Example.com")
+    assert main.parse_sni(record) == "tenant.mongo.example.com"
+    assert main.parse_sni(client_hello()) is None
+
+
+def test_parse_sni_malformed():
+    """Test that truncated, corrupted or empty records are rejected without errors."""
+    record = client_hello("tenant.mongo.example.com")
+    for length in range(len(record)):
+        # The name can be read as long as the record is cut after it
+        assert main.parse_sni(record[:length]) in (None, "tenant.mongo.example.com")
+    assert main.parse_sni(record[:60]) is None
+    corrupted = bytearray(record)
+    # Session id longer than the record
+    corrupted[38] = 0xFF
+    assert main.parse_sni(bytes(corrupted)) is None
+    assert main.parse_sni(b"\x02" + record[1:]) is None
+    assert main.parse_sni(record.replace(b"tenant", b"t\xffnant")) is None
+
+
+def test_update_route():
+    """Test that instances are routed by hostname to their service."""
+    main.update_route("ADDED", mongo_instance("tenant", hibernated=True))
+    route = main.routes["tenant.mongo.example.com"]
+    assert (route.host, route.port) == ("tenant.default.svc.cluster.local", 27017)
+    assert route.hibernated
+
+    main.update_route("DELETED", mongo_instance("tenant"))
+    assert main.routes == {}
+
+
+def test_update_route_replica_set_primary():
+    """Test that replica sets are routed to their primary once it is known."""
+    primary = "tenant-1.tenant-headless.default.svc.cluster.local:27017"
+    main.update_route("ADDED", mongo_instance("tenant", {"replicaSet": {"primary": None}}))
+    assert main.routes["tenant.mongo.example.com"].host == (
+        "tenant.default.svc.cluster.local"
+    )
+    main.update_route(
+        "MODIFIED", mongo_instance("tenant", {"replicaSet": {"primary": primary}})
+    )
+    route = main.routes["tenant.mongo.example.com"]
+    assert (route.host, route.port) == (
+        "tenant-1.tenant-headless.default.svc.cluster.local",
+        27017,
+    )
+
+
+def test_replace_routes():
+    """Test that relisting the instances drops the routes of the deleted ones."""
+    main.update_route("ADDED", mongo_instance("deleted"))
+    main.update_route("ADDED", mongo_instance("tenant"))
+    main.replace_routes([mongo_instance("tenant", hibernated=True), mongo_instance("new")])
+    assert set(main.routes) == {"tenant.mongo.example.com", "new.mongo.example.com"}
+    assert main.routes["tenant.mongo.example.com"].hibernated